@@ -3,94 +3,53 @@
 import os
 import openai
 import logging
-import requests
 import sys
 import json
-import tempfile
-from llama_index.tools import BaseTool, FunctionTool
-from llama_index.multi_modal_llms.gemini import GeminiMultiModal
-from llama_index.multi_modal_llms.generic_utils import load_image_urls
+from llama_index.tools import FunctionTool
 from typing import List
 import os.path
-from llama_index import (
-  VectorStoreIndex,
-  SimpleDirectoryReader,
-  StorageContext,
-  load_index_from_storage,
-  )
-from llama_hub.youtube_transcript import YoutubeTranscriptReader
 from llama_index.tools import QueryEngineTool, ToolMetadata
-from llama_index.agent import OpenAIAgent
-from llama_index.llms import OpenAI,Gemini
+from llama_index.agent import AgentRunner
+from llama_index.llms import Gemini
+from agent.video_summaries import load_video_summaries
+from agent.index_loader import load_toolbox_indexes, LazyQueryEngine
+from agent.query_cache import cached_query_engine
+from agent.image_analysis import ImageAnalyzer
+from agent.video_index import VideoIndex, RECOMMEND_MODE, RECOMMEND_TOP_K, format_local_recommendation
+from agent.chat_memory import SummaryMemory
+from agent.fanout_retrieval import FanOutQueryEngine, TOOLBOX_RETRIEVAL
+from agent.tool_executor import ParallelToolAgentWorker
+from agent.deadlines import HedgedOpenAI, gemini_complete, hedged_call
+from monitoring.tracing import install_llama_index_handler
+from monitoring.startup import StartupReport
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# See gunicorn.conf.py, tools_setup waits for the indexes and embeddings so a preloading master can share them with its workers
+PRELOAD_SHARED_STATE = os.environ.get("PRELOAD_SHARED_STATE") == "true"
 
-CHALLENGING_CHILD_TOOLBOX_EMBEDDING = os.environ.get("CHALLENGING_CHILD_TOOLBOX_EMBEDDING")
-MINDFULNESS_TOOLBOX_ANXIETY_EMBEDDING = os.environ.get("MINDFULNESS_TOOLBOX_ANXIETY_EMBEDDING")
-MINDFULNESS_TOOLBOX_RELATIONSHIPS_EMBEDDING = os.environ.get("MINDFULNESS_TOOLBOX_RELATIONSHIPS_EMBEDDING")
 
-CHALLENGING_CHILD_TOOLBOX = os.environ.get("CHALLENGING_CHILD_TOOLBOX")
-MINDFULNESS_TOOLBOX_ANXIETY = os.environ.get("MINDFULNESS_TOOLBOX_ANXIETY")
-MINDFULNESS_TOOLBOX_RELATIONSHIPS = os.environ.get("MINDFULNESS_TOOLBOX_RELATIONSHIPS")
-
-def load_data_from_url(url):
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.content
-
-def process_url_with_reader(url):
-    data = load_data_from_url(url)
-    with tempfile.NamedTemporaryFile(mode='wb', delete=False) as tmp_file:
-        tmp_file.write(data)
-        tmp_file_path = tmp_file.name
-    return SimpleDirectoryReader(input_files=[tmp_file_path]).load_data(show_progress=True)
-
-def agent_setup(simple_prompt=False):
-    global agent
+def tools_setup(startup=None):
+    startup = startup or StartupReport()
     openai.api_key = os.environ.get("OPENAI_API_KEY")
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
     logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
 
-    """### Vectorize Mindfulness Guides"""
+    # Tool, LLM, embedding and retrieval timings for /metrics, set before any index or agent is created
+    install_llama_index_handler()
 
-    # Attempt to load embeddings
-    try:
-        storage_context = StorageContext.from_defaults(
-            persist_dir=CHALLENGING_CHILD_TOOLBOX_EMBEDDING
-        )
-        challenging_child_index = load_index_from_storage(storage_context)
+    """### Vectorize Mindfulness Guides"""
 
-        storage_context = StorageContext.from_defaults(
-            persist_dir=MINDFULNESS_TOOLBOX_ANXIETY_EMBEDDING
-        )
-        mindfulness_TB_50_index = load_index_from_storage(storage_context)
+    # Indexes load concurrently in the background, a tool only blocks if its index isn't ready yet
+    toolbox_indexes = load_toolbox_indexes(startup=startup)
+    for name, lazy_index in toolbox_indexes.items():
+        startup.add_check(f"index:{name}", lazy_index.ready)
 
-        storage_context = StorageContext.from_defaults(
-            persist_dir=MINDFULNESS_TOOLBOX_RELATIONSHIPS_EMBEDDING
-        )
-        mindfulness_TB_relationships_index = load_index_from_storage(storage_context)
-    except:
-        # Need to generate embeddings
-        print("GENERATING EMBEDDINGS........")
-        challenging_child_docs = process_url_with_reader(CHALLENGING_CHILD_TOOLBOX)
-        mindfulness_TB_50_docs = process_url_with_reader(MINDFULNESS_TOOLBOX_ANXIETY)
-        mindfulness_TB_relationships_docs = process_url_with_reader(MINDFULNESS_TOOLBOX_RELATIONSHIPS)
-
-        # Build index
-        challenging_child_index = VectorStoreIndex.from_documents(challenging_child_docs)
-        mindfulness_TB_50_index = VectorStoreIndex.from_documents(mindfulness_TB_50_docs)
-        mindfulness_TB_relationships_index = VectorStoreIndex.from_documents(mindfulness_TB_relationships_docs)
-
-        # Persist
-        challenging_child_index.storage_context.persist(persist_dir="./agent/storage/mindfulness_TB_50")
-        mindfulness_TB_50_index.storage_context.persist("./agent/storage/mindfulness_TB_50")
-        mindfulness_TB_relationships_index.storage_context.persist(persist_dir="./agent/storage/mindfulness_TB_relationships")
-
-    challenging_child_engine = challenging_child_index.as_query_engine()
-    mindfulness_TB_50_engine = mindfulness_TB_50_index.as_query_engine()
-    mindfulness_TB_relationships_engine = mindfulness_TB_relationships_index.as_query_engine()
+    # Near identical questions from different users are answered from a semantic cache
+    challenging_child_engine = cached_query_engine("challenging_child", LazyQueryEngine(toolbox_indexes["challenging_child"]))
+    mindfulness_TB_50_engine = cached_query_engine("mindfulness_TB_50", LazyQueryEngine(toolbox_indexes["mindfulness_TB_50"]))
+    mindfulness_TB_relationships_engine = cached_query_engine("mindfulness_TB_relationships", LazyQueryEngine(toolbox_indexes["mindfulness_TB_relationships"]))
 
     """### Test to make sure our data loaded"""
 
@@ -116,6 +75,8 @@ def agent_setup(simple_prompt=False):
 
 
 
+    image_analyzer = ImageAnalyzer()
+
     def analyze_image(img_urls: List[str]) -> str:
         """Calls our Gemini vision API to analyze the image and return a description of the text contained in the image.
             Returns: A string with a description of the image and the mood it conveys if any.
@@ -123,70 +84,31 @@ def agent_setup(simple_prompt=False):
         Args:
             img_urls (List[str]): The URL of one or more images that convey the users mood
         """
-        image_documents = load_image_urls(img_urls)
-
-        gemini = GeminiMultiModal(model="models/gemini-pro-vision", api_key=os.environ.get("GOOGLE_API_KEY"))
-
-        complete_response = gemini.complete(
-            prompt="Identify what you see in the image and what mood it conveys if any",
-            image_documents=image_documents,
-        )
-
-        return complete_response
+        # downscaled, deduplicated by content hash and sent through a shared Gemini client
+        return image_analyzer.analyze(img_urls)
 
     vision_tool = FunctionTool.from_defaults(fn=analyze_image)
 
-    """### Save session tool"""
-
-    def save_session(chat_summary: str) -> bool:
-        """Persists a summary of the user's chat history. Use this tool when the user is happy with your recomendations and done with the session
-            Returns: A boolean saying if the chat history was persisted
-
-        Args:
-            chat_summary (str): A summary of the chat history, including the users name if it was provided in the chat session
-        """
-
-        # Here is where we would persist the chat summary so we can retrive it when we start a new sessions
-
-        return True
-
-    save_tool = FunctionTool.from_defaults(fn=save_session)
-
     """### Mindfulness routine recomendation tool
 
     Use Gemini Pro to examine the transcript of our mindfulness videos
     """
 
-    # Download video transcripts
-    loader = YoutubeTranscriptReader()
-    documents = loader.load_data(ytlinks=['https://youtu.be/nPvN1OI7h80?si=iB3TYXI-9Ztc0Qpi',
-                                        'https://youtu.be/8ZhjZD8rj3E?si=n30dJ0D55tRl9frP',
-                                        'https://youtu.be/mGoGYu7F2PA?si=qsvemuKLDdlnvC6z',
-                                        'https://youtu.be/d0VZk3Dd0nw?si=yb3Zr4XGErHSENFB',
-                                        'https://youtu.be/mme5NC0F7wQ?si=Dd_KECuQCjPJSFXu',
-                                        'https://youtu.be/iPjFd1eL40Y?si=3RI6N1mw6J3unntk'
-                                        'https://youtu.be/iPjFd1eL40Y?si=bC0hbYPR0jbVRim9',
-                                        'https://youtu.be/zVbRxs_QFBA?si=Bn7MC5yG2QcXtHZP',
-                                        'https://youtu.be/6xTx984jSFc?si=J3rNB2v9OUvAEBsx',
-                                        'https://youtu.be/1qBbuKWWTGY?si=GO7hyw9za62_V9cB',
-                                        'https://youtu.be/fj0dh_KxIg4?si=dxVvRm6AC3Ixls1b',
-                                        'https://youtu.be/4ksAYqRku-s?si=q3cJ7Spvbgi6H2gi',
-                                        'https://youtu.be/f2ZwrQF6VQM?si=ujQw2fq5Ww3_b9Mv',
-                                        'https://youtu.be/IL_1DRZDzWc?si=-RutJc161ZO5wgO4'])
-
-
-    videos = {}
-
-    # Have Gemini analyze the transcript sentiment and who this video is for
-    for document in documents:
-        response = Gemini(model='models/gemini-pro', api_key=os.environ.get('GOOGLE_API_KEY')).complete(f"Summarize the transcript from this mindfulness video and who should use it: {document.text}")
-        videos[document.metadata['video_id']] = response.text
+    # Summaries are cached on disk, only new videos are downloaded and sent to Gemini
+    with startup.phase("video_summaries"):
+        videos = load_video_summaries()
 
     """Create a tool which recomends a mindfulness routine based on how the user is feeling"""
 
+    # Only the closest few videos are sent to Gemini, so the prompt doesn't grow with the catalog
+    video_index = VideoIndex(videos)
+    gemini = Gemini(model='models/gemini-pro', api_key=os.environ.get('GOOGLE_API_KEY'))
 
-    json_string = json.dumps(videos)
-
+    if PRELOAD_SHARED_STATE:
+        for lazy_index in toolbox_indexes.values():
+            lazy_index.get()
+        with startup.phase("video_embeddings"):
+            video_index.matrix()
 
     def recomend_mindfulness(feelings_summary: str) -> str:
         """Recomends a mindfullness routine based on how the user is feeling
@@ -195,16 +117,25 @@ def agent_setup(simple_prompt=False):
         Args:
             feelings_summary (str): A summary of the user's feeings
         """
-        videos_string = json.dumps(videos)
+        candidates = video_index.top_k(feelings_summary, RECOMMEND_TOP_K)
+
+        if RECOMMEND_MODE == "local":
+            return format_local_recommendation(candidates)
 
-        response = Gemini(model='models/gemini-pro', api_key=os.environ.get('GOOGLE_API_KEY')).complete(f"""
+        videos_string = json.dumps({video_id: summary for video_id, summary, _ in candidates})
+        prompt = f"""
             I'm sending you a json with a list of youtube mindfulness videos
             The key is the youtube video id and the value is a summary of the video transcript
             from this mindfulness video and who should use it.  The json is here: {videos_string}.
             Recomend a video based on my feelings and include the youtube link in the format https://www.youtube.com/watch?v=video_id
-            Here is a summary of the user's feelings: {feelings_summary}""")
+            Here is a summary of the user's feelings: {feelings_summary}"""
 
-        return response.text
+        # when the request is running out of time the best match is answered without Gemini
+        return hedged_call(
+            "recommend",
+            lambda timeout: gemini_complete(gemini, prompt, timeout),
+            fallback=lambda timeout: format_local_recommendation(candidates),
+        )
 
     recommend_tool = FunctionTool.from_defaults(fn=recomend_mindfulness)
 
@@ -243,9 +174,29 @@ def agent_setup(simple_prompt=False):
         ),
     ]
 
-    tools = query_engine_tools + [vision_tool, save_tool, recommend_tool]
+    # One tool over all three books, searched concurrently and answered with a single synthesis call
+    toolboxes_tool = QueryEngineTool(
+        query_engine=cached_query_engine("toolboxes", FanOutQueryEngine(toolbox_indexes)),
+        metadata=ToolMetadata(
+            name="mindfulness_toolboxes",
+            description=(
+                "Searches all of our therapy books at once: The Challenging Child Toolbox, The Mindfulness Toolbox "
+                "for Anxiety Depression Stress and Pain, and The Mindfulness Toolbox for Relationships. "
+                "Returns an answer with the books and pages it is based on. "
+                "Use a detailed plain text question as input to the tool."
+            ),
+        ),
+    )
+
+    if TOOLBOX_RETRIEVAL == "separate":
+        tools = query_engine_tools + [vision_tool, recommend_tool]
+    else:
+        tools = [toolboxes_tool, vision_tool, recommend_tool]
+
+    return tools
 
 
+def get_system_prompt(simple_prompt=False):
     SYSTEM_PROMPT = """
     You are Willow, an emotional support assistant combining counseling expertise with the warmth and supportiveness of a best friend.
     Begin each conversation with: "Hey! I’m Willow. I’m here for you." Your role is to understand users' emotions through conversation, analyzing their drawings (if they do not know how they are feeling), or discussing dreams. 
@@ -285,22 +236,44 @@ def agent_setup(simple_prompt=False):
         Thus, you will only provide responses related to these areas. If a question falls outside your area of expertise or if you lack the necessary information, you will inform the user by saying,
         'Sorry, I do not know the answer to your question.' and then prompt for more information related to their feelings."""
 
-    llm = OpenAI(model="gpt-4-1106-preview") # Using GPT-4 Turbo (Beta)
+    return SYSTEM_PROMPT
+
+
+def session_tools(memory, save_summary):
+    """### Save session tool"""
+
+    def save_session(chat_summary: str) -> bool:
+        """Persists a summary of the user's chat history. Use this tool when the user is happy with your recomendations and done with the session
+            Returns: A boolean saying if the chat history was persisted
+
+        Args:
+            chat_summary (str): A summary of the chat history, including the users name if it was provided in the chat session
+        """
+
+        # A returning user's session starts from this summary instead of the full transcript
+        save_summary(chat_summary or memory.summary or "")
+        return True
+
+    save_tool = FunctionTool.from_defaults(fn=save_session)
+
+    return [save_tool]
+
 
-    agent = OpenAIAgent.from_tools(
+def create_agent(tools, simple_prompt=False, chat_history=None, save_summary=None):
+    # Using GPT-4 Turbo (Beta), slow calls are hedged and fall back to LLM_FAST_MODEL near the request deadline,
+    # so the client's own retries are cut down
+    llm = HedgedOpenAI(model="gpt-4-1106-preview", max_retries=1)
+
+    # Older turns are folded into a rolling summary so the prompt stays within a token budget
+    memory = SummaryMemory.from_defaults(chat_history)
+    if save_summary:
+        tools = tools + session_tools(memory, save_summary)
+
+    # OpenAIAgent with a worker that runs the tool calls of a step concurrently
+    worker = ParallelToolAgentWorker.from_tools(
         tools,
         llm=llm,
         verbose=True,
-        system_prompt=SYSTEM_PROMPT,
+        system_prompt=get_system_prompt(simple_prompt),
     )
-
-
-    # response = agent.chat("hi I'm Ali")
-    # print("**Response:**\n\n",response)
-    # response = agent.chat("https://ih1.redbubble.net/image.3636044620.1142/bg,f8f8f8-flat,750x,075,f-pad,750x1000,f8f8f8.u5.jpg")
-    # print("**Response:**\n\n",response)
-    # print(agent)
-    # gent.reset()
-    return agent
-
-# print("Agent Setup",agent)
\ No newline at end of file
+    return AgentRunner(worker, memory=memory, llm=llm, callback_manager=llm.callback_manager)
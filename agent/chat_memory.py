@@ -0,0 +1,220 @@
+import os
+import threading
+from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from llama_index.bridge.pydantic import Field
+from llama_index.llms import OpenAI, ChatMessage, MessageRole
+from llama_index.memory.types import BaseMemory
+from llama_index.utils import get_tokenizer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Most tokens of earlier conversation (rolling summary included) sent with each turn
+CHAT_MEMORY_TOKEN_LIMIT = int(os.environ.get("CHAT_MEMORY_TOKEN_LIMIT", 3000))
+# Most recent turns kept word for word, older ones are folded into the summary
+CHAT_MEMORY_KEEP_TURNS = int(os.environ.get("CHAT_MEMORY_KEEP_TURNS", 6))
+CHAT_SUMMARY_MODEL = os.environ.get("CHAT_SUMMARY_MODEL", "gpt-3.5-turbo")
+CHAT_SUMMARY_WORKERS = int(os.environ.get("CHAT_SUMMARY_WORKERS", 2))
+
+SUMMARY_PREFIX = "Summary of the earlier conversation with this user:\n"
+SUMMARY_PROMPT = """You keep notes for a mindfulness coach about a conversation with a user.
+Update the notes with the new messages. Keep the user's name, what they are going through,
+how they feel, and what was recommended and whether it helped. Write at most 200 words.
+
+Current notes:
+{summary}
+
+New messages:
+{transcript}
+
+Updated notes:"""
+
+_executor = ThreadPoolExecutor(max_workers=CHAT_SUMMARY_WORKERS, thread_name_prefix="chat-summary")
+_summary_llm = None
+
+
+def _reset_executor():
+    # a forked worker inherits the executor but none of its threads
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=CHAT_SUMMARY_WORKERS, thread_name_prefix="chat-summary")
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+def summary_message(summary):
+    return ChatMessage(role=MessageRole.SYSTEM, content=SUMMARY_PREFIX + summary)
+
+
+def split_summary(messages):
+    """Separates a leading summary_message from the rest of the history."""
+    messages = list(messages or [])
+    if messages and messages[0].role == MessageRole.SYSTEM and (messages[0].content or "").startswith(SUMMARY_PREFIX):
+        return messages[0].content[len(SUMMARY_PREFIX):], messages[1:]
+    return None, messages
+
+
+def split_turns(messages):
+    # a turn starts at a user message and carries the tool calls and replies that followed,
+    # so a function result is never sent without the call that produced it
+    turns = []
+    for message in messages:
+        if message.role == MessageRole.USER or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def summarize(summary, messages):
+    global _summary_llm
+    if _summary_llm is None:
+        _summary_llm = OpenAI(model=CHAT_SUMMARY_MODEL)
+
+    transcript = "\n".join(
+        f"{message.role.value}: {message.content}"
+        for message in messages
+        if message.role in (MessageRole.USER, MessageRole.ASSISTANT) and message.content
+    )
+    prompt = SUMMARY_PROMPT.format(summary=summary or "(none yet)", transcript=transcript)
+    return _summary_llm.complete(prompt).text.strip()
+
+
+class RollingSummaryHistory:
+    """Chat history that keeps the last turns verbatim and folds older ones into a summary.
+
+    `messages()` returns the summary followed by as many recent turns as fit in
+    `token_limit`, so the prompt stops growing with the session. Turns that fall out of
+    the window are summarized on a background thread, the request that pushed them out
+    doesn't wait for it.
+    """
+
+    def __init__(self, chat_history=None, token_limit=CHAT_MEMORY_TOKEN_LIMIT, keep_turns=CHAT_MEMORY_KEEP_TURNS,
+                 summarize_fn=summarize, tokenizer_fn=None):
+        self.summary, self._messages = split_summary(chat_history)
+        self._token_limit = token_limit
+        self._keep_turns = keep_turns
+        self._summarize = summarize_fn
+        self._tokenizer_fn = tokenizer_fn or get_tokenizer()
+        self._folding = False
+        self._lock = threading.Lock()
+        self._maybe_fold()
+
+    def _tokens(self, messages):
+        return sum(
+            len(self._tokenizer_fn(message.content or "")) + len(self._tokenizer_fn(str(message.additional_kwargs or "")))
+            for message in messages
+        )
+
+    def _window(self):
+        """Index of the first verbatim message that is still sent with each turn."""
+        budget = self._token_limit - (self._tokens([summary_message(self.summary)]) if self.summary else 0)
+        turns = split_turns(self._messages)
+        start = len(self._messages)
+        for kept, turn in enumerate(reversed(turns)):
+            budget -= self._tokens(turn)
+            if kept >= self._keep_turns or budget < 0:
+                break
+            start -= len(turn)
+        return start
+
+    def messages(self):
+        with self._lock:
+            messages = self._messages[self._window():]
+            return ([summary_message(self.summary)] if self.summary else []) + messages
+
+    def all_messages(self):
+        with self._lock:
+            return ([summary_message(self.summary)] if self.summary else []) + list(self._messages)
+
+    def append(self, message):
+        with self._lock:
+            self._messages.append(message)
+        self._maybe_fold()
+
+    def replace(self, messages):
+        summary, messages = split_summary(messages)
+        with self._lock:
+            # the agent writes back what messages() returned plus the new turn, turns outside
+            # the window that haven't been folded into the summary yet are kept
+            start = next((i for i, message in enumerate(self._messages) if messages and message is messages[0]), None)
+            if start is not None:
+                messages = self._messages[:start] + messages
+            elif summary == self.summary and self._window() == len(self._messages):
+                # nothing fit in the window, messages() only returned the summary
+                messages = self._messages + messages
+            else:
+                self.summary = summary
+            self._messages = messages
+        self._maybe_fold()
+
+    def clear(self):
+        with self._lock:
+            self.summary = None
+            self._messages = []
+
+    def _maybe_fold(self):
+        with self._lock:
+            if self._folding:
+                return
+            folded = self._messages[:self._window()]
+            if not folded:
+                return
+            self._folding = True
+            summary = self.summary
+
+        _executor.submit(self._fold, summary, folded)
+
+    def _fold(self, summary, folded):
+        try:
+            new_summary = self._summarize(summary, folded)
+        except Exception as e:
+            print("Could not summarize chat history", e)
+            with self._lock:
+                self._folding = False
+            return
+
+        with self._lock:
+            self._folding = False
+            # a reset or a new history while summarizing makes this summary stale
+            if len(self._messages) < len(folded) or any(a is not b for a, b in zip(self._messages, folded)):
+                return
+            self.summary = new_summary
+            self._messages = self._messages[len(folded):]
+        self._maybe_fold()
+
+
+class SummaryMemory(BaseMemory):
+    """llama_index memory backed by a RollingSummaryHistory.
+
+    The agent copies its memory into every task it creates, so all state lives in the
+    shared `history` object rather than on the pydantic model.
+    """
+
+    history: Any = Field(exclude=True)
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @classmethod
+    def from_defaults(cls, chat_history=None, llm=None, **kwargs):
+        return cls(history=RollingSummaryHistory(chat_history, **kwargs))
+
+    @property
+    def summary(self):
+        return self.history.summary
+
+    def get(self, **kwargs):
+        return self.history.messages()
+
+    def get_all(self):
+        return self.history.all_messages()
+
+    def put(self, message):
+        self.history.append(message)
+
+    def set(self, messages):
+        self.history.replace(messages)
+
+    def reset(self):
+        self.history.clear()
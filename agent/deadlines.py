@@ -0,0 +1,293 @@
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from google.generativeai import client as genai_client
+from google.generativeai.types.generation_types import GenerateContentResponse
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.embeddings import OpenAIEmbedding
+from llama_index.llms import OpenAI
+from llama_index.llms.gemini_utils import completion_from_gemini_response
+from monitoring.metrics import LLM_CALL_PATH
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Latency budget of a chat request, from the route down through every LLM call it makes
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", 60))
+# Longest budget a client can ask for with the X-Request-Timeout header
+REQUEST_DEADLINE_MAX_SECONDS = float(os.environ.get("REQUEST_DEADLINE_MAX_SECONDS", 120))
+# Timeout of an LLM call made outside of a request, e.g. while summarizing transcripts at boot
+LLM_CALL_TIMEOUT_SECONDS = float(os.environ.get("LLM_CALL_TIMEOUT_SECONDS", 60))
+# A call still running past this percentile of its recent latencies gets a duplicate request
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", 95))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", 20))
+# Used until a call has LLM_HEDGE_MIN_SAMPLES latencies
+LLM_HEDGE_DEFAULT_SECONDS = float(os.environ.get("LLM_HEDGE_DEFAULT_SECONDS", 15))
+# With less budget left than this, a call goes to its fast fallback instead
+LLM_FALLBACK_MIN_SECONDS = float(os.environ.get("LLM_FALLBACK_MIN_SECONDS", 10))
+LLM_FAST_MODEL = os.environ.get("LLM_FAST_MODEL", "gpt-3.5-turbo-1106")
+LLM_HEDGE_WORKERS = int(os.environ.get("LLM_HEDGE_WORKERS", 32))
+
+LATENCY_WINDOW = 200
+
+_deadline = ContextVar("deadline", default=None)
+
+_executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_WORKERS, thread_name_prefix="llm-call")
+
+
+def _reset_executor():
+    # a forked worker inherits the executor but none of its threads
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_WORKERS, thread_name_prefix="llm-call")
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+@contextmanager
+def request_deadline(seconds=REQUEST_DEADLINE_SECONDS):
+    """Gives the block `seconds` to finish, or what's left of an enclosing deadline if that's sooner."""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(min(deadline, current) if current else deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline, None outside of one."""
+    deadline = _deadline.get()
+    return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+
+def deadline_seconds(header_value):
+    """The budget of a request, from its X-Request-Timeout header when it has a valid one."""
+    try:
+        seconds = float(header_value) if header_value else REQUEST_DEADLINE_SECONDS
+    except ValueError:
+        seconds = REQUEST_DEADLINE_SECONDS
+    return min(max(seconds, 0), REQUEST_DEADLINE_MAX_SECONDS)
+
+
+class LatencyTracker:
+    """Recent successful latencies per call, to decide when a call is slow enough to hedge."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._window = window
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self._latencies.setdefault(name, deque(maxlen=self._window)).append(seconds)
+
+    def percentile(self, name, percentile=LLM_HEDGE_PERCENTILE, min_samples=LLM_HEDGE_MIN_SAMPLES):
+        with self._lock:
+            latencies = sorted(self._latencies.get(name, ()))
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+    def stats(self):
+        with self._lock:
+            names = list(self._latencies)
+        return {name: self.percentile(name, min_samples=1) for name in names}
+
+
+latencies = LatencyTracker()
+
+
+def _submit(name, fn, timeout, record):
+    start = time.perf_counter()
+    # the call runs with the caller's context, so its spans land on the request trace
+    future = _executor.submit(contextvars.copy_context().run, fn, timeout)
+    if record:
+        # losers of a hedge are recorded too, otherwise hedging would hide how slow the provider is
+        future.add_done_callback(
+            lambda done: done.exception() or latencies.observe(name, time.perf_counter() - start)
+        )
+    return future
+
+
+def hedged_call(name, call, fallback=None):
+    """Runs `call(timeout)` within the current deadline and returns its result.
+
+    A call that hasn't answered by its usual p`LLM_HEDGE_PERCENTILE` latency, or that failed,
+    is sent again, and whichever answer comes first is used. With a `fallback` (a faster,
+    cheaper way to answer), the last LLM_FALLBACK_MIN_SECONDS of the budget are kept for it:
+    if neither the call nor its duplicate answered before then, `fallback(timeout)` joins the
+    race. Raises DeadlineExceeded if nothing answered in time. Every call is counted in
+    willow_llm_call_path_total by the path that served it.
+    """
+    budget = remaining()
+    if budget is None:
+        budget = LLM_CALL_TIMEOUT_SECONDS
+    start = time.monotonic()
+    deadline = start + budget
+
+    if fallback and budget < LLM_FALLBACK_MIN_SECONDS:
+        return _finish(name, {_submit(name, fallback, budget, record=False): "fallback"}, deadline)
+
+    # the call and its duplicate only get the time the fallback doesn't need
+    cutoff = deadline - LLM_FALLBACK_MIN_SECONDS if fallback else deadline
+    paths = {_submit(name, call, budget, record=True): "primary"}
+    errors = []
+    hedge_after = latencies.percentile(name) or LLM_HEDGE_DEFAULT_SECONDS
+    answered = _wait_first(paths, min(start + hedge_after, cutoff), errors)
+
+    if not answered and time.monotonic() < cutoff:
+        paths[_submit(name, call, deadline - time.monotonic(), record=True)] = "hedge"
+        answered = _wait_first(paths, cutoff, errors)
+
+    if answered:
+        LLM_CALL_PATH.labels(call=name, path=paths[answered]).inc()
+        return answered.result()
+
+    if fallback:
+        paths[_submit(name, fallback, max(deadline - time.monotonic(), 0), record=False)] = "fallback"
+    elif not paths:
+        LLM_CALL_PATH.labels(call=name, path="error").inc()
+        raise errors[0]
+
+    try:
+        return _finish(name, paths, deadline)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        # every attempt failed, report what went wrong with the first one
+        if errors:
+            raise errors[0]
+        raise
+
+
+def _wait_first(paths, until, errors):
+    """Waits until one of `paths` ({future: path}) answers or `until`, returns its future or None.
+
+    Attempts that failed are taken out of `paths` and their exceptions added to `errors`.
+    """
+    while paths:
+        done, _ = wait(paths, timeout=max(until - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+        if not done:
+            return None
+        for future in done:
+            if not future.exception():
+                return future
+            errors.append(future.exception())
+            del paths[future]
+    return None
+
+
+def _finish(name, paths, deadline):
+    """Returns the first successful result among `paths` ({future: path}), waiting until `deadline`."""
+    pending = set(paths)
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception():
+                error = future.exception()
+                continue
+            LLM_CALL_PATH.labels(call=name, path=paths[future]).inc()
+            return future.result()
+
+    if error and not pending:
+        LLM_CALL_PATH.labels(call=name, path="error").inc()
+        raise error
+    LLM_CALL_PATH.labels(call=name, path="deadline_exceeded").inc()
+    raise DeadlineExceeded(f"{name} did not answer in time")
+
+
+def gemini_complete(llm, contents, timeout):
+    """Text of a completion of `contents` by a llama_index Gemini (or GeminiMultiModal) LLM.
+
+    google-generativeai 0.3.2 (pinned in requirements.txt) has no public way to give
+    GenerativeModel.generate_content a timeout, `request_options` only came in 0.4. Until
+    then the request is built and sent the way generate_content does it, with the timeout
+    passed to the client, tests/test_deadlines.py fails once the public option exists. The
+    call bypasses llama_index's LLM wrappers, so it reports its own LLM event for the
+    latency and stage metrics.
+    """
+    model = llm._model
+    callback_manager = getattr(llm, "callback_manager", None) or CallbackManager()
+    with callback_manager.event(
+        CBEventType.LLM,
+        payload={EventPayload.SERIALIZED: {"model": llm.model_name}, EventPayload.PROMPT: str(contents)},
+    ) as event:
+        request = model._prepare_request(contents=contents)
+        if model._client is None:
+            model._client = genai_client.get_default_generative_client()
+        response = GenerateContentResponse.from_response(model._client.generate_content(request, timeout=timeout))
+        completion = completion_from_gemini_response(response)
+        event.on_end(payload={EventPayload.COMPLETION: completion})
+    return completion.text
+
+
+class HedgedOpenAI(OpenAI):
+    """OpenAI LLM whose chat calls run within the request deadline, see `hedged_call`.
+
+    The fallback is `fast_model`, it has to support the same tools. Streamed chats can't be
+    hedged, they only get the remaining budget as their timeout, or the fast model when
+    little of it is left.
+    """
+
+    fast_model: str = LLM_FAST_MODEL
+    _fast_llm: Optional[OpenAI] = PrivateAttr(default=None)
+
+    def fast_llm(self):
+        if self._fast_llm is None:
+            self._fast_llm = OpenAI(
+                model=self.fast_model,
+                temperature=self.temperature,
+                max_retries=self.max_retries,
+                callback_manager=self.callback_manager,
+            )
+        return self._fast_llm
+
+    def chat(self, messages, **kwargs):
+        return hedged_call(
+            f"chat:{self.model}",
+            lambda timeout: OpenAI.chat(self, messages, timeout=timeout, **kwargs),
+            fallback=lambda timeout: self.fast_llm().chat(messages, timeout=timeout, **kwargs),
+        )
+
+    def stream_chat(self, messages, **kwargs):
+        budget = remaining()
+        if budget is None:
+            return OpenAI.stream_chat(self, messages, **kwargs)
+        if budget < LLM_FALLBACK_MIN_SECONDS:
+            LLM_CALL_PATH.labels(call=f"chat:{self.model}", path="fallback").inc()
+            return self.fast_llm().stream_chat(messages, timeout=budget, **kwargs)
+        LLM_CALL_PATH.labels(call=f"chat:{self.model}", path="primary").inc()
+        return OpenAI.stream_chat(self, messages, timeout=budget, **kwargs)
+
+
+class HedgedOpenAIEmbedding(OpenAIEmbedding):
+    """OpenAIEmbedding whose query embeddings are computed within the request deadline, see `hedged_call`.
+
+    Document embeddings keep llama_index's retries, they are computed by index builds and
+    ingestion, outside of a request.
+    """
+
+    def _get_query_embedding(self, query):
+        client = self._get_client()
+        return hedged_call(
+            f"embedding:{self.model_name}",
+            lambda timeout: client.embeddings.create(
+                input=[query.replace("\n", " ")], model=self._query_engine, timeout=timeout, **self.additional_kwargs
+            ).data[0].embedding,
+        )
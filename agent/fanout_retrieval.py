@@ -0,0 +1,150 @@
+import os
+import time
+import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from llama_index.core.base_query_engine import BaseQueryEngine
+from llama_index.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.response.schema import Response
+from llama_index.response_synthesizers import get_response_synthesizer
+from llama_index.schema import NodeWithScore
+from agent.deadlines import HedgedOpenAIEmbedding, remaining
+from agent.index_loader import EMBED_MODEL, TOOLBOX_INDEXES, query_service_context
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "fanout" gives the agent one tool over every toolbox, "separate" one tool per toolbox
+TOOLBOX_RETRIEVAL = os.environ.get("TOOLBOX_RETRIEVAL", "fanout")
+FANOUT_TOP_K_PER_INDEX = int(os.environ.get("FANOUT_TOP_K_PER_INDEX", 4))
+FANOUT_TOP_K = int(os.environ.get("FANOUT_TOP_K", 5))
+# An index that hasn't answered by then is left out of the answer
+FANOUT_INDEX_TIMEOUT_SECONDS = float(os.environ.get("FANOUT_INDEX_TIMEOUT_SECONDS", 5))
+# Per index overrides, e.g. "challenging_child=3,mindfulness_TB_50=8"
+FANOUT_INDEX_TIMEOUTS = {
+    name.strip(): float(seconds)
+    for name, seconds in (
+        entry.split("=", 1) for entry in os.environ.get("FANOUT_INDEX_TIMEOUTS", "").split(",") if "=" in entry
+    )
+}
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", 8))
+
+NO_RESULTS = "Nothing in the toolboxes matches this question."
+
+_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+
+def _reset_executor():
+    # a forked worker inherits the executor but none of its threads
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+def source_label(name, node):
+    label = TOOLBOX_INDEXES[name].get("title", name)
+    page = node.metadata.get("page_label")
+    return f"{label}, p. {page}" if page else label
+
+
+class FanOutQueryEngine(BaseQueryEngine):
+    """Answers from every toolbox at once.
+
+    The query is embedded once, the indexes are searched concurrently, and the passages
+    that came back in time are merged by similarity (every index uses the same embedding
+    model, so scores compare) before a single synthesis call. Each index has its own
+    budget, `timeouts[name]` or `timeout`, cut to what is left of the request deadline, so
+    a slow index only loses its own passages. Each passage is labelled with the book and
+    page it came from.
+    """
+
+    def __init__(self, lazy_indexes, top_k_per_index=FANOUT_TOP_K_PER_INDEX, top_k=FANOUT_TOP_K,
+                 timeout=FANOUT_INDEX_TIMEOUT_SECONDS, timeouts=None, embed_model=None):
+        super().__init__(callback_manager=None)
+        self._lazy_indexes = lazy_indexes
+        self._top_k_per_index = top_k_per_index
+        self._top_k = top_k
+        self._timeout = timeout
+        self._timeouts = {**FANOUT_INDEX_TIMEOUTS, **(timeouts or {})}
+        self._embed_model = embed_model
+        self._retrievers = {}
+        self._synthesizer = None
+
+    def _get_prompt_modules(self):
+        return {}
+
+    @property
+    def embed_model(self):
+        if self._embed_model is None:
+            self._embed_model = HedgedOpenAIEmbedding(model=EMBED_MODEL)
+        return self._embed_model
+
+    @property
+    def synthesizer(self):
+        if self._synthesizer is None:
+            # synthesized with the deadline-aware LLM of the toolbox engines, not llama_index's default
+            self._synthesizer = get_response_synthesizer(service_context=query_service_context())
+        return self._synthesizer
+
+    def retriever(self, name):
+        if name not in self._retrievers:
+            # without node_ids, as_retriever() would filter on every id in the index
+            self._retrievers[name] = VectorIndexRetriever(
+                self._lazy_indexes[name].get(), similarity_top_k=self._top_k_per_index
+            )
+        return self._retrievers[name]
+
+    def index_timeout(self, name):
+        seconds = self._timeouts.get(name, self._timeout)
+        budget = remaining()
+        return seconds if budget is None else min(seconds, budget)
+
+    def _retrieve_from(self, name, query_bundle):
+        nodes = []
+        for node in self.retriever(name).retrieve(query_bundle):
+            # a copy, so the label doesn't end up on nodes the docstore hands out again
+            labelled = node.node.copy()
+            labelled.metadata = {**labelled.metadata, "source": source_label(name, labelled)}
+            nodes.append(NodeWithScore(node=labelled, score=node.score))
+        return nodes
+
+    def retrieve(self, query_bundle):
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self.embed_model.get_query_embedding(query_bundle.query_str)
+
+        searches = []
+        for name in self._lazy_indexes:
+            future = _executor.submit(contextvars.copy_context().run, self._retrieve_from, name, query_bundle)
+            # every index's budget is counted from when it was submitted
+            searches.append((name, future, time.monotonic() + self.index_timeout(name)))
+
+        nodes = []
+        for name, future, deadline in searches:
+            try:
+                nodes.extend(future.result(timeout=max(deadline - time.monotonic(), 0)))
+            except TimeoutError:
+                print(f"Index {name} took longer than {self.index_timeout(name):g}s, answering without it")
+            except Exception as e:
+                print(f"Index {name} failed", e)
+
+        # the same passage can be in more than one book's index
+        merged = {}
+        for node in sorted(nodes, key=lambda node: node.score or 0, reverse=True):
+            digest = hashlib.sha256(node.node.get_content().encode("utf-8")).hexdigest()
+            merged.setdefault(digest, node)
+        return list(merged.values())[:self._top_k]
+
+    def _query(self, query_bundle):
+        nodes = self.retrieve(query_bundle)
+        if not nodes:
+            return Response(NO_RESULTS, source_nodes=[])
+
+        response = self.synthesizer.synthesize(query_bundle, nodes)
+        sources = list(dict.fromkeys(node.node.metadata["source"] for node in nodes))
+        response.response = f"{response.response}\n\nSources: {'; '.join(sources)}"
+        return response
+
+    async def _aquery(self, query_bundle):
+        return self._query(query_bundle)
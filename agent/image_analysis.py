@@ -0,0 +1,119 @@
+import io
+import os
+import hashlib
+import threading
+import requests
+from collections import OrderedDict
+from concurrent.futures import Future
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
+from llama_index.multi_modal_llms.gemini import GeminiMultiModal
+from agent.deadlines import gemini_complete, hedged_call, remaining
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Longest side of the image sent to the vision model, phone photos are several times larger
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", 1024))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", 85))
+IMAGE_FETCH_TIMEOUT_SECONDS = float(os.environ.get("IMAGE_FETCH_TIMEOUT_SECONDS", 20))
+IMAGE_ANALYSIS_CACHE_SIZE = int(os.environ.get("IMAGE_ANALYSIS_CACHE_SIZE", 256))
+
+IMAGE_PROMPT = "Identify what you see in the image and what mood it conveys if any"
+
+
+class ImageAnalyzer:
+    """Describes images with Gemini vision, reusing one HTTP session and one Gemini client.
+
+    Images are downscaled before they are sent, and descriptions are cached by the hash
+    of the downloaded bytes, so the same drawing is only analyzed once even when it is
+    sent twice or from different URLs.
+    """
+
+    def __init__(self, gemini=None, session=None, cache_size=IMAGE_ANALYSIS_CACHE_SIZE):
+        self._gemini = gemini
+        self._session = session or self._pooled_session()
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @property
+    def gemini(self):
+        if self._gemini is None:
+            self._gemini = GeminiMultiModal(model="models/gemini-pro-vision", api_key=os.environ.get("GOOGLE_API_KEY"))
+        return self._gemini
+
+    def _pooled_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def fetch(self, url):
+        budget = remaining()
+        timeout = IMAGE_FETCH_TIMEOUT_SECONDS if budget is None else min(IMAGE_FETCH_TIMEOUT_SECONDS, budget)
+        response = self._session.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    def analyze(self, img_urls, prompt=IMAGE_PROMPT):
+        images = [self.fetch(url) for url in img_urls]
+
+        digest = hashlib.sha256(prompt.encode("utf-8"))
+        for image in images:
+            digest.update(hashlib.sha256(image).digest())
+        key = digest.hexdigest()
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            # the same image being analyzed by another request is waited on, not sent again
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            description = self._describe(images, prompt)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            self._cache[key] = description
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        future.set_result(description)
+        return description
+
+    def _describe(self, images, prompt):
+        downscaled = [downscale(image) for image in images]
+        return hedged_call("vision", lambda timeout: self._complete(downscaled, prompt, timeout))
+
+    def _complete(self, images, prompt, timeout):
+        # every attempt opens its own images, a hedged attempt can still be reading them after the other returned
+        return gemini_complete(self.gemini, [prompt, *(Image.open(io.BytesIO(image)) for image in images)], timeout)
+
+
+def downscale(image_bytes, max_dimension=IMAGE_MAX_DIMENSION, quality=IMAGE_JPEG_QUALITY):
+    """Re-encodes an image as a JPEG whose longest side is at most max_dimension."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # phone photos are often stored sideways with an EXIF rotation
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
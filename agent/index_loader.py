@@ -0,0 +1,372 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import requests
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from llama_index import (
+  ServiceContext,
+  VectorStoreIndex,
+  SimpleDirectoryReader,
+  StorageContext,
+  load_index_from_storage,
+  )
+from llama_index.core.base_query_engine import BaseQueryEngine
+from llama_index.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.query_engine import RetrieverQueryEngine
+from agent.deadlines import HedgedOpenAI, HedgedOpenAIEmbedding
+from agent.vector_store import VECTOR_STORE_FORMAT, MmapVectorStore, has_mmap_vectors, convert_persist_dir
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+CHALLENGING_CHILD_TOOLBOX_EMBEDDING = os.environ.get("CHALLENGING_CHILD_TOOLBOX_EMBEDDING", "./agent/storage/challenging_child")
+MINDFULNESS_TOOLBOX_ANXIETY_EMBEDDING = os.environ.get("MINDFULNESS_TOOLBOX_ANXIETY_EMBEDDING", "./agent/storage/mindfulness_TB_50")
+MINDFULNESS_TOOLBOX_RELATIONSHIPS_EMBEDDING = os.environ.get("MINDFULNESS_TOOLBOX_RELATIONSHIPS_EMBEDDING", "./agent/storage/mindfulness_TB_relationships")
+
+CHALLENGING_CHILD_TOOLBOX = os.environ.get("CHALLENGING_CHILD_TOOLBOX")
+MINDFULNESS_TOOLBOX_ANXIETY = os.environ.get("MINDFULNESS_TOOLBOX_ANXIETY")
+MINDFULNESS_TOOLBOX_RELATIONSHIPS = os.environ.get("MINDFULNESS_TOOLBOX_RELATIONSHIPS")
+
+INDEX_MANIFEST = os.environ.get("INDEX_MANIFEST", "./agent/storage/index_manifest.json")
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "text-embedding-ada-002")
+# Model that writes the toolbox tools' answers from the retrieved passages, llama_index's default
+TOOLBOX_LLM_MODEL = os.environ.get("TOOLBOX_LLM_MODEL", "gpt-3.5-turbo")
+# "background" starts loading every index at boot, "on_demand" waits for the first query
+INDEX_LOAD_MODE = os.environ.get("INDEX_LOAD_MODE", "background")
+# Indexes are built offline with `python -m agent.ingest`, set this to embed a missing index while serving
+INDEX_REBUILD_ON_FAILURE = os.environ.get("INDEX_REBUILD_ON_FAILURE", "false") == "true"
+# At load, files whose size and mtime match the manifest are trusted and only changed ones are hashed,
+# set this to hash every file of a store at every load
+INDEX_VERIFY_CONTENT = os.environ.get("INDEX_VERIFY_CONTENT") == "true"
+
+MANIFEST_VERSION = 1
+
+TOOLBOX_INDEXES = {
+    "challenging_child": {
+        "title": "The Challenging Child Toolbox",
+        "persist_dir": CHALLENGING_CHILD_TOOLBOX_EMBEDDING,
+        "source_url": CHALLENGING_CHILD_TOOLBOX,
+    },
+    "mindfulness_TB_50": {
+        "title": "The Mindfulness Toolbox: 50 Practical Tips, Tools & Handouts for Anxiety, Depression, Stress & Pain",
+        "persist_dir": MINDFULNESS_TOOLBOX_ANXIETY_EMBEDDING,
+        "source_url": MINDFULNESS_TOOLBOX_ANXIETY,
+    },
+    "mindfulness_TB_relationships": {
+        "title": "The Mindfulness Toolbox for Relationships",
+        "persist_dir": MINDFULNESS_TOOLBOX_RELATIONSHIPS_EMBEDDING,
+        "source_url": MINDFULNESS_TOOLBOX_RELATIONSHIPS,
+    },
+}
+
+_executor = ThreadPoolExecutor(max_workers=len(TOOLBOX_INDEXES), thread_name_prefix="index-loader")
+
+
+def _reset_executor():
+    # a forked worker inherits the executor but none of its threads
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=len(TOOLBOX_INDEXES), thread_name_prefix="index-loader")
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+class IndexManifestError(Exception):
+    pass
+
+
+@contextmanager
+def file_lock(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_data_from_url(url):
+    response = requests.get(url)
+    response.raise_for_status()
+    return response.content
+
+def process_url_with_reader(url):
+    data = load_data_from_url(url)
+    with tempfile.NamedTemporaryFile(mode='wb', delete=False) as tmp_file:
+        tmp_file.write(data)
+        tmp_file_path = tmp_file.name
+    try:
+        return SimpleDirectoryReader(input_files=[tmp_file_path]).load_data(show_progress=True)
+    finally:
+        os.remove(tmp_file_path)
+
+
+def hash_file(file_path, *digests):
+    digests = digests or (hashlib.sha256(),)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            for digest in digests:
+                digest.update(chunk)
+    return digests[-1].hexdigest()
+
+
+def scan_persist_dir(persist_dir):
+    """Returns the content hash of a store and {relative path: {size, mtime_ns, sha256}} of its files."""
+    digest = hashlib.sha256()
+    files = {}
+    for root, dirs, file_names in os.walk(persist_dir):
+        dirs.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(file_path, persist_dir)
+            digest.update(relative_path.encode("utf-8"))
+            stat = os.stat(file_path)
+            files[relative_path] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": hash_file(file_path, digest, hashlib.sha256()),
+            }
+    return digest.hexdigest(), files
+
+
+def hash_persist_dir(persist_dir):
+    return scan_persist_dir(persist_dir)[0]
+
+
+def read_manifest(path=INDEX_MANIFEST):
+    try:
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        raise IndexManifestError(f"Index manifest {path} is not valid json: {e}")
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise IndexManifestError(f"Index manifest {path} has unsupported version {manifest.get('version')}")
+
+    return manifest.get("indexes", {})
+
+
+def write_manifest_entry(name, persist_dir, path=INDEX_MANIFEST):
+    # hashed here, when the store is built, so loading it only has to compare file sizes and mtimes
+    content_hash, files = scan_persist_dir(persist_dir)
+    entry = {
+        "path": persist_dir,
+        "content_hash": content_hash,
+        "files": files,
+        "embed_model": EMBED_MODEL,
+        "built_at": datetime.utcnow().isoformat(),
+    }
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    with file_lock(path + ".lock"):
+        try:
+            indexes = read_manifest(path)
+        except IndexManifestError:
+            indexes = {}
+        indexes[name] = entry
+
+        with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp") as tmp_file:
+            json.dump({"version": MANIFEST_VERSION, "indexes": indexes}, tmp_file, indent=2, sort_keys=True)
+        os.replace(tmp_file.name, path)
+
+    return entry
+
+
+def verify_index(name, persist_dir, manifest_path=INDEX_MANIFEST, verify_content=INDEX_VERIFY_CONTENT):
+    if not persist_dir or not os.path.isdir(persist_dir):
+        raise IndexManifestError(f"Index {name} has no store at {persist_dir}, build it with `python -m agent.ingest {name}`")
+
+    entry = read_manifest(manifest_path).get(name)
+    if entry is None:
+        print(f"Index {name} has no manifest entry, run `python -m agent.index_loader` to record one")
+        return None
+
+    if entry.get("embed_model") != EMBED_MODEL:
+        raise IndexManifestError(
+            f"Index {name} was embedded with {entry.get('embed_model')} but the server queries with {EMBED_MODEL}"
+        )
+
+    if os.path.abspath(entry.get("path", "")) != os.path.abspath(persist_dir):
+        raise IndexManifestError(f"Index {name} manifest points at {entry.get('path')}, not {persist_dir}")
+
+    if verify_content or "files" not in entry:
+        if "files" not in entry:
+            print(f"Index {name} manifest entry has no file list, run `python -m agent.index_loader` to skip hashing it at boot")
+        if entry.get("content_hash") != hash_persist_dir(persist_dir):
+            raise IndexManifestError(f"Index {name} at {persist_dir} does not match its manifest content hash")
+        return entry
+
+    for relative_path, recorded in entry["files"].items():
+        file_path = os.path.join(persist_dir, relative_path)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            raise IndexManifestError(f"Index {name} is missing {relative_path}")
+        if stat.st_size != recorded["size"]:
+            raise IndexManifestError(f"Index {name} file {relative_path} does not match its manifest size")
+        # a copy or a deploy can touch a file without changing it, only those files are read
+        if stat.st_mtime_ns != recorded["mtime_ns"] and hash_file(file_path) != recorded["sha256"]:
+            raise IndexManifestError(f"Index {name} file {relative_path} does not match its manifest content hash")
+
+    return entry
+
+
+def load_storage_context(persist_dir):
+    # the mmap vectors skip parsing every embedding out of the JSON vector store
+    if VECTOR_STORE_FORMAT == "auto" and has_mmap_vectors(persist_dir):
+        vector_store = MmapVectorStore.from_persist_dir(persist_dir)
+        return StorageContext.from_defaults(persist_dir=persist_dir, vector_store=vector_store)
+    return StorageContext.from_defaults(persist_dir=persist_dir)
+
+
+def load_index(name):
+    persist_dir = TOOLBOX_INDEXES[name]["persist_dir"]
+
+    try:
+        verify_index(name, persist_dir)
+        return load_index_from_storage(load_storage_context(persist_dir))
+    except Exception as e:
+        if not INDEX_REBUILD_ON_FAILURE:
+            raise
+        print(f"Could not load index {name}: {e}")
+        return rebuild_index(name)
+
+
+def rebuild_index(name):
+    persist_dir = TOOLBOX_INDEXES[name]["persist_dir"]
+    source_url = TOOLBOX_INDEXES[name]["source_url"]
+
+    if not source_url:
+        raise IndexManifestError(f"Index {name} can't be rebuilt, no source url is configured")
+
+    # one worker rebuilds, the others wait and load what it persisted
+    with file_lock(persist_dir.rstrip("/") + ".lock"):
+        try:
+            verify_index(name, persist_dir)
+            return load_index_from_storage(load_storage_context(persist_dir))
+        except Exception:
+            pass
+
+        print(f"GENERATING EMBEDDINGS FOR {name}........")
+        index = VectorStoreIndex.from_documents(process_url_with_reader(source_url))
+        install_index(name, index)
+        return index
+
+
+def install_index(name, index):
+    """Persists `index` as the store for `name` and records it in the manifest, callers hold the store's lock."""
+    persist_dir = TOOLBOX_INDEXES[name]["persist_dir"]
+
+    # persist next to the old store and swap it in so readers never see a partial directory
+    tmp_dir = f"{persist_dir.rstrip('/')}.tmp-{os.getpid()}"
+    old_dir = f"{persist_dir.rstrip('/')}.old-{os.getpid()}"
+    index.storage_context.persist(persist_dir=tmp_dir)
+    convert_persist_dir(tmp_dir)
+    if os.path.exists(persist_dir):
+        os.replace(persist_dir, old_dir)
+    os.replace(tmp_dir, persist_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    return write_manifest_entry(name, persist_dir)
+
+
+class LazyIndex:
+    """An index that loads in a background thread, either right away or on first use."""
+
+    def __init__(self, name, background=None, startup=None):
+        self.name = name
+        self._startup = startup
+        self._lock = threading.Lock()
+        self._future = None
+        self._background = background if background is not None else INDEX_LOAD_MODE == "background"
+        if self._background:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._future is None:
+                self._future = _executor.submit(self._load)
+                self._future.add_done_callback(self._report)
+        return self._future
+
+    def _load(self):
+        if self._startup is None:
+            return load_index(self.name)
+        with self._startup.phase(f"index:{self.name}"):
+            return load_index(self.name)
+
+    def _report(self, future):
+        if future.exception():
+            print(f"Index {self.name} failed to load", future.exception())
+
+    def ready(self):
+        future = self._future
+        if not self._background:
+            # loaded on first use, the worker can serve before then, only a failed load makes it unready
+            return not (future is not None and future.done() and future.exception())
+        return future is not None and future.done() and not future.exception()
+
+    def get(self):
+        return self._start().result()
+
+
+def query_service_context():
+    """ServiceContext of the toolbox query engines, their LLM and embedding calls run within the request deadline."""
+    return ServiceContext.from_defaults(
+        llm=HedgedOpenAI(model=TOOLBOX_LLM_MODEL, max_retries=1),
+        embed_model=HedgedOpenAIEmbedding(model=EMBED_MODEL),
+    )
+
+
+class LazyQueryEngine(BaseQueryEngine):
+    """Query engine for a LazyIndex, the index is only waited on when the tool is first called."""
+
+    def __init__(self, lazy_index, **query_engine_kwargs):
+        super().__init__(callback_manager=None)
+        self._lazy_index = lazy_index
+        self._query_engine_kwargs = query_engine_kwargs
+        self._query_engine = None
+
+    def _get_prompt_modules(self):
+        return {}
+
+    def get_query_engine(self):
+        if self._query_engine is None:
+            index = self._lazy_index.get()
+            # as_query_engine() would give the retriever every node id of the index to filter on
+            kwargs = dict(self._query_engine_kwargs)
+            if "service_context" not in kwargs:
+                # not the index's own, its LLM and embedding calls would ignore the request deadline
+                kwargs["service_context"] = query_service_context()
+            retriever = VectorIndexRetriever(index, callback_manager=kwargs["service_context"].callback_manager, **kwargs)
+            self._query_engine = RetrieverQueryEngine.from_args(retriever, **kwargs)
+        return self._query_engine
+
+    def _query(self, query_bundle):
+        return self.get_query_engine().query(query_bundle)
+
+    async def _aquery(self, query_bundle):
+        return await self.get_query_engine().aquery(query_bundle)
+
+
+def load_toolbox_indexes(background=None, startup=None):
+    return {name: LazyIndex(name, background, startup) for name in TOOLBOX_INDEXES}
+
+
+if __name__ == "__main__":
+    # python -m agent.index_loader records the current stores in the manifest
+    for name, config in TOOLBOX_INDEXES.items():
+        entry = write_manifest_entry(name, config["persist_dir"])
+        print(name, entry)
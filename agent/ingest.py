@@ -0,0 +1,252 @@
+"""Builds the toolbox indexes offline.
+
+Each source PDF is downloaded to disk (resuming a partial download), read page by page,
+split into chunks and embedded in concurrent, rate limited batches. Embedded chunks are
+appended to a checkpoint, so an interrupted run picks up after the last finished batch.
+Once every page is embedded the index is persisted, converted to the mmap vector store
+and recorded in the manifest the server verifies at boot.
+
+    python -m agent.ingest
+    python -m agent.ingest challenging_child --concurrency 8 --requests-per-minute 1000
+    python -m agent.ingest mindfulness_TB_50 --restart
+"""
+
+import os
+import json
+import time
+import argparse
+import hashlib
+import tempfile
+import threading
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pypdf import PdfReader
+from llama_index import ServiceContext, VectorStoreIndex
+from llama_index.embeddings import OpenAIEmbedding
+from llama_index.node_parser import SentenceSplitter
+from llama_index.schema import Document, MetadataMode, TextNode
+from agent.index_loader import EMBED_MODEL, TOOLBOX_INDEXES, file_lock, install_index
+from dotenv import load_dotenv
+
+load_dotenv()
+
+INGEST_DIR = os.environ.get("INGEST_DIR", "./agent/storage/ingest")
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 100))
+INGEST_CONCURRENCY = int(os.environ.get("INGEST_CONCURRENCY", 4))
+INGEST_REQUESTS_PER_MINUTE = int(os.environ.get("INGEST_REQUESTS_PER_MINUTE", 300))
+INGEST_CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", 1024))
+INGEST_CHUNK_OVERLAP = int(os.environ.get("INGEST_CHUNK_OVERLAP", 20))
+
+CHECKPOINT_VERSION = 1
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_TIMEOUT_SECONDS = 60
+
+
+class RateLimiter:
+    """Spaces calls evenly so no more than `per_minute` start in any minute."""
+
+    def __init__(self, per_minute):
+        self._interval = 60.0 / per_minute if per_minute else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download(url, path):
+    """Streams `url` to `path`, continuing a `.part` file left by an interrupted run."""
+    partial = path + ".part"
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    with requests.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
+        response.raise_for_status()
+        # a server that ignores the range sends the whole file again
+        mode = "ab" if offset and response.status_code == 206 else "wb"
+        with open(partial, mode) as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                f.write(chunk)
+
+    os.replace(partial, path)
+
+
+def iter_pages(path, start_page=0):
+    """Yields (page number, Document) one page at a time, the way llama_index's PDFReader labels them."""
+    reader = PdfReader(path)
+    for page_number in range(start_page, len(reader.pages)):
+        metadata = {"page_label": reader.page_labels[page_number], "file_name": os.path.basename(path)}
+        yield page_number, Document(text=reader.pages[page_number].extract_text(), metadata=metadata)
+
+
+def chunk_page(splitter, name, page_number, document):
+    # stable ids, so a resumed run produces the same nodes as an uninterrupted one
+    document.id_ = f"{name}-page-{page_number}"
+    nodes = splitter.get_nodes_from_documents([document])
+    for i, node in enumerate(nodes):
+        node.id_ = f"{document.id_}-chunk-{i}"
+    return nodes
+
+
+class Checkpoint:
+    def __init__(self, work_dir):
+        self.path = os.path.join(work_dir, "checkpoint.json")
+        self.nodes_path = os.path.join(work_dir, "nodes.jsonl")
+        self.work_dir = work_dir
+        self.state = {}
+
+    def load(self, settings):
+        try:
+            with open(self.path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            state = {}
+
+        # chunks made with other settings or from another source can't be mixed in
+        if state.get("version") != CHECKPOINT_VERSION or state.get("settings") != settings:
+            state = {"version": CHECKPOINT_VERSION, "settings": settings, "pages_done": 0, "bytes": 0}
+        self.state = state
+
+        # drop anything written after the last checkpoint, it may be a partial line
+        with open(self.nodes_path, "ab") as nodes_file:
+            nodes_file.truncate(state["bytes"])
+        return state
+
+    def save(self, pages_done, size):
+        self.state.update(pages_done=pages_done, bytes=size)
+        with tempfile.NamedTemporaryFile("w", dir=self.work_dir, delete=False, suffix=".tmp") as tmp_file:
+            json.dump(self.state, tmp_file, indent=2)
+        os.replace(tmp_file.name, self.path)
+
+
+def embed_pages(name, source_path, checkpoint, embed_model, batch_size, concurrency, requests_per_minute):
+    splitter = SentenceSplitter(chunk_size=INGEST_CHUNK_SIZE, chunk_overlap=INGEST_CHUNK_OVERLAP)
+    limiter = RateLimiter(requests_per_minute)
+    pages_done = checkpoint.state["pages_done"]
+
+    def embed(nodes):
+        if not nodes:
+            return []
+        limiter.acquire()
+        return embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+
+    # batches are written in page order, the checkpoint only ever covers whole pages
+    in_flight = deque()
+
+    def write_oldest(nodes_file):
+        last_page, nodes, future = in_flight.popleft()
+        for node, embedding in zip(nodes, future.result()):
+            node.embedding = embedding
+            nodes_file.write((json.dumps(node.to_dict()) + "\n").encode("utf-8"))
+        nodes_file.flush()
+        os.fsync(nodes_file.fileno())
+        checkpoint.save(last_page + 1, nodes_file.tell())
+        print(f"{name}: {last_page + 1} pages embedded")
+
+    with open(checkpoint.nodes_path, "ab") as nodes_file, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        batch = []
+        last_page = pages_done - 1
+        for page_number, document in iter_pages(source_path, pages_done):
+            batch.extend(chunk_page(splitter, name, page_number, document))
+            last_page = page_number
+            if len(batch) < batch_size:
+                continue
+
+            in_flight.append((last_page, batch, executor.submit(embed, batch)))
+            batch = []
+            while len(in_flight) > concurrency or (in_flight and in_flight[0][2].done()):
+                write_oldest(nodes_file)
+
+        if last_page >= pages_done:
+            in_flight.append((last_page, batch, executor.submit(embed, batch)))
+        while in_flight:
+            write_oldest(nodes_file)
+
+
+def build_index(name, checkpoint, embed_model):
+    with open(checkpoint.nodes_path) as nodes_file:
+        nodes = [TextNode.from_dict(json.loads(line)) for line in nodes_file]
+
+    # every node already has its embedding, VectorStoreIndex only embeds the ones that don't
+    service_context = ServiceContext.from_defaults(embed_model=embed_model, llm=None)
+    index = VectorStoreIndex(nodes, service_context=service_context)
+
+    persist_dir = TOOLBOX_INDEXES[name]["persist_dir"]
+    with file_lock(persist_dir.rstrip("/") + ".lock"):
+        return install_index(name, index)
+
+
+def ingest(name, batch_size=INGEST_BATCH_SIZE, concurrency=INGEST_CONCURRENCY,
+           requests_per_minute=INGEST_REQUESTS_PER_MINUTE, restart=False):
+    source_url = TOOLBOX_INDEXES[name]["source_url"]
+    if not source_url:
+        raise ValueError(f"Index {name} has no source url configured")
+
+    work_dir = os.path.join(INGEST_DIR, name)
+    os.makedirs(work_dir, exist_ok=True)
+
+    # one ingest per index at a time
+    with file_lock(work_dir.rstrip("/") + ".lock"):
+        source_path = os.path.join(work_dir, "source.pdf")
+        if restart:
+            for path in [source_path, source_path + ".part"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        if not os.path.exists(source_path):
+            print(f"{name}: downloading {source_url}")
+            download(source_url, source_path)
+
+        settings = {
+            "source_url": source_url,
+            "source_sha256": file_sha256(source_path),
+            "embed_model": EMBED_MODEL,
+            "chunk_size": INGEST_CHUNK_SIZE,
+            "chunk_overlap": INGEST_CHUNK_OVERLAP,
+        }
+        checkpoint = Checkpoint(work_dir)
+        if restart and os.path.exists(checkpoint.path):
+            os.remove(checkpoint.path)
+        state = checkpoint.load(settings)
+        if state["pages_done"]:
+            print(f"{name}: resuming after page {state['pages_done']}")
+
+        embed_model = OpenAIEmbedding(model=EMBED_MODEL, embed_batch_size=batch_size)
+        embed_pages(name, source_path, checkpoint, embed_model, batch_size, concurrency, requests_per_minute)
+
+        entry = build_index(name, checkpoint, embed_model)
+        print(f"{name}: installed at {entry['path']} ({entry['content_hash']})")
+        return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help=f"indexes to build, all by default: {', '.join(TOOLBOX_INDEXES)}")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="chunks per embedding request")
+    parser.add_argument("--concurrency", type=int, default=INGEST_CONCURRENCY, help="embedding requests in flight")
+    parser.add_argument("--requests-per-minute", type=int, default=INGEST_REQUESTS_PER_MINUTE)
+    parser.add_argument("--restart", action="store_true", help="download and embed again from scratch")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in TOOLBOX_INDEXES]
+    if unknown:
+        parser.error(f"unknown index {', '.join(unknown)}")
+
+    for name in args.names or list(TOOLBOX_INDEXES):
+        ingest(name, args.batch_size, args.concurrency, args.requests_per_minute, args.restart)
+
+
+if __name__ == "__main__":
+    main()
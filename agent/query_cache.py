@@ -0,0 +1,223 @@
+import os
+import re
+import json
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from llama_index.core.base_query_engine import BaseQueryEngine
+from agent.deadlines import HedgedOpenAIEmbedding
+from agent.index_loader import EMBED_MODEL
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Two questions about different situations still score above 0.95, only near-identical wordings should share an answer
+QUERY_CACHE_SIMILARITY = float(os.environ.get("QUERY_CACHE_SIMILARITY", 0.98))
+# Per tool overrides, e.g. "toolboxes=0.99,challenging_child=0.97"
+QUERY_CACHE_SIMILARITIES = {
+    name.strip(): float(similarity)
+    for name, similarity in (
+        entry.split("=", 1) for entry in os.environ.get("QUERY_CACHE_SIMILARITIES", "").split(",") if "=" in entry
+    )
+}
+QUERY_CACHE_TTL_SECONDS = int(os.environ.get("QUERY_CACHE_TTL_SECONDS", 24 * 60 * 60))
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", 500))
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", 20 * 1024 * 1024))
+
+# one cache per tool, the same question gets a different answer from each book
+QUERY_CACHES = {}
+
+
+def normalize_query(text):
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+def response_size(response):
+    """Bytes held by a response: its text plus the text and metadata of the nodes it was built from."""
+    size = len(str(getattr(response, "response", response) or "").encode("utf-8"))
+    for source in getattr(response, "source_nodes", None) or []:
+        size += len(source.node.get_content().encode("utf-8"))
+        size += len(json.dumps(source.node.metadata, default=str).encode("utf-8"))
+    return size
+
+
+class CacheEntry:
+    def __init__(self, embedding, response):
+        self.embedding = embedding
+        self.response = response
+        self.created_at = time.monotonic()
+        self.size = embedding.nbytes + response_size(response)
+
+
+def normalize_embedding(embedding):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return embedding / (np.linalg.norm(embedding) or 1.0)
+
+
+class SemanticQueryCache:
+    """LRU + TTL cache of query responses.
+
+    A query is a hit if its normalized text was seen before, or if its embedding's
+    cosine similarity to a cached query is at least `similarity`. The embedding is of the
+    query as asked, so a miss can hand it on to the query engine instead of it being
+    computed again.
+    """
+
+    def __init__(
+        self,
+        embed_fn=None,
+        similarity=QUERY_CACHE_SIMILARITY,
+        ttl_seconds=QUERY_CACHE_TTL_SECONDS,
+        max_entries=QUERY_CACHE_MAX_ENTRIES,
+        max_bytes=QUERY_CACHE_MAX_BYTES,
+    ):
+        self._embed_fn = embed_fn
+        self._similarity = similarity
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._matrix = None
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def embed(self, text):
+        if self._embed_fn is None:
+            # the model the indexes were embedded with, so the engine can search with this embedding
+            self._embed_fn = HedgedOpenAIEmbedding(model=EMBED_MODEL).get_query_embedding
+        return self._embed_fn(text)
+
+    def lookup(self, query, embedding=None):
+        """Returns (response, key, embedding), response is None on a miss.
+
+        `embedding` is the query's, when the caller already has it. The one returned is the
+        query's embedding as the embedding model gave it, None on an exact text hit.
+        """
+        key = normalize_query(query)
+
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.response, key, embedding
+
+        if embedding is None:
+            embedding = self.embed(query)
+        normalized = normalize_embedding(embedding)
+
+        with self._lock:
+            match = self._nearest(normalized)
+            if match:
+                self._entries.move_to_end(match)
+                self.hits += 1
+                self.semantic_hits += 1
+                return self._entries[match].response, key, embedding
+            self.misses += 1
+
+        return None, key, embedding
+
+    def store(self, key, embedding, response):
+        entry = CacheEntry(normalize_embedding(embedding), response)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._matrix = None
+
+            while self._entries and (len(self._entries) > self._max_entries or self._bytes > self._max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
+
+    def _nearest(self, embedding):
+        if not self._entries:
+            return None
+
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            self._matrix = np.vstack([self._entries[key].embedding for key in self._matrix_keys])
+
+        # embeddings are normalized, so a dot product is the cosine similarity
+        scores = self._matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] >= self._similarity:
+            return self._matrix_keys[best]
+        return None
+
+    def _expire(self):
+        if not self._ttl_seconds:
+            return
+
+        cutoff = time.monotonic() - self._ttl_seconds
+        expired = [key for key, entry in self._entries.items() if entry.created_at < cutoff]
+        for key in expired:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        self._matrix = None
+
+
+class CachedQueryEngine(BaseQueryEngine):
+    """Answers from a SemanticQueryCache before falling back to the wrapped query engine."""
+
+    def __init__(self, query_engine, cache):
+        super().__init__(callback_manager=None)
+        self._query_engine = query_engine
+        self._cache = cache
+
+    def _get_prompt_modules(self):
+        return {"query_engine": self._query_engine}
+
+    def _query(self, query_bundle):
+        response, key, embedding = self._cache.lookup(query_bundle.query_str, query_bundle.embedding)
+        if response is None:
+            # retrievers embed the query only when the bundle doesn't carry its embedding yet
+            query_bundle.embedding = embedding
+            response = self._query_engine.query(query_bundle)
+            self._cache.store(key, embedding, response)
+        return response
+
+    async def _aquery(self, query_bundle):
+        response, key, embedding = self._cache.lookup(query_bundle.query_str, query_bundle.embedding)
+        if response is None:
+            query_bundle.embedding = embedding
+            response = await self._query_engine.aquery(query_bundle)
+            self._cache.store(key, embedding, response)
+        return response
+
+
+def cached_query_engine(name, query_engine, **cache_kwargs):
+    if name not in QUERY_CACHES:
+        cache_kwargs.setdefault("similarity", QUERY_CACHE_SIMILARITIES.get(name, QUERY_CACHE_SIMILARITY))
+        QUERY_CACHES[name] = SemanticQueryCache(**cache_kwargs)
+    return CachedQueryEngine(query_engine, QUERY_CACHES[name])
+
+
+def query_cache_stats():
+    return {name: cache.stats() for name, cache in QUERY_CACHES.items()}
@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from llama_index.llms import ChatMessage, MessageRole
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MAX_AGENT_SESSIONS = int(os.environ.get("MAX_AGENT_SESSIONS", 200))
+MAX_AGENT_SESSION_MEMORY_BYTES = int(os.environ.get("MAX_AGENT_SESSION_MEMORY_BYTES", 50 * 1024 * 1024))
+AGENT_SESSION_IDLE_SECONDS = int(os.environ.get("AGENT_SESSION_IDLE_SECONDS", 30 * 60))
+AGENT_SESSION_HISTORY_LIMIT = int(os.environ.get("AGENT_SESSION_HISTORY_LIMIT", 40))
+
+
+def to_chat_history(messages, assistant_user):
+    """Turns stored (user, content) pairs, oldest first, into llama_index chat messages."""
+    history = []
+    for user, content in messages:
+        role = MessageRole.ASSISTANT if user == assistant_user else MessageRole.USER
+        history.append(ChatMessage(role=role, content=content))
+    return history
+
+
+def chat_history_bytes(agent):
+    return sum(len(message.content or "") for message in agent.chat_history)
+
+
+class AgentSession:
+    def __init__(self, agent, memory_bytes=0):
+        self.agent = agent
+        self.last_used = time.monotonic()
+        # measured when the session is created and after each of its turns, not on every lookup
+        self.memory_bytes = memory_bytes
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+
+class AgentSessionManager:
+    """Keeps one agent per (env, user) so conversations don't share chat memory.
+
+    Sessions are evicted least recently used first once there are more than
+    `max_sessions` of them or their chat histories exceed `max_memory_bytes`,
+    and dropped once idle for `idle_seconds`. An evicted session is rebuilt
+    from `load_history(env, user)` with `create_agent(env, user, chat_history)`
+    the next time that user sends a message. A session's history is measured
+    when it is created and after each of its turns, lookups don't walk every
+    history.
+
+    An agent's chat memory isn't safe to use from two threads at once, so turns
+    run under `session_lock(env, user)`: different users chat in parallel, two
+    turns for the same user are serialized.
+    """
+
+    def __init__(
+        self,
+        create_agent,
+        load_history=None,
+        max_sessions=MAX_AGENT_SESSIONS,
+        max_memory_bytes=MAX_AGENT_SESSION_MEMORY_BYTES,
+        idle_seconds=AGENT_SESSION_IDLE_SECONDS,
+    ):
+        self._create_agent = create_agent
+        self._load_history = load_history
+        self._max_sessions = max_sessions
+        self._max_memory_bytes = max_memory_bytes
+        self._idle_seconds = idle_seconds
+        self._sessions = OrderedDict()
+        # sum of the sessions' memory_bytes, kept up to date as sessions are added, measured and removed
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        # (lock, number of holders and waiters) per user, kept apart from the sessions so an
+        # eviction can't hand a second lock to a user whose turn is still running
+        self._session_locks = {}
+
+    def get_agent(self, env, user):
+        key = (env, user)
+
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(key)
+            if session:
+                session.touch()
+                self._sessions.move_to_end(key)
+                self._enforce_limits(keep=key)
+                return session.agent
+
+        # Rebuild outside the lock, loading history is a Firestore round trip
+        chat_history = self._load_history(env, user) if self._load_history else None
+        agent = self._create_agent(env, user, chat_history)
+        memory_bytes = chat_history_bytes(agent)
+
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(key)
+            if session:
+                # another request for the same user won the race, keep its session
+                session.touch()
+                self._sessions.move_to_end(key)
+            else:
+                session = self._sessions[key] = AgentSession(agent, memory_bytes)
+                self._memory_bytes += memory_bytes
+            # the limits are enforced on every path, whichever request's session was kept
+            self._enforce_limits(keep=key)
+            return session.agent
+
+    def measure(self, env, user):
+        """Measures the chat history of one session again, after a turn that may have grown it."""
+        key = (env, user)
+        with self._lock:
+            session = self._sessions.get(key)
+        if session is None:
+            return
+
+        memory_bytes = chat_history_bytes(session.agent)
+        with self._lock:
+            # the session may have been evicted or replaced while it was measured
+            if self._sessions.get(key) is not session:
+                return
+            self._memory_bytes += memory_bytes - session.memory_bytes
+            session.memory_bytes = memory_bytes
+            self._enforce_limits(keep=key)
+
+    @contextmanager
+    def session_lock(self, env, user):
+        key = (env, user)
+        with self._lock:
+            lock, users = self._session_locks.get(key, (None, 0))
+            lock = lock or threading.Lock()
+            self._session_locks[key] = (lock, users + 1)
+
+        try:
+            with lock:
+                try:
+                    yield
+                finally:
+                    self.measure(env, user)
+        finally:
+            with self._lock:
+                lock, users = self._session_locks[key]
+                if users == 1:
+                    del self._session_locks[key]
+                else:
+                    self._session_locks[key] = (lock, users - 1)
+
+    def reset(self, env, user=None):
+        with self._lock:
+            for key in list(self._sessions):
+                if key[0] == env and (user is None or key[1] == user):
+                    self._remove(key)
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "busy_sessions": len(self._session_locks),
+                "memory_bytes": self._memory_bytes,
+            }
+
+    def _evict_idle(self):
+        if not self._idle_seconds:
+            return
+
+        cutoff = time.monotonic() - self._idle_seconds
+        # sessions are kept in LRU order, so the idle ones are all at the front
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if session.last_used >= cutoff:
+                break
+            self._remove(key)
+
+    def _enforce_limits(self, keep=None):
+        while len(self._sessions) > self._max_sessions and self._evict_oldest(keep):
+            pass
+
+        while self._memory_bytes > self._max_memory_bytes and self._evict_oldest(keep):
+            pass
+
+    def _evict_oldest(self, keep=None):
+        for key in self._sessions:
+            if key != keep:
+                return self._remove(key)
+        return None
+
+    def _remove(self, key):
+        session = self._sessions.pop(key)
+        self._memory_bytes -= session.memory_bytes
+        return session
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from llama_index.agent.openai.step import OpenAIAgentWorker, call_function, get_function_by_name
+from llama_index.callbacks import CBEventType, EventPayload
+from llama_index.chat_engine.types import ChatResponseMode
+from llama_index.llms import ChatMessage, MessageRole
+from llama_index.tools import ToolOutput
+from agent.deadlines import remaining
+from monitoring.metrics import TOOL_CALL_FAILURES
+from dotenv import load_dotenv
+
+load_dotenv()
+
+AGENT_TOOL_WORKERS = int(os.environ.get("AGENT_TOOL_WORKERS", 16))
+AGENT_TOOL_TIMEOUT_SECONDS = float(os.environ.get("AGENT_TOOL_TIMEOUT_SECONDS", 60))
+# Per tool overrides, e.g. "mindfulness_toolboxes=20,recomend_mindfulness=30"
+AGENT_TOOL_TIMEOUTS = {
+    name.strip(): float(seconds)
+    for name, seconds in (
+        entry.split("=", 1) for entry in os.environ.get("AGENT_TOOL_TIMEOUTS", "").split(",") if "=" in entry
+    )
+}
+
+_executor = ThreadPoolExecutor(max_workers=AGENT_TOOL_WORKERS, thread_name_prefix="agent-tool")
+
+
+def _reset_executor():
+    # a forked worker inherits the executor but none of its threads
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=AGENT_TOOL_WORKERS, thread_name_prefix="agent-tool")
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+def tool_timeout(name):
+    """The tool's own timeout, cut to what is left of the request deadline so a tool can't outlive it."""
+    seconds = AGENT_TOOL_TIMEOUTS.get(name, AGENT_TOOL_TIMEOUT_SECONDS)
+    budget = remaining()
+    return seconds if budget is None else min(seconds, budget)
+
+
+def tool_error(tool_call, error, reason):
+    """The reply the model gets for a tool call that failed, so it can answer without it."""
+    name = tool_call.function.name
+    TOOL_CALL_FAILURES.labels(tool=name, reason=reason).inc()
+    print(f"Tool {name} failed ({reason})", error)
+    content = f"Error: {error}"
+    message = ChatMessage(
+        content=content,
+        role=MessageRole.TOOL,
+        additional_kwargs={"name": name, "tool_call_id": tool_call.id},
+    )
+    output = ToolOutput(content=content, tool_name=name, raw_input={"arguments": tool_call.function.arguments}, raw_output=error)
+    return message, output
+
+
+class ParallelToolAgentWorker(OpenAIAgentWorker):
+    """OpenAIAgentWorker that runs the tool calls of one step concurrently.
+
+    The model can ask for several tools in one message. llama_index calls them one
+    after another; here each call is submitted to a shared pool as the step reaches it,
+    and the step waits for all of them before it returns, so it takes as long as its
+    slowest tool. Each call has its own timeout (AGENT_TOOL_TIMEOUTS, or
+    AGENT_TOOL_TIMEOUT_SECONDS, at most what is left of the request deadline), counted
+    from when it was submitted. A call that times
+    out, fails or names an unknown tool is answered with an error message for that call
+    only. Results go into the chat memory in the order the model asked for them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # _call_function isn't given the task, the calls of the step running on this thread are kept here
+        self._pending = threading.local()
+
+    def _run_step(self, step, task, mode=ChatResponseMode.WAIT, tool_choice="auto"):
+        self._pending.calls = []
+        try:
+            output = super()._run_step(step, task, mode=mode, tool_choice=tool_choice)
+            self._collect(self._pending.calls)
+        finally:
+            self._pending.calls = None
+        return output
+
+    def _call_function(self, tools, tool_call, memory, sources):
+        calls = getattr(self._pending, "calls", None)
+        if calls is None:
+            return super()._call_function(tools, tool_call, memory, sources)
+
+        # each call gets a copy of the request's context, so its spans still land on the request trace
+        future = _executor.submit(contextvars.copy_context().run, self._execute, tools, tool_call)
+        seconds = tool_timeout(tool_call.function.name)
+        calls.append((tool_call, future, seconds, time.monotonic() + seconds, memory, sources))
+
+    def _execute(self, tools, tool_call):
+        function_call = tool_call.function
+        try:
+            tool = get_function_by_name(tools, function_call.name)
+            json.loads(function_call.arguments)
+        except ValueError as e:
+            return tool_error(tool_call, e, "invalid_call")
+
+        with self.callback_manager.event(
+            CBEventType.FUNCTION_CALL,
+            payload={EventPayload.FUNCTION_CALL: function_call.arguments, EventPayload.TOOL: tool.metadata},
+        ) as event:
+            function_message, tool_output = call_function(tools, tool_call, verbose=self._verbose)
+            event.on_end(payload={EventPayload.FUNCTION_OUTPUT: str(tool_output)})
+
+        # call_function already turned the exception into an error reply, it's only counted here
+        if isinstance(tool_output.raw_output, Exception):
+            TOOL_CALL_FAILURES.labels(tool=function_call.name, reason="error").inc()
+        return function_message, tool_output
+
+    def _collect(self, calls):
+        for tool_call, future, seconds, deadline, memory, sources in calls:
+            try:
+                function_message, tool_output = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except TimeoutError:
+                # the call keeps running on its thread, its result is dropped
+                function_message, tool_output = tool_error(
+                    tool_call, TimeoutError(f"{tool_call.function.name} did not answer within {seconds:g}s"), "timeout"
+                )
+            except Exception as e:
+                function_message, tool_output = tool_error(tool_call, e, "error")
+
+            sources.append(tool_output)
+            memory.put(function_message)
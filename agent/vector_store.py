@@ -0,0 +1,211 @@
+import os
+import sys
+import json
+import tempfile
+import numpy as np
+from llama_index.vector_stores.types import (
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "auto" searches the mmap vectors of an index when they have been converted, "json" always uses llama_index's JSON store
+VECTOR_STORE_FORMAT = os.environ.get("VECTOR_STORE_FORMAT", "auto")
+
+VECTORS_FILE = "vectors.npy"
+VECTORS_SIDECAR_FILE = "vectors.json"
+SIDECAR_VERSION = 1
+JSON_VECTOR_STORE_FILES = ["default__vector_store.json", "vector_store.json"]
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def has_mmap_vectors(persist_dir):
+    return all(os.path.exists(os.path.join(persist_dir, file_name)) for file_name in [VECTORS_FILE, VECTORS_SIDECAR_FILE])
+
+
+class MmapVectorStore(VectorStore):
+    """Read-only vector store over a float32 matrix memory-mapped from `vectors.npy`.
+
+    Rows are L2-normalized when they are written, so cosine similarity for a query is a
+    single matrix-vector product. Node ids, ref doc ids and metadata live in the small
+    `vectors.json` sidecar, the node text stays in the index's docstore. Pages of the
+    matrix come from the OS page cache, so every worker process searches the same copy.
+    """
+
+    stores_text = False
+    is_embedding_query = True
+
+    def __init__(self, matrix, ids, ref_doc_ids=None, metadata=None):
+        if len(ids) != matrix.shape[0]:
+            raise ValueError(f"Vector store has {matrix.shape[0]} vectors but {len(ids)} ids")
+        self._matrix = matrix
+        self._ids = ids
+        self._ref_doc_ids = ref_doc_ids or [None] * len(ids)
+        self._metadata = metadata or {}
+        # row of each node id and rows of each ref doc id, so a filter is a lookup per id, not a pass over every row
+        self._rows = {node_id: row for row, node_id in enumerate(ids)}
+        self._doc_rows = {}
+        for row, ref_doc_id in enumerate(self._ref_doc_ids):
+            self._doc_rows.setdefault(ref_doc_id, []).append(row)
+        # metadata key -> {value: rows}, built the first time a filter uses the key
+        self._metadata_rows = {}
+        # the node_ids list a retriever passes when it names every node, see _mask
+        self._all_node_ids = None
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir):
+        with open(os.path.join(persist_dir, VECTORS_SIDECAR_FILE)) as sidecar_file:
+            sidecar = json.load(sidecar_file)
+        if sidecar.get("version") != SIDECAR_VERSION:
+            raise ValueError(f"{persist_dir}/{VECTORS_SIDECAR_FILE} has unsupported version {sidecar.get('version')}")
+
+        matrix = np.load(os.path.join(persist_dir, VECTORS_FILE), mmap_mode="r")
+        return cls(matrix, sidecar["ids"], sidecar.get("ref_doc_ids"), sidecar.get("metadata"))
+
+    @property
+    def client(self):
+        return None
+
+    def add(self, nodes, **add_kwargs):
+        raise NotImplementedError("MmapVectorStore is read-only, rebuild the index and convert it again")
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        raise NotImplementedError("MmapVectorStore is read-only, rebuild the index and convert it again")
+
+    def persist(self, persist_path=None, fs=None):
+        write_vectors(os.path.dirname(persist_path), self._matrix, self._ids, self._ref_doc_ids, self._metadata)
+
+    def _rows_mask(self, rows):
+        mask = np.zeros(len(self._ids), dtype=bool)
+        mask[list(rows)] = True
+        return mask
+
+    def _covers_every_node(self, node_ids):
+        # as_retriever() passes every node id of the index on every query, in the same list, which filters nothing
+        if node_ids is self._all_node_ids:
+            return True
+        if len(node_ids) >= len(self._ids) and self._rows.keys() <= set(node_ids):
+            self._all_node_ids = node_ids
+            return True
+        return False
+
+    def _metadata_index(self, key):
+        if key not in self._metadata_rows:
+            index = {}
+            for row, node_id in enumerate(self._ids):
+                value = self._metadata.get(node_id, {}).get(key)
+                # filter values are strings or numbers, a list or dict value can't match one
+                if not isinstance(value, (list, dict)):
+                    index.setdefault(value, []).append(row)
+            self._metadata_rows[key] = index
+        return self._metadata_rows[key]
+
+    def _mask(self, query):
+        mask = None
+
+        if query.doc_ids:
+            rows = [row for doc_id in set(query.doc_ids) for row in self._doc_rows.get(doc_id, ())]
+            mask = self._rows_mask(rows)
+
+        if query.node_ids and not self._covers_every_node(query.node_ids):
+            rows = {self._rows[node_id] for node_id in query.node_ids if node_id in self._rows}
+            node_mask = self._rows_mask(rows)
+            mask = node_mask if mask is None else mask & node_mask
+
+        if query.filters is not None:
+            for metadata_filter in query.filters.filters:
+                operator = getattr(getattr(metadata_filter, "operator", None), "value", "==")
+                if operator != "==":
+                    raise ValueError(f"MmapVectorStore only supports exact match filters, not {operator}")
+            for metadata_filter in query.filters.filters:
+                rows = self._metadata_index(metadata_filter.key).get(metadata_filter.value, ())
+                filter_mask = self._rows_mask(rows)
+                mask = filter_mask if mask is None else mask & filter_mask
+
+        return mask
+
+    def query(self, query: VectorStoreQuery, **kwargs):
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"MmapVectorStore does not support {query.mode} queries")
+
+        if not self._ids or not query.similarity_top_k:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        scores = self._matrix @ normalize_rows(query_embedding)
+
+        mask = self._mask(query)
+        candidates = len(self._ids)
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+            candidates = int(mask.sum())
+
+        top_k = min(query.similarity_top_k, candidates)
+        if top_k == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return VectorStoreQueryResult(
+            similarities=[float(scores[i]) for i in best],
+            ids=[self._ids[i] for i in best],
+        )
+
+
+def write_vectors(persist_dir, matrix, ids, ref_doc_ids=None, metadata=None):
+    """Writes the matrix and its sidecar, each swapped in whole so readers never see a partial file."""
+    matrix = normalize_rows(np.asarray(matrix, dtype=np.float32))
+
+    with tempfile.NamedTemporaryFile(dir=persist_dir, delete=False, suffix=".tmp") as tmp_file:
+        np.save(tmp_file, np.ascontiguousarray(matrix))
+    os.replace(tmp_file.name, os.path.join(persist_dir, VECTORS_FILE))
+
+    sidecar = {"version": SIDECAR_VERSION, "ids": list(ids), "ref_doc_ids": list(ref_doc_ids or []), "metadata": metadata or {}}
+    with tempfile.NamedTemporaryFile("w", dir=persist_dir, delete=False, suffix=".tmp") as tmp_file:
+        json.dump(sidecar, tmp_file)
+    os.replace(tmp_file.name, os.path.join(persist_dir, VECTORS_SIDECAR_FILE))
+
+
+def convert_persist_dir(persist_dir):
+    """Converts the JSON vector store of a persisted index into `vectors.npy` and `vectors.json`."""
+    for file_name in JSON_VECTOR_STORE_FILES:
+        json_path = os.path.join(persist_dir, file_name)
+        if os.path.exists(json_path):
+            break
+    else:
+        raise FileNotFoundError(f"No JSON vector store in {persist_dir}")
+
+    with open(json_path) as json_file:
+        data = json.load(json_file)
+
+    embeddings = data.get("embedding_dict", {})
+    ids = list(embeddings)
+    ref_doc_ids = [data.get("text_id_to_ref_doc_id", {}).get(node_id) for node_id in ids]
+    metadata = {node_id: data["metadata_dict"][node_id] for node_id in ids if node_id in data.get("metadata_dict", {})}
+    matrix = np.asarray([embeddings[node_id] for node_id in ids], dtype=np.float32)
+    if not ids:
+        matrix = matrix.reshape(0, 0)
+
+    write_vectors(persist_dir, matrix, ids, ref_doc_ids, metadata)
+    return len(ids)
+
+
+if __name__ == "__main__":
+    # python -m agent.vector_store [index names] converts the toolbox indexes and updates the manifest
+    from agent.index_loader import TOOLBOX_INDEXES, file_lock, write_manifest_entry
+
+    for name in sys.argv[1:] or list(TOOLBOX_INDEXES):
+        persist_dir = TOOLBOX_INDEXES[name]["persist_dir"]
+        with file_lock(persist_dir.rstrip("/") + ".lock"):
+            count = convert_persist_dir(persist_dir)
+            write_manifest_entry(name, persist_dir)
+        print(name, f"{count} vectors written to {os.path.join(persist_dir, VECTORS_FILE)}")
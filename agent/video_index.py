@@ -0,0 +1,111 @@
+import os
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from llama_index.embeddings import OpenAIEmbedding
+from agent.index_loader import EMBED_MODEL
+from dotenv import load_dotenv
+
+load_dotenv()
+
+VIDEO_EMBEDDINGS_CACHE = os.environ.get("VIDEO_EMBEDDINGS_CACHE", "./agent/storage/video_embeddings.npz")
+# Number of candidate videos sent to Gemini
+RECOMMEND_TOP_K = int(os.environ.get("RECOMMEND_TOP_K", 3))
+# "llm" lets Gemini pick between the top candidates, "local" answers with the best match without an LLM call
+RECOMMEND_MODE = os.environ.get("RECOMMEND_MODE", "llm")
+
+
+def video_link(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+def summaries_hash(videos):
+    digest = hashlib.sha256(EMBED_MODEL.encode("utf-8"))
+    for video_id in sorted(videos):
+        digest.update(video_id.encode("utf-8"))
+        digest.update(videos[video_id].encode("utf-8"))
+    return digest.hexdigest()
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VideoIndex:
+    """Cosine top-k over the video summaries.
+
+    Summaries are embedded once on first use (and the matrix is saved next to the
+    summaries snapshot), so ranking a query costs one embedding call and one matrix product.
+    """
+
+    def __init__(self, videos, embed_model=None, path=VIDEO_EMBEDDINGS_CACHE):
+        self.videos = videos
+        self._embed_model = embed_model
+        self._path = path
+        self._ids = sorted(videos)
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    @property
+    def embed_model(self):
+        if self._embed_model is None:
+            self._embed_model = OpenAIEmbedding(model=EMBED_MODEL)
+        return self._embed_model
+
+    def matrix(self):
+        if self._matrix is None:
+            with self._lock:
+                if self._matrix is None:
+                    matrix = self._load()
+                    self._matrix = matrix if matrix is not None else self._build()
+        return self._matrix
+
+    def top_k(self, text, k=RECOMMEND_TOP_K):
+        """Returns [(video_id, summary, score)] best match first."""
+        if not self._ids:
+            return []
+
+        matrix = self.matrix()
+        query = normalize_rows(np.asarray(self.embed_model.get_query_embedding(text), dtype=np.float32))
+        scores = matrix @ query
+
+        k = min(k, len(self._ids))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(self._ids[i], self.videos[self._ids[i]], float(scores[i])) for i in best]
+
+    def _load(self):
+        try:
+            cached = np.load(self._path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+        if str(cached["key"]) != summaries_hash(self.videos) or list(cached["ids"]) != self._ids:
+            return None
+        return cached["matrix"]
+
+    def _build(self):
+        embeddings = self.embed_model.get_text_embedding_batch([self.videos[video_id] for video_id in self._ids])
+        matrix = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+
+        try:
+            directory = os.path.dirname(self._path) or "."
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=directory, delete=False, suffix=".npz") as tmp_file:
+                np.savez(tmp_file, key=summaries_hash(self.videos), ids=np.array(self._ids), matrix=matrix)
+            os.replace(tmp_file.name, self._path)
+        except OSError as e:
+            print("Could not save video embeddings", e)
+
+        return matrix
+
+
+def format_local_recommendation(candidates):
+    if not candidates:
+        return "Sorry, I don't have a mindfulness video to recommend right now."
+
+    video_id, summary, _ = candidates[0]
+    return f"I recommend this mindfulness video: {video_link(video_id)}\n\n{summary}"
@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+import tempfile
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from llama_hub.youtube_transcript import YoutubeTranscriptReader
+from llama_index.llms import Gemini
+from agent.deadlines import gemini_complete, hedged_call
+from dotenv import load_dotenv
+
+load_dotenv()
+
+VIDEO_SUMMARIES_CACHE = os.environ.get("VIDEO_SUMMARIES_CACHE", "./agent/storage/video_summaries.json")
+VIDEO_SUMMARY_CONCURRENCY = int(os.environ.get("VIDEO_SUMMARY_CONCURRENCY", 4))
+# Re-download every transcript at boot and re-summarize the ones whose text changed
+VIDEO_SUMMARIES_REVALIDATE = os.environ.get("VIDEO_SUMMARIES_REVALIDATE") == "true"
+
+SNAPSHOT_VERSION = 1
+SUMMARY_MODEL = "models/gemini-pro"
+SUMMARY_PROMPT = "Summarize the transcript from this mindfulness video and who should use it: {transcript}"
+
+VIDEO_LINKS = [
+    'https://youtu.be/nPvN1OI7h80?si=iB3TYXI-9Ztc0Qpi',
+    'https://youtu.be/8ZhjZD8rj3E?si=n30dJ0D55tRl9frP',
+    'https://youtu.be/mGoGYu7F2PA?si=qsvemuKLDdlnvC6z',
+    'https://youtu.be/d0VZk3Dd0nw?si=yb3Zr4XGErHSENFB',
+    'https://youtu.be/mme5NC0F7wQ?si=Dd_KECuQCjPJSFXu',
+    'https://youtu.be/iPjFd1eL40Y?si=3RI6N1mw6J3unntk',
+    'https://youtu.be/iPjFd1eL40Y?si=bC0hbYPR0jbVRim9',
+    'https://youtu.be/zVbRxs_QFBA?si=Bn7MC5yG2QcXtHZP',
+    'https://youtu.be/6xTx984jSFc?si=J3rNB2v9OUvAEBsx',
+    'https://youtu.be/1qBbuKWWTGY?si=GO7hyw9za62_V9cB',
+    'https://youtu.be/fj0dh_KxIg4?si=dxVvRm6AC3Ixls1b',
+    'https://youtu.be/4ksAYqRku-s?si=q3cJ7Spvbgi6H2gi',
+    'https://youtu.be/f2ZwrQF6VQM?si=ujQw2fq5Ww3_b9Mv',
+    'https://youtu.be/IL_1DRZDzWc?si=-RutJc161ZO5wgO4',
+]
+
+
+def extract_video_id(link):
+    url = urlparse(link)
+    if url.hostname == "youtu.be":
+        return url.path.lstrip("/")
+    return parse_qs(url.query).get("v", [url.path.rstrip("/").split("/")[-1]])[0]
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def snapshot_key():
+    # summaries made with another model or prompt are not reused
+    return hash_text(f"{SNAPSHOT_VERSION}:{SUMMARY_MODEL}:{SUMMARY_PROMPT}")
+
+
+def load_snapshot(path=VIDEO_SUMMARIES_CACHE):
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError):
+        return {}
+
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("key") != snapshot_key():
+        return {}
+
+    return snapshot.get("videos", {})
+
+
+def save_snapshot(entries, path=VIDEO_SUMMARIES_CACHE):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    snapshot = {"version": SNAPSHOT_VERSION, "key": snapshot_key(), "videos": entries}
+
+    # write then rename so other workers never read a half written snapshot
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp") as tmp_file:
+        json.dump(snapshot, tmp_file, indent=2, sort_keys=True)
+    os.replace(tmp_file.name, path)
+
+
+def fetch_transcript(link):
+    documents = YoutubeTranscriptReader().load_data(ytlinks=[link])
+    return " ".join(document.text for document in documents)
+
+
+def summarize_transcript(transcript):
+    gemini = Gemini(model=SUMMARY_MODEL, api_key=os.environ.get('GOOGLE_API_KEY'))
+    prompt = SUMMARY_PROMPT.format(transcript=transcript)
+    return hedged_call("video_summary", lambda timeout: gemini_complete(gemini, prompt, timeout))
+
+
+def refresh_video(video_id, link, cached_entry, fetch=fetch_transcript, summarize=summarize_transcript):
+    transcript = fetch(link)
+    transcript_hash = hash_text(transcript)
+
+    if cached_entry and cached_entry.get("transcript_hash") == transcript_hash:
+        return cached_entry
+
+    return {
+        "link": link,
+        "transcript_hash": transcript_hash,
+        "summary": summarize(transcript),
+        "updated_at": datetime.utcnow().isoformat(),
+    }
+
+
+def load_video_summaries(
+    links=VIDEO_LINKS,
+    path=VIDEO_SUMMARIES_CACHE,
+    revalidate=VIDEO_SUMMARIES_REVALIDATE,
+    max_workers=VIDEO_SUMMARY_CONCURRENCY,
+    fetch=fetch_transcript,
+    summarize=summarize_transcript,
+):
+    """Returns {video_id: summary}, only fetching and summarizing videos missing from the snapshot.
+
+    With `revalidate` every transcript is downloaded again and only the ones whose
+    hash changed are sent back to Gemini.
+    """
+    cached = load_snapshot(path)
+
+    links_by_id = {}
+    for link in links:
+        links_by_id.setdefault(extract_video_id(link), link)
+
+    stale = {
+        video_id: link for video_id, link in links_by_id.items()
+        if revalidate or video_id not in cached
+    }
+
+    entries = {video_id: cached[video_id] for video_id in links_by_id if video_id in cached}
+
+    if stale:
+        print(f"REFRESHING {len(stale)} VIDEO SUMMARIES........")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                video_id: executor.submit(refresh_video, video_id, link, cached.get(video_id), fetch, summarize)
+                for video_id, link in stale.items()
+            }
+
+        for video_id, future in futures.items():
+            try:
+                entries[video_id] = future.result()
+            except Exception as e:
+                # keep serving the old summary (if any) when a video can't be refreshed
+                print(f"Could not refresh video {video_id}", e)
+
+        if any(entries.get(video_id) is not cached.get(video_id) for video_id in stale):
+            save_snapshot(entries, path)
+
+    return {video_id: entry["summary"] for video_id, entry in entries.items()}
+
+
+if __name__ == "__main__":
+    # python -m agent.video_summaries rebuilds the snapshot before a deploy
+    load_video_summaries(revalidate=True)
@@ -0,0 +1,54 @@
+import os
+import threading
+from concurrent.futures import Future
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "background" builds the agent tools on a thread once the app is created, "blocking" builds them
+# before create_app returns, "post_fork" leaves it to the gunicorn post_fork hook
+AGENT_WARMUP = os.environ.get("AGENT_WARMUP", "background")
+# How long a request waits for tools that are still being built before it fails
+AGENT_WARMUP_WAIT_SECONDS = float(os.environ.get("AGENT_WARMUP_WAIT_SECONDS", 120))
+
+
+class AgentWarmup:
+    """Builds the agent tools off the request path, requests wait for them with `tools()`."""
+
+    def __init__(self, build, startup):
+        self._build = build
+        self._startup = startup
+        self._future = None
+        self._pid = None
+        self._lock = threading.Lock()
+        startup.add_check("agent_tools", self.ready)
+
+    def start(self):
+        with self._lock:
+            future = self._future
+            # a build still running when the process forked never completes in the child, a failed build is retried
+            stale = future is not None and not future.done() and self._pid != os.getpid()
+            failed = future is not None and future.done() and future.exception()
+            if future is None or stale or failed:
+                self._pid = os.getpid()
+                self._future = Future()
+                threading.Thread(target=self._run, args=(self._future,), name="agent-warmup", daemon=True).start()
+            return self._future
+
+    def _run(self, future):
+        try:
+            with self._startup.phase("tools_setup"):
+                tools = self._build()
+        except Exception as e:
+            print("Agent warmup failed", e)
+            future.set_exception(e)
+            return
+        future.set_result(tools)
+        print("Agent warmup finished", self._startup.report()["phases"])
+
+    def ready(self):
+        future = self._future
+        return future is not None and future.done() and not future.exception()
+
+    def tools(self, timeout=AGENT_WARMUP_WAIT_SECONDS):
+        return self.start().result(timeout)
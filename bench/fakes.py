@@ -0,0 +1,294 @@
+import re
+import time
+import uuid
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from llama_index.llms import ChatMessage, MessageRole
+
+
+def comparable(value):
+    # Firestore hands every timestamp back in UTC, naive datetimes are written with utcnow()
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return value
+
+
+def collection_name(model_name):
+    # FireO names a model's collection after the model, in snake case
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", model_name).lower()
+
+
+def sleep_ms(ms):
+    if ms:
+        time.sleep(ms / 1000.0)
+
+
+class ScriptedResponse:
+    def __init__(self, response):
+        self.response = response
+
+
+class ScriptedStreamingResponse:
+    def __init__(self, tokens, token_interval):
+        self._tokens = tokens
+        self._token_interval = token_interval
+        self.response = ""
+        # one generator, like llama_index's: reading it again continues where the last read stopped
+        self.response_gen = self._generate()
+
+    def _generate(self):
+        for token in self._tokens:
+            time.sleep(self._token_interval)
+            self.response += token
+            yield token
+
+
+class ScriptedAgent:
+    """Stands in for an OpenAIAgent: waits `latency_ms`, then produces `reply` at `tokens_per_second`."""
+
+    def __init__(self, reply, latency_ms=0, tokens_per_second=0, chat_history=None):
+        self.reply = reply
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.chat_history = list(chat_history or [])
+
+    def _tokens(self):
+        words = self.reply.split(" ")
+        return [word if i == 0 else f" {word}" for i, word in enumerate(words)]
+
+    def _token_interval(self):
+        return 1.0 / self.tokens_per_second if self.tokens_per_second else 0
+
+    def chat(self, message):
+        sleep_ms(self.latency_ms)
+        time.sleep(len(self._tokens()) * self._token_interval())
+        self.chat_history.append(ChatMessage(role=MessageRole.USER, content=message))
+        self.chat_history.append(ChatMessage(role=MessageRole.ASSISTANT, content=self.reply))
+        return ScriptedResponse(self.reply)
+
+    def stream_chat(self, message):
+        sleep_ms(self.latency_ms)
+        self.chat_history.append(ChatMessage(role=MessageRole.USER, content=message))
+        # the whole reply is in memory once the stream is read, like OpenAIAgent's
+        self.chat_history.append(ChatMessage(role=MessageRole.ASSISTANT, content=self.reply))
+        return ScriptedStreamingResponse(self._tokens(), self._token_interval())
+
+    def reset(self):
+        self.chat_history = []
+
+
+class FakeBatch:
+    def __init__(self, latency_ms=0):
+        self._latency_ms = latency_ms
+        self._writes = []
+
+    def add(self, write):
+        self._writes.append(write)
+
+    def commit(self):
+        sleep_ms(self._latency_ms)
+        for write in self._writes:
+            write()
+        self._writes = []
+
+
+class FakeFireo:
+    """Replaces the `fireo` module where batches are created."""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+
+    def batch(self):
+        return FakeBatch(self.latency_ms)
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=None, order=None, limit=None, start_after=None, parent=None, group=False):
+        self._collection = collection
+        self._filters = filters or []
+        self._order = order
+        self._limit = limit
+        self._start_after = start_after
+        self._parent = parent
+        self._group = group
+
+    def _copy(self, **changes):
+        fields = dict(
+            filters=self._filters,
+            order=self._order,
+            limit=self._limit,
+            start_after=self._start_after,
+            parent=self._parent,
+            group=self._group,
+        )
+        fields.update(changes)
+        return FakeQuery(self._collection, **fields)
+
+    def copy(self, group_collection=False):
+        return self._copy(group=group_collection)
+
+    def parent(self, key):
+        return self._copy(parent=key)
+
+    def filter(self, *args):
+        return self._copy(filters=self._filters + ([args] if args else []))
+
+    def order(self, field):
+        return self._copy(order=field)
+
+    def limit(self, limit):
+        return self._copy(limit=limit)
+
+    def start_after(self, key):
+        # FireO only pages from a document key, a bare id fails its assertion the same way
+        assert key and "/" in key, "Key must be a valid key"
+        return self._copy(start_after=key)
+
+    def fetch(self, limit=None):
+        sleep_ms(self._collection.latency_ms)
+        if self._group:
+            messages = self._collection.all()
+        else:
+            messages = self._collection.all(self._parent)
+
+        for field, op, value in self._filters:
+            messages = [message for message in messages if self._match(getattr(message, field, None), op, value)]
+
+        if self._order:
+            field = self._order.lstrip("-")
+            messages.sort(key=lambda message: comparable(getattr(message, field)) or 0, reverse=self._order.startswith("-"))
+
+        if self._start_after:
+            keys = [message.key for message in messages]
+            messages = messages[keys.index(self._start_after) + 1:] if self._start_after in keys else []
+
+        limit = limit or self._limit
+        return iter(messages[:limit] if limit else messages)
+
+    def _match(self, actual, op, value):
+        actual, value = comparable(actual), comparable(value)
+        if op == "==":
+            return actual == value
+        if op == ">=":
+            return actual is not None and actual >= value
+        if op == "<=":
+            return actual is not None and actual <= value
+        if op == ">":
+            return actual is not None and actual > value
+        if op == "<":
+            return actual is not None and actual < value
+        raise ValueError(f"Unsupported filter {op}")
+
+
+class FakeCollection(FakeQuery):
+    """Documents of one model by key, including the ones in subcollections of the same name."""
+
+    def __init__(self, name, latency_ms=0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self._documents = {}
+        self._lock = threading.Lock()
+        super().__init__(self)
+
+    def all(self, parent=False):
+        """Every document, or only the ones under `parent` (None for the root collection)."""
+        with self._lock:
+            documents = list(self._documents.values())
+        if parent is False:
+            return documents
+        return [document for document in documents if document.parent == parent]
+
+    def put(self, message):
+        with self._lock:
+            self._documents[message.key] = message
+
+    def delete(self, key, batch=None):
+        key = key if "/" in key else f"{self.name}/{key}"
+
+        def write():
+            with self._lock:
+                self._documents.pop(key, None)
+
+        if batch:
+            batch.add(write)
+        else:
+            sleep_ms(self.latency_ms)
+            write()
+
+    def delete_every(self):
+        sleep_ms(self.latency_ms)
+        with self._lock:
+            self._documents.clear()
+
+
+MESSAGE_FIELDS = ["user", "type", "content", "created_at", "conversation_user"]
+SUMMARY_FIELDS = ["user", "summary", "updated_at"]
+
+
+def fake_message_model(name, latency_ms=0, fields=MESSAGE_FIELDS):
+    """An in-memory stand-in for the FireO models, ProdMessages/DevMessages by default.
+
+    Documents get FireO's keys, `collection_name/id`, or `parent/collection_name/id` when
+    created with a parent, and queries page from keys the way FireO's do.
+    """
+
+    class FakeMessages:
+        _meta = SimpleNamespace(collection_name=collection_name(name))
+        collection = FakeCollection(_meta.collection_name, latency_ms)
+
+        def __init__(self, parent=None):
+            self.id = None
+            self.parent = parent
+            for field in self.fields:
+                setattr(self, field, None)
+
+        @property
+        def key(self):
+            path = f"{self.parent}/{self._meta.collection_name}" if self.parent else self._meta.collection_name
+            return f"{path}/{self.id}"
+
+        def save(self, batch=None):
+            if not self.id:
+                self.id = uuid.uuid4().hex
+
+            if batch:
+                batch.add(lambda: self.collection.put(self))
+            else:
+                sleep_ms(self.collection.latency_ms)
+                self.collection.put(self)
+            return self
+
+        def to_dict(self):
+            return {"id": self.id, "key": self.key, **{field: getattr(self, field) for field in self.fields}}
+
+    FakeMessages.fields = fields
+    FakeMessages.__name__ = name
+    return FakeMessages
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self._bucket = bucket
+        self.name = name
+        self.chunk_size = None
+
+    def upload_from_file(self, stream, content_type=None, rewind=False, **kwargs):
+        size = 0
+        for chunk in iter(lambda: stream.read(self.chunk_size or 1024 * 1024), b""):
+            size += len(chunk)
+        sleep_ms(self._bucket.latency_ms)
+        self._bucket.uploads[self.name] = {"size": size, "content_type": content_type}
+
+
+class FakeBucket:
+    """Local bucket, only records the size and content type of what was uploaded."""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.uploads = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
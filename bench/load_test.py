@@ -0,0 +1,223 @@
+"""Offline load test for the Flask app.
+
+Boots `main.create_app()` with a scripted LLM, an in-memory Firestore and a local bucket in
+place of OpenAI/Gemini, FireO and GCS, drives the message routes at a given
+concurrency and writes latency percentiles and throughput per route as JSON.
+
+    python -m bench.load_test --concurrency 8 --requests 200 --llm-latency-ms 800 --output bench_results.json
+    python -m bench.load_test --compare bench_results.json
+"""
+
+import io
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import subprocess
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+SCENARIOS = ["sendMessage", "conversation", "sendFile", "getAgentResponse"]
+REPLY = (
+    "Hey! I'm Willow. I'm here for you. It sounds like today has been a lot to carry, "
+    "would you like to tell me more about what has been weighing on you?"
+)
+
+
+def boot_app(args):
+    """Creates the app with every external service replaced by a local fake."""
+    import fireo
+    import agent.agent_setup as agent_setup
+    from bench.fakes import ScriptedAgent, FakeFireo, FakeBucket, fake_message_model, SUMMARY_FIELDS
+
+    fireo.connection = lambda *a, **kw: None
+    agent_setup.tools_setup = lambda startup=None: []
+    agent_setup.create_agent = lambda tools, simple_prompt=False, chat_history=None, **kwargs: ScriptedAgent(
+        REPLY, args.llm_latency_ms, args.tokens_per_second, chat_history
+    )
+
+    import main
+    from controllers import message_controller, bucket
+    from models import message_store
+
+    message_controller.ProdMessages = fake_message_model("ProdMessages", args.firestore_latency_ms)
+    message_controller.DevMessages = fake_message_model("DevMessages", args.firestore_latency_ms)
+    message_controller.ProdUserMessages = fake_message_model("ProdUserMessages", args.firestore_latency_ms)
+    message_controller.DevUserMessages = fake_message_model("DevUserMessages", args.firestore_latency_ms)
+    message_controller.ProdSessionSummaries = fake_message_model("ProdSessionSummaries", args.firestore_latency_ms, SUMMARY_FIELDS)
+    message_controller.DevSessionSummaries = fake_message_model("DevSessionSummaries", args.firestore_latency_ms, SUMMARY_FIELDS)
+    message_store.fireo = FakeFireo(args.firestore_latency_ms)
+    bucket.set_bucket(FakeBucket(args.gcs_latency_ms))
+
+    app = main.create_app()
+    message_controller.agent_warmup.tools()
+    return app
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # nearest rank
+    index = max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1] if latencies else None,
+    }
+
+
+def make_request(client, scenario, i, args):
+    user = f"bench-user-{i % args.users}"
+
+    if scenario == "sendMessage":
+        body = {"type": "text", "content": f"I feel anxious today ({i})", "createdAt": datetime.now(timezone.utc).isoformat()}
+        return client.post(f"/api/sendMessage?env={args.env}&user={user}", json=body)
+    if scenario == "conversation":
+        return client.get(f"/api/conversation?env={args.env}&limit={args.page_size}")
+    if scenario == "sendFile":
+        data = {"file": (io.BytesIO(b"\0" * args.file_bytes), "drawing.jpg", "image/jpeg")}
+        return client.post(
+            f"/api/sendFile?contentId=bench-{i}&env={args.env}&user={user}",
+            data=data,
+            content_type="multipart/form-data",
+        )
+    if scenario == "getAgentResponse":
+        return client.post(f"/api/getAgentResponse?env={args.env}&user={user}", json={"content": "Can we try a breathing exercise?"})
+    raise ValueError(f"Unknown scenario {scenario}")
+
+
+def run_scenario(app, scenario, args):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(i):
+        nonlocal errors
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+
+        start = time.perf_counter()
+        try:
+            response = make_request(local.client, scenario, i, args)
+            ok = response.status_code < 400
+        except Exception:
+            ok = False
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+
+        with lock:
+            if ok:
+                latencies.append(elapsed_ms)
+            else:
+                errors += 1
+
+    for i in range(args.warmup):
+        one(i)
+    latencies.clear()
+    errors = 0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    return summarize(latencies, errors, elapsed)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline, baseline_path):
+    print(f"\ncompared to {baseline_path} ({baseline.get('revision')})")
+    for scenario, summary in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(scenario)
+        if not before:
+            continue
+        for metric in ["p50_ms", "p95_ms", "p99_ms", "throughput_rps"]:
+            if summary[metric] is None or not before.get(metric):
+                continue
+            change = (summary[metric] - before[metric]) / before[metric] * 100
+            print(f"  {scenario:<18} {metric:<15} {before[metric]:>10} -> {summary[metric]:>10} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="requests per scenario before timing starts")
+    parser.add_argument("--users", type=int, default=20, help="distinct users the requests are spread over")
+    parser.add_argument("--env", default="dev")
+    parser.add_argument("--page-size", type=int, default=10)
+    parser.add_argument("--file-bytes", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--llm-latency-ms", type=float, default=500, help="time before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--firestore-latency-ms", type=float, default=20)
+    parser.add_argument("--gcs-latency-ms", type=float, default=50)
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument(
+        "--max-error-rate", type=float, default=0.5,
+        help="exit with an error when more than this share of a scenario's requests failed",
+    )
+    args = parser.parse_args()
+
+    # read before running, --output may point at the same file
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    app = boot_app(args)
+
+    results = {
+        "revision": git_revision(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "scenarios": {},
+    }
+
+    for scenario in args.scenarios:
+        summary = run_scenario(app, scenario, args)
+        results["scenarios"][scenario] = summary
+        print(f"{scenario:<18} p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms "
+              f"rps={summary['throughput_rps']} errors={summary['errors']}")
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"results written to {args.output}")
+
+    if baseline:
+        compare(results, baseline, args.compare)
+
+    # latencies of a scenario that mostly failed only time its errors, don't let them pass for a result
+    failing = [
+        scenario for scenario, summary in results["scenarios"].items()
+        if summary["requests"] and summary["errors"] / summary["requests"] > args.max_error_rate
+    ]
+    if failing:
+        print(f"error rate above {args.max_error_rate:.0%} in {', '.join(failing)}, the results are not usable", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
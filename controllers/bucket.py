@@ -0,0 +1,38 @@
+import os
+import threading
+from google.cloud import storage
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BUCKET_NAME = "willow-conversation-assets"
+# resumable uploads send the request body to GCS in chunks of this size (must be a multiple of 256KB)
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+
+_lock = threading.Lock()
+_bucket = None
+
+
+def get_bucket():
+    """Returns the conversation assets bucket, the storage client is created once per process and reused."""
+    global _bucket
+    if _bucket is None:
+        with _lock:
+            if _bucket is None:
+                # bucket() doesn't make an API call, unlike get_bucket()
+                _bucket = storage.Client().bucket(BUCKET_NAME)
+    return _bucket
+
+
+def set_bucket(bucket):
+    """Swaps the bucket, e.g. for a local fake exposing blob(name).upload_from_file(...)."""
+    global _bucket
+    with _lock:
+        _bucket = bucket
+
+
+def upload_stream(blob_name, stream, content_type=None):
+    blob = get_bucket().blob(blob_name)
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+    blob.upload_from_file(stream, content_type=content_type, rewind=False)
+    return blob
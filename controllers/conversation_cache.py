@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime, timezone
+from dateutil import parser
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Number of most recent messages kept per env/user
+CONVERSATION_CACHE_WINDOW = int(os.environ.get("CONVERSATION_CACHE_WINDOW", 100))
+# Other instances write to Firestore without updating this process, so in-process windows are kept briefly
+CONVERSATION_CACHE_TTL_SECONDS = float(os.environ.get("CONVERSATION_CACHE_TTL_SECONDS", 5))
+# With a shared redis every instance appends to the same windows, so they can live much longer
+CONVERSATION_CACHE_REDIS_URL = os.environ.get("CONVERSATION_CACHE_REDIS_URL")
+CONVERSATION_CACHE_REDIS_TTL_SECONDS = int(os.environ.get("CONVERSATION_CACHE_REDIS_TTL_SECONDS", 5 * 60))
+
+
+def message_sort_key(message):
+    created_at = message.get("created_at")
+    if isinstance(created_at, str):
+        created_at = parser.isoparse(created_at)
+    if not isinstance(created_at, datetime):
+        return 0.0
+    if created_at.tzinfo is None:
+        # agent replies are stamped with utcnow() before they round trip through Firestore
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at.timestamp()
+
+
+class InProcessBackend:
+    def __init__(self, ttl_seconds=CONVERSATION_CACHE_TTL_SECONDS):
+        self._ttl_seconds = ttl_seconds
+        self._windows = {}
+        self._writes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            window = self._windows.get(key)
+            if window and time.monotonic() - window["loaded_at"] > self._ttl_seconds:
+                del self._windows[key]
+                return None
+            # copied so a concurrent append can't change it while it is being serialized
+            return dict(window, messages=list(window["messages"])) if window else None
+
+    def set(self, key, window):
+        with self._lock:
+            window["loaded_at"] = time.monotonic()
+            self._windows[key] = window
+
+    def update(self, key, fn):
+        with self._lock:
+            self._writes[key] = self._writes.get(key, 0) + 1
+            window = self._windows.get(key)
+            if window:
+                fn(window)
+
+    def writes(self, key):
+        with self._lock:
+            return self._writes.get(key, 0)
+
+    def delete(self, key):
+        with self._lock:
+            self._windows.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._windows if key.startswith(prefix)]:
+                del self._windows[key]
+
+
+class RedisBackend:
+    def __init__(self, url, ttl_seconds=CONVERSATION_CACHE_REDIS_TTL_SECONDS):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+        self._ttl_seconds = ttl_seconds
+
+    def get(self, key):
+        data = self._redis.get(key)
+        return self._decode(data) if data else None
+
+    def set(self, key, window):
+        self._redis.set(key, self._encode(window), ex=self._ttl_seconds)
+
+    def update(self, key, fn):
+        self._redis.incr(f"{key}:writes")
+        with self._redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    data = pipe.get(key)
+                    if not data:
+                        return
+                    window = self._decode(data)
+                    fn(window)
+                    pipe.multi()
+                    pipe.set(key, self._encode(window), ex=self._ttl_seconds)
+                    pipe.execute()
+                    return
+                except self._watch_error:
+                    continue
+
+    def writes(self, key):
+        return int(self._redis.get(f"{key}:writes") or 0)
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+    def delete_prefix(self, prefix):
+        keys = list(self._redis.scan_iter(match=f"{prefix}*"))
+        if keys:
+            self._redis.delete(*keys)
+
+    def _encode(self, window):
+        return json.dumps(window, default=lambda value: value.isoformat())
+
+    def _decode(self, data):
+        window = json.loads(data)
+        for message in window["messages"]:
+            if isinstance(message.get("created_at"), str):
+                message["created_at"] = parser.isoparse(message["created_at"])
+        return window
+
+
+class ConversationCache:
+    """Most recent message window per env (and per env/user), newest message first.
+
+    Windows are filled on a first page read, appended to whenever a message is saved
+    and dropped when a conversation is deleted.
+    """
+
+    def __init__(self, backend=None, window_size=CONVERSATION_CACHE_WINDOW):
+        self._backend = backend or InProcessBackend()
+        self.window_size = window_size
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, env, user=None):
+        return f"conversation:{env}:{user or ''}"
+
+    def get(self, env, user, limit):
+        """Returns the first `limit` messages, or None if Firestore has to be read."""
+        messages = self.peek(env, user, limit)
+        if messages is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return messages
+
+    def peek(self, env, user, limit):
+        if not 0 < limit <= self.window_size:
+            return None
+
+        window = self._backend.get(self.key(env, user))
+        if not window or (len(window["messages"]) < limit and not window["complete"]):
+            return None
+
+        return window["messages"][:limit]
+
+    def writes(self, env, user):
+        """Counts appends, taken before a Firestore read so fill() can tell if it raced with a write."""
+        return self._backend.writes(self.key(env, user))
+
+    def fill(self, env, user, messages, requested, writes=None):
+        """Stores the newest `requested` messages read from Firestore, newest first."""
+        key = self.key(env, user)
+        # a message saved while Firestore was being read could be missing from what was read
+        if writes is not None and self._backend.writes(key) != writes:
+            return
+
+        self._backend.set(key, {
+            "messages": list(messages)[:self.window_size],
+            # fewer messages than asked for means this is the whole conversation
+            "complete": len(messages) < requested,
+        })
+
+    def append(self, env, user, message):
+        def add(window):
+            messages = window["messages"]
+            messages.append(message)
+            messages.sort(key=message_sort_key, reverse=True)
+            if len(messages) > self.window_size:
+                del messages[self.window_size:]
+                window["complete"] = False
+
+        # the env wide window (no user) is what the un-scoped conversation read serves
+        self._backend.update(self.key(env), add)
+        if user:
+            self._backend.update(self.key(env, user), add)
+
+    def invalidate(self, env, user=None):
+        if user:
+            self._backend.delete(self.key(env, user))
+            self._backend.delete(self.key(env))
+        else:
+            self._backend.delete_prefix(f"conversation:{env}:")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def messages_etag(messages):
+    payload = json.dumps(messages, default=str, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def conversation_cache_backend():
+    if CONVERSATION_CACHE_REDIS_URL:
+        return RedisBackend(CONVERSATION_CACHE_REDIS_URL)
+    return InProcessBackend()
+
+
+conversation_cache = ConversationCache(conversation_cache_backend())
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# How long a finished request's result is replayed to retries
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 10 * 60))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", 1000))
+
+EXECUTED = "executed"
+COALESCED = "coalesced"
+REPLAYED = "replayed"
+
+
+def request_idempotency_key(route, env, user, body, header_key=None):
+    """Key for a request, from its Idempotency-Key header or else the message's createdAt and content.
+
+    Returns None when neither is there, a body without createdAt can't be told apart from
+    the user sending the same text again.
+    """
+    if header_key:
+        parts = [route, env, user, "header", header_key]
+    elif body and body.get("createdAt"):
+        content = json.dumps(body.get("content"), sort_keys=True, default=str)
+        parts = [route, env, user, body.get("createdAt"), hashlib.sha256(content.encode("utf-8")).hexdigest()]
+    else:
+        return None
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class IdempotentRequests:
+    """Runs each keyed request once per process.
+
+    A duplicate that arrives while the first is still running waits for and shares its
+    result, one that arrives after it finished gets the result replayed for `ttl_seconds`.
+    Results are controller `(body, status)` tuples, server errors aren't kept so a retry
+    after one runs again. `scope`, the (env, user) a request belongs to, lets `clear` forget
+    the results of one conversation only.
+    """
+
+    def __init__(self, ttl_seconds=IDEMPOTENCY_TTL_SECONDS, max_entries=IDEMPOTENCY_MAX_ENTRIES):
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        # key -> (future, finished_at, scope), finished_at is None while the request runs
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.outcomes = {EXECUTED: 0, COALESCED: 0, REPLAYED: 0}
+
+    def run(self, key, fn, scope=None):
+        """Returns (fn's result, outcome), outcome is one of executed, coalesced or replayed."""
+        if key is None:
+            return fn(), EXECUTED
+
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is None:
+                future = Future()
+                self._entries[key] = (future, None, scope)
+                outcome = EXECUTED
+            else:
+                future = entry[0]
+                outcome = REPLAYED if future.done() else COALESCED
+            self.outcomes[outcome] += 1
+
+        if outcome != EXECUTED:
+            return future.result(), outcome
+
+        # the entry is finished or evicted whatever happens, a key is never left running
+        keep = False
+        try:
+            result = fn()
+            if not (isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], int)):
+                raise TypeError(f"Expected a (body, status) result, got {result!r}")
+            keep = result[1] < 500
+            future.set_result(result)
+            return result, EXECUTED
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            self._finish(key, future, keep)
+
+    def _finish(self, key, future, keep):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not future:
+                return
+            if not keep:
+                del self._entries[key]
+                return
+            self._entries[key] = (future, time.monotonic(), entry[2])
+            self._entries.move_to_end(key)
+            self._enforce_limit()
+
+    def _expire(self):
+        cutoff = time.monotonic() - self._ttl_seconds
+        # finished entries are moved to the end in the order they finish, running ones are skipped
+        for key, (future, finished_at, scope) in list(self._entries.items()):
+            if finished_at is None:
+                continue
+            if finished_at >= cutoff:
+                break
+            del self._entries[key]
+
+    def _enforce_limit(self):
+        for key, (future, finished_at, scope) in list(self._entries.items()):
+            if len(self._entries) <= self._max_entries:
+                break
+            if finished_at is not None:
+                del self._entries[key]
+
+    def clear(self, env, user=None):
+        """Forgets the finished results of `env`, or of one of its users, running requests still share theirs."""
+        with self._lock:
+            for key, (future, finished_at, scope) in list(self._entries.items()):
+                if finished_at is None or scope is None:
+                    continue
+                if scope[0] == env and (user is None or scope[1] == user):
+                    del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for future, finished_at, scope in self._entries.values() if finished_at is None)
+            return {
+                "running": running,
+                "replayable": len(self._entries) - running,
+                **self.outcomes,
+            }
+
+
+idempotent_requests = IdempotentRequests()
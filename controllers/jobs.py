@@ -0,0 +1,109 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+MAX_JOBS = int(os.environ.get("MAX_JOBS", 1000))
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 60 * 60))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job:
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.progress = None
+        self.created_at = datetime.utcnow()
+        self.updated_at = self.created_at
+        self.finished = threading.Event()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "progress": self.progress,
+            "createdAt": self.created_at,
+            "updatedAt": self.updated_at,
+        }
+
+
+class JobQueue:
+    """Runs work off the request thread and keeps the outcome around for clients to poll.
+
+    Jobs live in this process only, finished jobs are dropped after `ttl_seconds`
+    or once more than `max_jobs` are tracked.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, max_jobs=MAX_JOBS, ttl_seconds=JOB_TTL_SECONDS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._max_jobs = max_jobs
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        job = Job()
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def submit_with_progress(self, fn, *args, **kwargs):
+        """Like submit, but fn is called with a `report(progress)` callback as its first argument."""
+        job = Job()
+
+        def report(progress):
+            job.progress = progress
+            job.updated_at = datetime.utcnow()
+
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, (report, *args), kwargs)
+        return job.id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        job = self.get(job_id)
+        if job:
+            job.finished.wait(timeout)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = RUNNING
+        job.updated_at = datetime.utcnow()
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = DONE
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+        job.updated_at = datetime.utcnow()
+        job.finished_at = time.monotonic()
+        job.finished.set()
+
+    def _prune(self):
+        cutoff = time.monotonic() - self._ttl_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and (job.finished_at < cutoff or len(self._jobs) >= self._max_jobs):
+                del self._jobs[job_id]
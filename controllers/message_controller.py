@@ -1,10 +1,22 @@
 from datetime import datetime
 from dateutil import parser
-from google.cloud import storage
-from agent.agent_setup import agent_setup
-from models.message_model import DevMessages, ProdMessages
-import tempfile
+from agent.agent_setup import tools_setup, create_agent
+from agent.session_manager import AgentSessionManager, AGENT_SESSION_HISTORY_LIMIT, to_chat_history
+from agent.chat_memory import summary_message
+from agent.warmup import AgentWarmup
+from agent.deadlines import REQUEST_DEADLINE_SECONDS, DeadlineExceeded, request_deadline, latencies
+from agent.query_cache import query_cache_stats
+from models.message_model import DevMessages, ProdMessages, DevUserMessages, ProdUserMessages, DevSessionSummaries, ProdSessionSummaries
+from models.conversation_storage import AI_COACH_USER, ConversationStorage
+from controllers.bucket import upload_stream
+from controllers.jobs import JobQueue, DONE
+from models.message_store import FIRESTORE_BATCH_LIMIT, message_writer, delete_messages
+from controllers.conversation_cache import conversation_cache, messages_etag
+from controllers.idempotency import idempotent_requests
+from monitoring.tracing import span
+from monitoring.startup import startup_report
 import uuid
+import json
 from dotenv import load_dotenv
 import os
 
@@ -13,39 +25,112 @@ load_dotenv()
 SUPPORTED_MESSAGE_TYPES = ["audio", "image", "text"]
 SUPPORTED_ENVIRONMENTS = ["dev", "prod"]
 BASE_STORAGE_BUCKET_URL = "https://storage.cloud.google.com/willow-conversation-assets/"
-BUCKET_NAME = "willow-conversation-assets"
 DATETIME_FORMAT = "'%Y-%m-%dT%H:%M:%S.%f%z'"
+JOB_EVENTS_HEARTBEAT_SECONDS = 15
+# Messages read per Firestore query while exporting, memory use stays at one chunk
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 500))
 
-global agent
-agent = agent_setup(os.environ.get("SIMPLE_PROMPT"))
+def load_session_summary(env, user):
+    summary_model = get_summary_model(env)
+    return next(iter(summary_model.collection.filter('user', '==', user).fetch(1)), None)
 
-def get_conversation(env, page=1, limit=10, last_document=None):
+def save_session_summary(env, user, summary):
+    saved = load_session_summary(env, user)
+    if saved is None:
+        saved = get_summary_model(env)()
+        saved.user = user
+    saved.summary = summary
+    saved.updated_at = datetime.utcnow()
+    with span("firestore_save"):
+        saved.save()
+    return saved
+
+def load_chat_history(env, user):
+    query = get_storage(env).query(user)
+
+    # a returning user starts from their saved summary plus what was said after it
+    saved = load_session_summary(env, user)
+    if saved:
+        query = query.filter('created_at', '>', saved.updated_at)
+
+    messages = (
+        query
+        .order('-created_at')
+        .limit(AGENT_SESSION_HISTORY_LIMIT)
+        .fetch()
+    )
+
+    # only text turns are replayed, file messages just hold a content id
+    history = to_chat_history(
+        [(msg.user, msg.content) for msg in reversed(list(messages)) if msg.type == "text"],
+        AI_COACH_USER,
+    )
+    return ([summary_message(saved.summary)] if saved else []) + history
+
+# tools are built off the request path, see create_app in main.py
+agent_warmup = AgentWarmup(lambda: tools_setup(startup_report), startup_report)
+simple_prompt = os.environ.get("SIMPLE_PROMPT")
+agent_sessions = AgentSessionManager(
+    lambda env, user, chat_history: create_agent(
+        agent_warmup.tools(), simple_prompt, chat_history, save_summary=lambda summary: save_session_summary(env, user, summary)
+    ),
+    load_history=load_chat_history,
+)
+background_jobs = JobQueue()
+
+def get_conversation(env, page=1, limit=10, last_document=None, user=None):
     if env not in SUPPORTED_ENVIRONMENTS:
         return {"error": "Invalid environment"}, 400
 
     try:
-        message_model = get_message_model(env)
+        # scoped to one user, only that user's messages are read
+        storage = get_storage(env)
+        query = storage.query(user)
 
         if page == 1:
-            messages = (
-                message_model.collection
-                .order('-created_at')   # sorted in descending order to get the most recent messages first
-                .limit(limit)
-                .fetch()
-            )
+            messages_data = conversation_cache.get(env, user, limit)
+            window_size = conversation_cache.window_size
+
+            if messages_data is None and 0 < limit <= window_size:
+                # read the whole window once, later polls are answered from it
+                writes = conversation_cache.writes(env, user)
+                with span("firestore_query"):
+                    messages = (
+                        query
+                        .order('-created_at')   # sorted in descending order to get the most recent messages first
+                        .limit(window_size)
+                        .fetch()
+                    )
+                    window = [message_to_dict(msg) for msg in messages]
+                conversation_cache.fill(env, user, window, window_size, writes)
+                messages_data = window[:limit]
+            elif messages_data is None:
+                with span("firestore_query"):
+                    messages = (
+                        query
+                        .order('-created_at')   # sorted in descending order to get the most recent messages first
+                        .limit(limit)
+                        .fetch()
+                    )
+                    messages_data = [message_to_dict(msg) for msg in messages]
         else:
             if not last_document:
                 return {"error": "last_document is required for paginated queries after the first page"}, 400
+            try:
+                last_document = storage.cursor_key(last_document, user)
+            except ValueError as e:
+                return {"error": str(e)}, 400
 
-            messages = (
-                message_model.collection
-                .order('-created_at')   # sorted in descending order to get the most recent messages first
-                .limit(limit)
-                .start_after(last_document)
-                .fetch()
-            )
+            with span("firestore_query"):
+                messages = (
+                    query
+                    .order('-created_at')   # sorted in descending order to get the most recent messages first
+                    .limit(limit)
+                    .start_after(last_document)
+                    .fetch()
+                )
 
-        messages_data = [{"id": msg.id, **msg.to_dict()} for msg in messages]
+                messages_data = [message_to_dict(msg) for msg in messages]
 
         return {
             "status": "Successfully retrieved conversation",
@@ -58,24 +143,102 @@ def get_conversation(env, page=1, limit=10, last_document=None):
     except Exception as e:
         return {"error": str(e)}, 500
 
-def delete_conversation(env):
+def export_conversation(env, user=None, start=None, end=None, cursor=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+        Returns a generator of NDJSON lines, one message per line oldest first, read `chunk_size` at a time:
+        - start / end: ISO datetimes, only messages created in [start, end) are exported
+        - cursor: the key of the last message a previous export got to, it continues after it
+        The last line is {"done": true, "exported": n, "cursor": ...}, or {"error": ..., "cursor": ...}
+        if the export failed, so an interrupted export can be resumed from its cursor.
+    """
+    if env not in SUPPORTED_ENVIRONMENTS:
+        return {"error": "Invalid environment"}, 400
+
+    try:
+        start_at = parser.isoparse(start) if start else None
+        end_at = parser.isoparse(end) if end else None
+    except ValueError as e:
+        return {"error": f"Invalid date range: {e}"}, 400
+
+    if not 0 < chunk_size <= FIRESTORE_BATCH_LIMIT:
+        return {"error": f"chunkSize must be between 1 and {FIRESTORE_BATCH_LIMIT}"}, 400
+
+    storage = get_storage(env)
+    try:
+        cursor = storage.cursor_key(cursor, user) if cursor else None
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    query = storage.query(user)
+    if start_at:
+        query = query.filter('created_at', '>=', start_at)
+    if end_at:
+        query = query.filter('created_at', '<', end_at)
+    query = query.order('created_at')
+
+    def lines():
+        last_key = cursor
+        exported = 0
+        try:
+            while True:
+                page = query.start_after(last_key) if last_key else query
+                with span("firestore_query"):
+                    messages = page.fetch(chunk_size)
+
+                count = 0
+                # documents are streamed off the query iterator, never collected into a list
+                for message in messages:
+                    yield json.dumps(message_to_dict(message), default=json_default) + "\n"
+                    last_key = message.key
+                    count += 1
+
+                exported += count
+                if count < chunk_size:
+                    break
+
+            yield json.dumps({"done": True, "exported": exported, "cursor": last_key}) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e), "exported": exported, "cursor": last_key}) + "\n"
+
+    return lines(), 200
+
+def delete_conversation(env, run_async=False, user=None):
     if env not in ['dev', 'prod']:
         return {"error": "Invalid environment"}, 400
 
     try:
-        # delete all messages in db
-        message_model = get_message_model(env)
-        message_model.collection.delete_every()
+        # queued messages would otherwise be written after the delete
+        message_writer.flush()
+
+        # reset the agent sessions and cached conversation windows of the env, or of just this user
+        agent_sessions.reset(env, user)
+        conversation_cache.invalidate(env, user)
+        # a replayed send would hand back a message that no longer exists
+        idempotent_requests.clear(env, user)
 
-        # reset agent
-        agent.reset();
+        # delete the messages and saved session summaries in db, in parallel batches
+        storage = get_storage(env)
+        summary_model = get_summary_model(env)
+        summaries = summary_model.collection.filter('user', '==', user) if user else None
 
-        return {"status": "Deleted and reset successfully"}, 200
+        def delete_all(report=None):
+            deleted = storage.delete(user, report=report)
+            delete_messages(summary_model, summaries)
+            return deleted
+
+        if run_async:
+            job_id = background_jobs.submit_with_progress(lambda report: {"deleted": delete_all(report)})
+            return {"status": "Delete queued", "jobId": job_id}, 202
+
+        with span("firestore_delete"):
+            deleted = delete_all()
+
+        return {"status": "Deleted and reset successfully", "deleted": deleted}, 200
 
     except Exception as e:
         return {"error": str(e)}, 500
 
-def send_message(env, user, body):
+def send_message(env, user, body, stream=False, deadline=REQUEST_DEADLINE_SECONDS):
     if not env or not user or not body:
         return { "status": "missing either env, user, or body data"}, 400
 
@@ -83,10 +246,9 @@ def send_message(env, user, body):
     content_type = body.get("type")
     content = body.get("content")
     created_at_string = body.get("createdAt")
-    print(content_type, content, created_at_string)
     # initialize dict of values we will write to firestore
-    message_model = get_message_model(env)
-    new_message = message_model()
+    storage = get_storage(env)
+    new_message = storage.new_message(user)
     new_message.user = user
     new_message.type = content_type
     new_message.created_at = parser.parse(created_at_string)
@@ -99,64 +261,214 @@ def send_message(env, user, body):
 
     if content_type == "text":
         new_message.content = content
-        new_message.save()
-        agent_response, status_code = get_agent_response(env, body)
+        # make sure the session is rehydrated before this message lands in its history
+        with span("agent_session"):
+            agent_sessions.get_agent(env, user)
+        with span("firestore_save"):
+            storage.save(new_message)
+        conversation_cache.append(env, user, message_to_dict(new_message))
+
+        if stream:
+            return stream_agent_response(env, body, user, user_message=new_message.to_dict(), deadline=deadline)
+
+        agent_response, status_code = get_agent_response(env, body, user, deadline)
 
         if status_code != 200:
-            return { "status": "something went wrong getting agent response", "userMessage": new_message.to_dict()}
+            # the user message is saved, a timed out agent is a 504 and any other failure a 502
+            return { "status": "something went wrong getting agent response", "userMessage": new_message.to_dict()}, 504 if status_code == 504 else 502
         
         return { "userMessage": new_message.to_dict(), "agentResponse": agent_response["message"]}, 200 
     elif content_type == "image" or content_type == "audio":
         new_message.content = f'{uuid.uuid4()}'
-        new_message.save()
+        with span("firestore_save"):
+            storage.save(new_message)
+        conversation_cache.append(env, user, message_to_dict(new_message))
 
         return { "userMessage": new_message.to_dict()}, 200
     else:
         return { "status": "incorrect file type", content_type: content_type }, 400
 
 
-def send_file(content_id, env, request_files):
+def send_file(content_id, env, request_files, user=None, run_async=False):
     if 'file' not in request_files or not request_files['file']:
         return { "status": "missing file" }, 400
+    # the analysis is a turn in this user's session
+    if not env or not user:
+        return { "status": "missing either env, or user"}, 400
 
     content_file = request_files['file']
 
-    with tempfile.NamedTemporaryFile() as temp_file:
-        content_file.save(temp_file.name)
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(BUCKET_NAME)
-        blob = bucket.blob(content_id)
-        blob.upload_from_filename(temp_file.name)
-    
+    # stream the upload straight to GCS, no temp file copy
+    with span("gcs_upload"):
+        upload_stream(content_id, content_file.stream, content_file.mimetype)
+
+    if run_async:
+        job_id = background_jobs.submit(analyze_file, env, content_id, user)
+        return { "status": "Analysis queued", "jobId": job_id, "contentId": content_id }, 202
+
+    try:
+        return analyze_file(env, content_id, user), 200
+    except Exception:
+        return { "status": "something went wrong getting agent response to image", "contentId": content_id}, 500
+
+def analyze_file(env, content_id, user=None):
     image_prompt = { "content": f'Analyze the image I sent at this URL: {BASE_STORAGE_BUCKET_URL}{content_id}. Given the context of what we talked about, what does it tell you about my emotional state?' }
-    agent_response, status_code = get_agent_response(env, image_prompt)
+    agent_response, status_code = get_agent_response(env, image_prompt, user)
 
     if status_code != 200:
-        return { "status": "something went wrong getting agent response to image", "contentId": content_id}
-    
-    return { "agentResponse": agent_response["message"]}, 200
+        raise Exception(agent_response.get("error") or agent_response.get("status"))
+
+    return { "agentResponse": agent_response["message"]}
+
+def get_job(job_id):
+    job = background_jobs.get(job_id)
+    if not job:
+        return {"error": "Job not found"}, 404
+
+    return {"status": "Successfully retrieved job", "job": job.to_dict()}, 200
 
-def get_agent_response(env,body):
-    if not env or not body:
-      return { "status": "missing either env, or message data"}, 400
+def stream_job(job_id):
+    job = background_jobs.get(job_id)
+    if not job:
+        return {"error": "Job not found"}, 404
+
+    def events():
+        while not job.finished.wait(JOB_EVENTS_HEARTBEAT_SECONDS):
+            yield sse_event("status", job.to_dict())
+        yield sse_event("done" if job.status == DONE else "error", job.to_dict())
+
+    return events(), 200
+
+def get_agent_response(env, body, user=None, deadline=REQUEST_DEADLINE_SECONDS):
+    # every user has their own session, a request without one can't be given anybody's
+    if not env or not user or not body:
+      return { "status": "missing either env, user, or message data"}, 400
     try:
-        agent_response = agent.chat(body.get("content"))
+        # every LLM call of the turn, including the ones its tools make, shares the request's budget
+        with request_deadline(deadline):
+            with span("agent_session"):
+                agent = agent_sessions.get_agent(env, user)
+            # tool, LLM and embedding calls inside the chat are timed by the llama_index callback handler
+            with agent_sessions.session_lock(env, user), span("agent_chat"):
+                agent_response = agent.chat(body.get("content"))
 
-        message_model = get_message_model(env)
-        new_message = message_model()
-        new_message.user = "ai_coach"
-        new_message.type = "text"
-        new_message.created_at = datetime.utcnow()
-        new_message.content = agent_response.response
-        new_message.save()
+        new_message = save_agent_message(env, user, agent_response.response)
 
         return {
             "status": "Successfully retrieved agent reply",
             "message": new_message.to_dict()
         }, 200
+    except DeadlineExceeded as e:
+        return {"error": str(e)}, 504
     except Exception as e:
         return {"error": str(e)}, 500
 
+def stream_agent_response(env, body, user=None, user_message=None, deadline=REQUEST_DEADLINE_SECONDS):
+    """
+        Same as get_agent_response but returns a generator of server-sent events:
+        - userMessage: the saved user message, when streaming from sendMessage
+        - token: {"delta": ...} for every chunk of the reply as the LLM produces it
+        - done: the saved ai_coach message, once the whole reply has been written to firestore
+        - error: {"error": ...} if the agent fails mid stream
+    """
+    if not env or not user or not body:
+      return { "status": "missing either env, user, or message data"}, 400
+
+    def events():
+        if user_message:
+            yield sse_event("userMessage", user_message)
+
+        # held until the whole reply is in the agent's memory, the next turn for this user waits for it
+        with request_deadline(deadline), agent_sessions.session_lock(env, user):
+            streaming_response = None
+            tokens = []
+            persisted = False
+            try:
+                agent = agent_sessions.get_agent(env, user)
+                streaming_response = agent.stream_chat(body.get("content"))
+
+                for delta in streaming_response.response_gen:
+                    tokens.append(delta)
+                    yield sse_event("token", {"delta": delta})
+
+                new_message = save_agent_message(env, user, "".join(tokens).strip())
+                persisted = True
+
+                yield sse_event("done", {
+                    "status": "Successfully retrieved agent reply",
+                    "message": new_message.to_dict()
+                })
+            except GeneratorExit:
+                # the client went away, finish the reply so it still lands in the conversation
+                if streaming_response is not None and not persisted:
+                    tokens.extend(streaming_response.response_gen)
+                    save_agent_message(env, user, "".join(tokens).strip())
+                raise
+            except Exception as e:
+                yield sse_event("error", {"error": str(e)})
+
+    return events(), 200
+
+def json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def save_agent_message(env, user, content):
+    storage = get_storage(env)
+    new_message = storage.new_message(user)
+    new_message.user = AI_COACH_USER
+    new_message.type = "text"
+    new_message.created_at = datetime.utcnow()
+    new_message.content = content
+    with span("firestore_save"):
+        storage.save(new_message)
+    conversation_cache.append(env, user, message_to_dict(new_message))
+    return new_message
+
+def message_to_dict(message):
+    return {"id": message.id, **message.to_dict()}
+
+def conversation_etag(env, page=1, limit=10, user=None):
+    """ETag of a first page read that can be answered from the cache, without touching Firestore."""
+    if page != 1:
+        return None
+    messages = conversation_cache.peek(env, user, limit)
+    return messages_etag(messages) if messages is not None else None
+
+def get_readiness():
+    report = startup_report.report()
+    if not startup_report.ready():
+        return {"status": "Starting", **report}, 503
+    return {"status": "Ready", **report}, 200
+
+def get_stats():
+    return {
+        "status": "Successfully retrieved stats",
+        "startup": startup_report.report(),
+        "agentSessions": agent_sessions.stats(),
+        "queryCaches": query_cache_stats(),
+        "conversationCache": conversation_cache.stats(),
+        "idempotency": idempotent_requests.stats(),
+        "llmHedgeAfterSeconds": latencies.stats(),
+    }, 200
+
+def get_summary_model(env):
+    if env == 'prod':
+        return ProdSessionSummaries
+    elif env == 'dev':
+        return DevSessionSummaries
+
+def get_storage(env):
+    return ConversationStorage(env, get_message_model(env), get_user_message_model(env))
+
+def get_user_message_model(env):
+    if env == 'prod':
+        return ProdUserMessages
+    elif env == 'dev':
+        return DevUserMessages
+
 def get_message_model(env):
     if env == 'prod':
         return ProdMessages
@@ -0,0 +1,66 @@
+# gunicorn -c gunicorn.conf.py "main:create_app()"
+#
+# The app is created once in the master and the port is bound right away, each worker
+# builds the agent tools in the background after fork and reports it on /readyz. With
+# PRELOAD_SHARED_STATE=true the master builds indexes, video embeddings and tools before
+# forking instead, so workers share them copy-on-write, at the cost of a slower boot.
+# The worker serves requests on a thread pool, AgentSessionManager serializes turns per
+# user so different users run in parallel. Workers keep their metrics in PROMETHEUS_MULTIPROC_DIR,
+# so /metrics answers with the sum over every worker whichever one serves the scrape.
+import gc
+import os
+import shutil
+import tempfile
+
+if os.environ.get("PRELOAD_SHARED_STATE") == "true":
+    os.environ.setdefault("AGENT_WARMUP", "blocking")
+else:
+    os.environ.setdefault("AGENT_WARMUP", "post_fork")
+
+# set before the app is preloaded, prometheus_client picks its multiprocess mode when it is first imported.
+# Emptied here rather than in on_starting, which runs after the preload, so files of an earlier server on
+# this machine aren't added to this one's counts
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), f"willow-metrics-{os.environ.get('PORT', '8080')}")
+)
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir)
+
+bind = f":{os.environ.get('PORT', '8080')}"
+preload_app = True
+# One worker by default. Agent sessions, the per-user turn lock, background jobs and idempotency keys
+# live in the worker's memory, so with several workers a user's turns can be answered from another
+# worker's stale chat history, two of their turns can run at once, and /api/jobs/<id> polls that reach
+# another worker answer 404. Concurrency comes from the threads below; only raise this behind a load
+# balancer that sends each user to the same worker.
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+# gthread by default, "gevent" also works as long as gevent is installed
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+# agent turns with several tool calls routinely take longer than the 30s default
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+
+
+def when_ready(server):
+    # the preloaded objects move to a permanent generation, so the collector in each
+    # worker doesn't write to their pages and un-share them
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # the Firestore client holds a gRPC channel, which can't be used across a fork
+    import fireo
+
+    fireo.connection(from_file="serviceAccountKey.json")
+
+    # a no-op when the master already built the tools
+    from controllers.message_controller import agent_warmup
+
+    agent_warmup.start()
+
+
+def child_exit(server, worker):
+    from monitoring.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
@@ -1,21 +1,49 @@
 from flask import Flask
 from flask_cors import CORS
-from routes.message_route import controller
+from monitoring.startup import startup_report
+from agent.warmup import AGENT_WARMUP
 import fireo
 import os
 
 
-app = Flask(__name__)
-CORS(app, resources={ r"/api/*": { "origins": "*"}})
+def create_app():
+    """Builds the Flask app without waiting for the agent, tools are warmed up according to AGENT_WARMUP."""
+    app = Flask(__name__)
+    CORS(app, resources={ r"/api/*": { "origins": "*"}})
 
-# Set up environment variables
-os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "serviceAccountKey.json"
+    # Set up environment variables
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "serviceAccountKey.json"
 
-# Set up Firebase Admin SDK and FireO
-fireo.connection(from_file="serviceAccountKey.json")
+    # Set up Firebase Admin SDK and FireO
+    with startup_report.phase("fireo_connection"):
+        fireo.connection(from_file="serviceAccountKey.json")
+
+    # Register the controller blueprint
+    with startup_report.phase("routes"):
+        from routes.message_route import controller
+        from controllers.message_controller import agent_warmup
+    app.register_blueprint(controller)
+
+    if AGENT_WARMUP == "blocking":
+        agent_warmup.tools(timeout=None)
+    elif AGENT_WARMUP == "background":
+        agent_warmup.start()
+
+    return app
+
+
+_app = None
+
+
+def __getattr__(name):
+    # `gunicorn main:app` and `flask --app main` look up a module level app, it is created the first time they do
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# Register the controller blueprint
-app.register_blueprint(controller)
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
@@ -0,0 +1,183 @@
+"""Where each env's messages live.
+
+    flat:         every user's messages in one ProdMessages/DevMessages collection, filtered by conversation_user
+    dual:         written to both layouts, read from the flat one, while the backfill runs
+    partitioned:  one prod_user_messages/dev_user_messages subcollection per user, under
+                  prod_conversations/<user> (dev_conversations/<user>)
+
+A user's history is read, paged and deleted from their own subcollection, so it costs the
+same however much everyone else has written. Reads across every user use a collection group
+query. Copy the existing messages before switching reads over:
+
+    MESSAGE_STORAGE=dual      # deploy, new messages go to both layouts
+    python -m models.conversation_storage --env prod dev
+    MESSAGE_STORAGE=partitioned
+    python -m models.conversation_storage --env prod dev --delete-flat
+
+Messages written before conversations were kept per user have no conversation_user. The
+backfill gives them the user who sent them and writes it back to the flat message too, so
+user scoped reads of the flat layout only see them once it has run. The coach's replies from
+that time can't be told apart and are left where they are.
+"""
+
+import os
+import argparse
+from urllib.parse import quote
+from models.message_model import ProdMessages, DevMessages, ProdUserMessages, DevUserMessages
+from models.message_store import FIRESTORE_BATCH_LIMIT, commit_batch, delete_keys, delete_messages, message_writer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MESSAGE_STORAGE = os.environ.get("MESSAGE_STORAGE", "flat")
+
+AI_COACH_USER = "ai_coach"
+CONVERSATION_COLLECTIONS = {"prod": "prod_conversations", "dev": "dev_conversations"}
+MESSAGE_FIELDS = ["user", "type", "content", "created_at", "conversation_user"]
+
+
+class ConversationStorage:
+    """Reads, writes and deletes the messages of one env in the layout picked by MESSAGE_STORAGE."""
+
+    def __init__(self, env, flat_model, user_model, mode=MESSAGE_STORAGE):
+        self.env = env
+        self.flat_model = flat_model
+        self.user_model = user_model
+        self.mode = mode
+
+    @property
+    def partitioned(self):
+        return self.mode == "partitioned"
+
+    def conversation_key(self, user):
+        # user ids become part of a document path, so a slash can't be allowed through
+        return f"{CONVERSATION_COLLECTIONS[self.env]}/{quote(user, safe='')}"
+
+    def user_messages(self, user):
+        return self.user_model.collection.parent(self.conversation_key(user))
+
+    def all_user_messages(self):
+        # every user's subcollection has the same id, a collection group query reads them all
+        return self.user_model.collection.filter().copy(group_collection=True)
+
+    def flat_messages(self, user=None):
+        # a legacy message only has a conversation_user once the backfill has run
+        query = self.flat_model.collection
+        return query.filter('conversation_user', '==', user) if user else query
+
+    def query(self, user=None):
+        """Messages of `user`, or of every user, from the layout reads come from."""
+        if not self.partitioned:
+            return self.flat_messages(user)
+        return self.user_messages(user) if user else self.all_user_messages()
+
+    def cursor_key(self, cursor, user=None):
+        """start_after takes a document key, a bare message id is resolved in the collection reads come from."""
+        if "/" in cursor:
+            return cursor
+        if not self.partitioned:
+            return f"{self.flat_model._meta.collection_name}/{cursor}"
+        if not user:
+            raise ValueError("Paging every user's messages needs the key of the last message, not its id")
+        return f"{self.conversation_key(user)}/{self.user_model._meta.collection_name}/{cursor}"
+
+    def new_message(self, user):
+        """An unsaved message for `user` in the layout reads come from."""
+        if self.partitioned:
+            message = self.user_model(parent=self.conversation_key(user))
+        else:
+            message = self.flat_model()
+        message.conversation_user = user
+        return message
+
+    def partitioned_copy(self, message):
+        copy = self.user_model(parent=self.conversation_key(message.conversation_user))
+        copy.id = message.id
+        for field in MESSAGE_FIELDS:
+            setattr(copy, field, getattr(message, field))
+        return copy
+
+    def save(self, message):
+        message_writer.save(message)
+        if self.mode == "dual":
+            # saved after the flat message, so it has its id
+            message_writer.save(self.partitioned_copy(message))
+        return message
+
+    def delete(self, user=None, report=None):
+        """Deletes the messages of `user`, or of the whole env, from every layout that may hold them.
+
+        Returns how many were deleted from the layout reads come from.
+        """
+        if self.partitioned:
+            deleted = delete_messages(self.user_model, self.query(user), report=report)
+            delete_messages(self.flat_model, self.flat_messages(user))
+            return deleted
+
+        deleted = delete_messages(self.flat_model, self.flat_messages(user), report=report)
+        if self.mode == "dual":
+            delete_messages(self.user_model, self.user_messages(user) if user else self.all_user_messages())
+        return deleted
+
+    def backfill(self, chunk_size=FIRESTORE_BATCH_LIMIT, after=None, delete_flat=False):
+        """Copies every flat message into its user's subcollection, in batches of `chunk_size`.
+
+        Copies keep the message id, so running it again (or resuming from `after`, the key of
+        the last copied message) overwrites instead of duplicating. A legacy message without a
+        conversation_user belongs to the user who sent it, the coach's legacy replies can't be
+        attributed and are reported instead. With `delete_flat` the flat messages copied by
+        this run are deleted once every chunk is in.
+        """
+        copied, unattributed = [], []
+        query = self.flat_model.collection.order('created_at')
+        while True:
+            page = query.start_after(after) if after else query
+            messages = list(page.fetch(chunk_size))
+            if not messages:
+                break
+
+            writes = []
+            for message in messages:
+                if not message.conversation_user:
+                    if not message.user or message.user == AI_COACH_USER:
+                        unattributed.append(message.key)
+                        continue
+                    # written back too, so reads of the flat layout find it under its user
+                    message.conversation_user = message.user
+                    writes.append(message)
+                writes.append(self.partitioned_copy(message))
+                copied.append(message.key)
+            commit_batch(writes)
+            after = messages[-1].key
+            print(f"{self.env}: {len(copied)} messages copied, last {after}")
+
+        if unattributed:
+            print(f"{self.env}: {len(unattributed)} messages without a conversation_user were left in place: {', '.join(unattributed)}")
+        if delete_flat:
+            deleted = sum(
+                delete_keys(self.flat_model, copied[start:start + FIRESTORE_BATCH_LIMIT])
+                for start in range(0, len(copied), FIRESTORE_BATCH_LIMIT)
+            )
+            print(f"{self.env}: {deleted} flat messages deleted")
+        return len(copied)
+
+def env_storage(env, mode=MESSAGE_STORAGE):
+    if env == "prod":
+        return ConversationStorage(env, ProdMessages, ProdUserMessages, mode)
+    elif env == "dev":
+        return ConversationStorage(env, DevMessages, DevUserMessages, mode)
+
+
+if __name__ == "__main__":
+    import fireo
+
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--env", nargs="+", choices=list(CONVERSATION_COLLECTIONS), default=["dev"])
+    arg_parser.add_argument("--chunk-size", type=int, default=FIRESTORE_BATCH_LIMIT)
+    arg_parser.add_argument("--after", help="key of the last message copied by an interrupted run")
+    arg_parser.add_argument("--delete-flat", action="store_true", help="delete the flat messages once copied")
+    args = arg_parser.parse_args()
+
+    fireo.connection(from_file="serviceAccountKey.json")
+    for env in args.env:
+        env_storage(env, "dual").backfill(args.chunk_size, args.after, args.delete_flat)
@@ -6,9 +6,36 @@ class ProdMessages(Model):
     type = TextField()
     content = TextField()
     created_at = DateTime()
+    conversation_user = TextField()
 
 class DevMessages(Model):
     user = TextField()
     type = TextField()
     content = TextField()
-    created_at = DateTime()
\ No newline at end of file
+    created_at = DateTime()
+    conversation_user = TextField()
+
+# One subcollection per user under prod_conversations/<user>, see models/conversation_storage.py
+class ProdUserMessages(Model):
+    user = TextField()
+    type = TextField()
+    content = TextField()
+    created_at = DateTime()
+    conversation_user = TextField()
+
+class DevUserMessages(Model):
+    user = TextField()
+    type = TextField()
+    content = TextField()
+    created_at = DateTime()
+    conversation_user = TextField()
+
+class ProdSessionSummaries(Model):
+    user = TextField()
+    summary = TextField()
+    updated_at = DateTime()
+
+class DevSessionSummaries(Model):
+    user = TextField()
+    summary = TextField()
+    updated_at = DateTime()
\ No newline at end of file
@@ -0,0 +1,194 @@
+import os
+import time
+import uuid
+import atexit
+import threading
+import fireo
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FIRESTORE_BATCH_LIMIT = 500
+# Saves are queued and committed together instead of one round trip per message
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND") == "true"
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 50))
+WRITE_BEHIND_FLUSH_SECONDS = float(os.environ.get("WRITE_BEHIND_FLUSH_SECONDS", 1.0))
+# A failed commit is retried this many times, waiting twice as long each time, before its messages are dropped
+WRITE_BEHIND_MAX_RETRIES = int(os.environ.get("WRITE_BEHIND_MAX_RETRIES", 5))
+WRITE_BEHIND_RETRY_SECONDS = float(os.environ.get("WRITE_BEHIND_RETRY_SECONDS", 1.0))
+DELETE_CHUNK_SIZE = int(os.environ.get("DELETE_CHUNK_SIZE", FIRESTORE_BATCH_LIMIT))
+DELETE_WORKERS = int(os.environ.get("DELETE_WORKERS", 4))
+
+
+def commit_batch(messages):
+    for start in range(0, len(messages), FIRESTORE_BATCH_LIMIT):
+        batch = fireo.batch()
+        for message in messages[start:start + FIRESTORE_BATCH_LIMIT]:
+            message.save(batch=batch)
+        batch.commit()
+
+
+class MessageWriter:
+    """Persists ProdMessages/DevMessages documents.
+
+    Without write-behind every save is a single Firestore write, as before. With it,
+    saves are queued and committed in batches once `batch_size` messages are pending,
+    every `flush_seconds`, and when the process exits. A failed commit is retried after
+    `retry_seconds`, doubling each time. After `max_retries` the messages are saved one by
+    one and the ones that still fail are logged and dropped, so a message Firestore always
+    rejects can't hold up the queue forever.
+    """
+
+    def __init__(
+        self,
+        write_behind=WRITE_BEHIND,
+        batch_size=WRITE_BEHIND_BATCH_SIZE,
+        flush_seconds=WRITE_BEHIND_FLUSH_SECONDS,
+        max_retries=WRITE_BEHIND_MAX_RETRIES,
+        retry_seconds=WRITE_BEHIND_RETRY_SECONDS,
+    ):
+        self._write_behind = write_behind
+        self._batch_size = batch_size
+        self._flush_seconds = flush_seconds
+        self._max_retries = max_retries
+        self._retry_seconds = retry_seconds
+        self._pending = []
+        # failed commits in a row, and when the queue may be committed again
+        self._failures = 0
+        self._retry_at = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+        if write_behind:
+            atexit.register(self.close)
+
+    def save(self, message):
+        if not self._write_behind:
+            message.save()
+            return message
+
+        # the document id is picked now so the caller can return it before the commit
+        if not message.id:
+            message.id = uuid.uuid4().hex
+
+        self._ensure_thread()
+        with self._cond:
+            self._pending.append(message)
+            if len(self._pending) >= self._batch_size:
+                self._cond.notify()
+        return message
+
+    def save_many(self, messages):
+        commit_batch(list(messages))
+
+    def flush(self):
+        with self._cond:
+            # backing off after a failed commit, unless the process is exiting
+            if not self._closed and time.monotonic() < self._retry_at:
+                return 0
+            pending, self._pending = self._pending, []
+
+        if not pending:
+            return 0
+
+        try:
+            commit_batch(pending)
+        except Exception as e:
+            with self._cond:
+                self._failures += 1
+                if self._failures <= self._max_retries:
+                    delay = self._retry_seconds * 2 ** (self._failures - 1)
+                    print(f"Could not flush {len(pending)} queued messages, retrying in {delay:g}s", e)
+                    self._pending = pending + self._pending
+                    self._retry_at = time.monotonic() + delay
+                    return 0
+                self._failures, self._retry_at = 0, 0
+            return self._save_one_by_one(pending, e)
+
+        with self._cond:
+            self._failures, self._retry_at = 0, 0
+        return len(pending)
+
+    def _save_one_by_one(self, messages, error):
+        """Last try for a batch that kept failing, the messages that fail on their own are dropped."""
+        print(f"Giving up on committing {len(messages)} queued messages as a batch", error)
+        saved = 0
+        for message in messages:
+            try:
+                message.save()
+                saved += 1
+            except Exception as e:
+                print(f"Dropping queued message {message.key}", e)
+        return saved
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread and self._pid == os.getpid():
+            self._thread.join()
+        self.flush()
+
+    def _ensure_thread(self):
+        # threads don't survive a fork, so each worker process starts its own flusher
+        if self._thread and self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._thread and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self._flush_seconds
+                # a full batch waits for the backoff of a failed commit too
+                while not self._closed and (len(self._pending) < self._batch_size or time.monotonic() < self._retry_at):
+                    remaining = max(deadline, self._retry_at) - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                closed = self._closed
+
+            self.flush()
+            if closed:
+                return
+
+
+def delete_keys(message_model, keys):
+    batch = fireo.batch()
+    for key in keys:
+        message_model.collection.delete(key, batch=batch)
+    batch.commit()
+    return len(keys)
+
+
+def delete_messages(message_model, query=None, chunk_size=DELETE_CHUNK_SIZE, workers=DELETE_WORKERS, report=None):
+    """Deletes every message matched by `query` (the whole collection by default) in parallel batch commits.
+
+    `report` is called with {"deleted": n} after every committed chunk.
+    """
+    query = query or message_model.collection
+    deleted = 0
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="message-delete") as executor:
+        while True:
+            keys = [message.key for message in query.fetch(chunk_size * workers)]
+            if not keys:
+                break
+
+            chunks = [keys[start:start + chunk_size] for start in range(0, len(keys), chunk_size)]
+            for count in executor.map(lambda chunk: delete_keys(message_model, chunk), chunks):
+                deleted += count
+                if report:
+                    report({"deleted": deleted})
+
+    return deleted
+
+
+message_writer = MessageWriter()
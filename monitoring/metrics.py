@@ -0,0 +1,61 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Shared by the worker processes of one server, each keeps its metrics in files there and /metrics serves
+# their sum. prometheus_client reads it when it is first imported, gunicorn.conf.py sets it before the app
+# loads. Unset, /metrics only covers the process that answers the scrape
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# imported once the .env is loaded, so PROMETHEUS_MULTIPROC_DIR can be set there too
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, float("inf"))
+
+
+def render_metrics(directory=PROMETHEUS_MULTIPROC_DIR):
+    """Every metric in the Prometheus text exposition format, summed over the worker files in `directory`."""
+    if not directory:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=directory)
+    return generate_latest(registry)
+
+
+def mark_process_dead(pid, directory=PROMETHEUS_MULTIPROC_DIR):
+    """Called by the gunicorn master when a worker exits, its counts stay in the sums."""
+    if directory:
+        multiprocess.mark_process_dead(pid, directory)
+
+
+REQUEST_DURATION = Histogram(
+    "willow_request_duration_seconds", "Time spent handling a request.", ["route", "method", "status"], buckets=DEFAULT_BUCKETS
+)
+STAGE_DURATION = Histogram(
+    "willow_stage_duration_seconds", "Time spent in each stage of the request path.", ["stage"], buckets=DEFAULT_BUCKETS
+)
+TOOL_CALL_DURATION = Histogram(
+    "willow_tool_call_duration_seconds", "Time spent running an agent tool.", ["tool"], buckets=DEFAULT_BUCKETS
+)
+TOOL_CALL_FAILURES = Counter(
+    "willow_tool_call_failures_total", "Agent tool calls answered with an error.", ["tool", "reason"]
+)
+LLM_CALL_DURATION = Histogram(
+    "willow_llm_call_duration_seconds", "Time spent waiting on an LLM call.", ["model"], buckets=DEFAULT_BUCKETS
+)
+LLM_CALL_PATH = Counter(
+    "willow_llm_call_path_total", "LLM calls by the path that served them: primary, hedge, fallback, error or deadline_exceeded.", ["call", "path"]
+)
+LLM_TOKENS = Counter(
+    "willow_llm_tokens_total", "Tokens sent to and generated by LLMs.", ["model", "type"]
+)
+EMBEDDING_DURATION = Histogram(
+    "willow_embedding_duration_seconds", "Time spent computing embeddings.", ["model"], buckets=DEFAULT_BUCKETS
+)
+EMBEDDED_TEXTS = Counter(
+    "willow_embedded_texts_total", "Texts sent to the embedding model.", ["model"]
+)
+IDEMPOTENT_REQUESTS = Counter(
+    "willow_idempotent_requests_total", "Keyed requests by whether they ran or reused another's result.", ["route", "outcome"]
+)
@@ -0,0 +1,65 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+class StartupReport:
+    """Time spent in each phase of getting the app ready, and the checks that say it is."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._phases = {}
+        self._checks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        with self._lock:
+            self._phases[name] = {"status": "running", "startedAt": round(time.time() - self.started_at, 3)}
+        try:
+            yield
+        except Exception as e:
+            self._finish(name, start, "failed", str(e))
+            raise
+        self._finish(name, start, "done")
+
+    def _finish(self, name, start, status, error=None):
+        with self._lock:
+            self._phases[name].update(status=status, seconds=round(time.perf_counter() - start, 3))
+            if error:
+                self._phases[name]["error"] = error
+
+    def add_check(self, name, check):
+        """`check()` returns True once the named dependency can serve requests."""
+        with self._lock:
+            self._checks[name] = check
+
+    def checks(self):
+        with self._lock:
+            checks = dict(self._checks)
+        results = {}
+        for name, check in checks.items():
+            try:
+                results[name] = bool(check())
+            except Exception:
+                results[name] = False
+        return results
+
+    def ready(self):
+        checks = self.checks()
+        return bool(checks) and all(checks.values())
+
+    def report(self):
+        with self._lock:
+            phases = {name: dict(phase) for name, phase in self._phases.items()}
+        return {
+            "pid": os.getpid(),
+            "uptimeSeconds": round(time.time() - self.started_at, 3),
+            "phases": phases,
+            "checks": self.checks(),
+        }
+
+
+startup_report = StartupReport()
@@ -0,0 +1,168 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from llama_index.callbacks import CBEventType, EventPayload
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from monitoring.metrics import (
+    STAGE_DURATION,
+    TOOL_CALL_DURATION,
+    LLM_CALL_DURATION,
+    LLM_TOKENS,
+    EMBEDDING_DURATION,
+    EMBEDDED_TEXTS,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Adds a Server-Timing header with the per stage breakdown of every response
+TIMING_HEADER = os.environ.get("TIMING_HEADER") == "true"
+
+_request_trace = ContextVar("request_trace", default=None)
+
+
+class RequestTrace:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.spans.append((stage, seconds))
+
+    def breakdown(self):
+        """{stage: (total seconds, count)} in the order stages first ran."""
+        totals = {}
+        with self._lock:
+            for stage, seconds in self.spans:
+                total, count = totals.get(stage, (0.0, 0))
+                totals[stage] = (total + seconds, count + 1)
+        return totals
+
+    def server_timing(self):
+        # Server-Timing metric names are tokens, so tool and model names are sanitized
+        entries = []
+        for stage, (seconds, count) in self.breakdown().items():
+            name = "".join(c if c.isalnum() or c in "_-." else "_" for c in stage)
+            entries.append(f'{name};dur={seconds * 1000:.1f};desc="x{count}"')
+        entries.append(f"total;dur={(time.perf_counter() - self.started_at) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+def start_request_trace():
+    return _request_trace.set(RequestTrace())
+
+
+def end_request_trace(token):
+    trace = _request_trace.get()
+    _request_trace.reset(token)
+    return trace
+
+
+def current_trace():
+    return _request_trace.get()
+
+
+def record_stage(stage, seconds):
+    STAGE_DURATION.labels(stage=stage).observe(seconds)
+    trace = _request_trace.get()
+    if trace:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(stage):
+    """Times a block of the request path as `stage`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def _model_name(payload):
+    serialized = (payload or {}).get(EventPayload.SERIALIZED) or {}
+    return serialized.get("model") or serialized.get("model_name") or serialized.get("class_name") or "unknown"
+
+
+def _token_counts(response):
+    counts = dict(getattr(response, "additional_kwargs", None) or {})
+    if "prompt_tokens" in counts:
+        return counts.get("prompt_tokens", 0), counts.get("completion_tokens", 0)
+
+    # the OpenAI client returns pydantic objects, so usage isn't always copied into additional_kwargs
+    raw = getattr(response, "raw", None)
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if not usage:
+        return None, None
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return getattr(usage, "prompt_tokens", 0), getattr(usage, "completion_tokens", 0)
+
+
+class TimingCallbackHandler(BaseCallbackHandler):
+    """Turns llama_index tool, LLM, embedding, retrieval and synthesis events into metrics and spans."""
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+        if event_type == CBEventType.FUNCTION_CALL:
+            tool = (payload or {}).get(EventPayload.TOOL)
+            label = getattr(tool, "name", None) or "unknown"
+        elif event_type in (CBEventType.LLM, CBEventType.EMBEDDING):
+            label = _model_name(payload)
+        else:
+            label = None
+
+        with self._lock:
+            self._events[event_id] = (time.perf_counter(), label)
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        with self._lock:
+            started = self._events.pop(event_id, None)
+        if not started:
+            return
+
+        start, label = started
+        seconds = time.perf_counter() - start
+        payload = payload or {}
+
+        if event_type == CBEventType.FUNCTION_CALL:
+            TOOL_CALL_DURATION.labels(tool=label).observe(seconds)
+            record_stage(f"tool:{label}", seconds)
+        elif event_type == CBEventType.LLM:
+            LLM_CALL_DURATION.labels(model=label).observe(seconds)
+            record_stage(f"llm:{label}", seconds)
+            response = payload.get(EventPayload.RESPONSE) or payload.get(EventPayload.COMPLETION)
+            prompt_tokens, completion_tokens = _token_counts(response)
+            if prompt_tokens is not None:
+                LLM_TOKENS.labels(model=label, type="prompt").inc(prompt_tokens)
+                LLM_TOKENS.labels(model=label, type="completion").inc(completion_tokens)
+        elif event_type == CBEventType.EMBEDDING:
+            EMBEDDING_DURATION.labels(model=label).observe(seconds)
+            EMBEDDED_TEXTS.labels(model=label).inc(len(payload.get(EventPayload.CHUNKS) or []))
+            record_stage(f"embedding:{label}", seconds)
+        elif event_type in (CBEventType.RETRIEVE, CBEventType.SYNTHESIZE):
+            record_stage(event_type.value, seconds)
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
+
+
+def install_llama_index_handler():
+    """Registers the handler globally, every CallbackManager created afterwards picks it up."""
+    import llama_index
+
+    if not isinstance(llama_index.global_handler, TimingCallbackHandler):
+        llama_index.global_handler = TimingCallbackHandler()
+    return llama_index.global_handler
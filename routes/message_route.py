@@ -1,10 +1,16 @@
 # routes.py
 
-from flask import Blueprint, jsonify, request
-from flask_cors import cross_origin
-from controllers.message_controller import get_agent_response, get_conversation, delete_conversation, send_message, send_file
-from agent.agent_setup import agent_setup
+from flask import Blueprint, Response, g, jsonify, request, stream_with_context
+from werkzeug.datastructures import FileStorage
+from controllers.message_controller import get_agent_response, get_conversation, delete_conversation, send_message, send_file, stream_agent_response, get_job, stream_job, get_stats, get_readiness, conversation_etag, export_conversation
+from controllers.message_controller import EXPORT_CHUNK_SIZE
+from controllers.conversation_cache import messages_etag
+from controllers.idempotency import EXECUTED, idempotent_requests, request_idempotency_key
+from monitoring.metrics import CONTENT_TYPE_LATEST, IDEMPOTENT_REQUESTS, REQUEST_DURATION, render_metrics
+from monitoring.tracing import TIMING_HEADER, start_request_trace, end_request_trace
+from agent.deadlines import deadline_seconds
 import traceback
+import time
 
 controller = Blueprint('controller', __name__)
 
@@ -13,31 +19,125 @@ def print_and_return_exception(e, **additional_params):
     traceback.print_exc()
     return jsonify({ "status": "error getting conversation", "exception": e, **additional_params}), 500
 
+def event_stream_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def idempotent_response(route, env, user, data, fn):
+    """Runs `fn` once per idempotency key, retries of a slow send share or replay its result."""
+    key = request_idempotency_key(route, env, user, data, request.headers.get('Idempotency-Key'))
+    (result, status_code), outcome = idempotent_requests.run(key, fn, scope=(env, user))
+    if key:
+        IDEMPOTENT_REQUESTS.labels(route=route, outcome=outcome).inc()
+
+    response = jsonify(result)
+    if outcome != EXECUTED:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response, status_code
+
+@controller.before_request
+def start_trace():
+    g.trace_token = start_request_trace()
+
+@controller.after_request
+def end_trace(response):
+    trace = end_request_trace(g.trace_token)
+    # labelled by route pattern, not path, so job ids don't create a series each
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_DURATION.labels(route=route, method=request.method, status=response.status_code).observe(
+        time.perf_counter() - trace.started_at
+    )
+
+    # streamed bodies are produced after this runs, their header only covers the work done up front
+    if TIMING_HEADER or request.headers.get('X-Timing') == 'true':
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
 
 @controller.route('/', methods=['GET'])
 def hello_world():
     #return hello world in json
     return jsonify({"message": "Hello, World!"}), 200
 
+@controller.route('/healthz', methods=['GET'])
+def healthz_route():
+    # liveness only, the process is up and serving, see /readyz for whether it can answer chats
+    return jsonify({"status": "ok"}), 200
+
+@controller.route('/readyz', methods=['GET'])
+def readyz_route():
+    try:
+        result, status_code = get_readiness()
+        return jsonify(result), status_code
+    except Exception as e:
+        return print_and_return_exception(e)
+
+@controller.route('/api/stats', methods=['GET'])
+def get_stats_route():
+    try:
+        result, status_code = get_stats()
+        return jsonify(result), status_code
+    except Exception as e:
+        return print_and_return_exception(e)
+
+@controller.route('/metrics', methods=['GET'])
+def metrics_route():
+    return Response(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
 @controller.route('/api/conversation', methods=['GET'])
 def get_conversation_route():
     env = request.args.get('env')
     page = int(request.args.get('page', 1))
     limit = int(request.args.get('limit', 0))
     last_document = request.args.get('last_document')
+    user = request.args.get('user')
 
     try:
-        result, status_code = get_conversation(env, page, limit, last_document)
-        return jsonify(result), status_code
+        # polls for an unchanged conversation are answered without reading Firestore
+        etag = conversation_etag(env, page, limit, user)
+        if etag and etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        result, status_code = get_conversation(env, page, limit, last_document, user)
+        response = jsonify(result)
+        if status_code != 200:
+            return response, status_code
+
+        response.set_etag(messages_etag(result["messages"]))
+        return response.make_conditional(request)
+    except Exception as e:
+        return print_and_return_exception(e)
+
+@controller.route('/api/conversation/export', methods=['GET'])
+def export_conversation_route():
+    env = request.args.get('env')
+    user = request.args.get('user')
+    start = request.args.get('start')
+    end = request.args.get('end')
+    cursor = request.args.get('cursor')
+    chunk_size = int(request.args.get('chunkSize', EXPORT_CHUNK_SIZE))
+
+    try:
+        result, status_code = export_conversation(env, user, start, end, cursor, chunk_size)
+        if status_code != 200:
+            return jsonify(result), status_code
+        return Response(stream_with_context(result), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
     except Exception as e:
         return print_and_return_exception(e)
 
 @controller.route('/api/conversation', methods=['DELETE'])
 def delete_conversation_route():
     env = request.args.get('env')
+    user = request.args.get('user')
+    run_async = request.args.get('async') == 'true'
 
     try:
-        result, status_code = delete_conversation(env)
+        result, status_code = delete_conversation(env, run_async, user)
         return jsonify(result), status_code
     except Exception as e:
         return print_and_return_exception(e)
@@ -46,10 +146,17 @@ def delete_conversation_route():
 def send_message_route():
     env = request.args.get('env')
     user = request.args.get('user')
+    stream = request.args.get('stream') == 'true'
+    deadline = deadline_seconds(request.headers.get('X-Request-Timeout'))
     data = request.get_json()
     try:
-        result, status_code = send_message(env, user, data)
-        return jsonify(result), status_code
+        if stream and data and data.get("type") == "text":
+            # a streamed reply can't be shared, only plain sends are deduplicated
+            result, status_code = send_message(env, user, data, stream, deadline)
+            if status_code == 200:
+                return event_stream_response(result)
+            return jsonify(result), status_code
+        return idempotent_response('sendMessage', env, user, data, lambda: send_message(env, user, data, deadline=deadline))
     except Exception as e:
         return print_and_return_exception(e)
     
@@ -57,9 +164,17 @@ def send_message_route():
 def send_file_route():
     content_id = request.args.get('contentId')
     env = request.args.get('env')
-    files = request.files
+    user = request.args.get('user')
+    run_async = request.args.get('async') == 'true'
+
+    if request.mimetype == 'multipart/form-data':
+        files = request.files
+    else:
+        # a raw request body is uploaded as it is read, without being buffered first
+        files = { "file": FileStorage(stream=request.stream, filename=content_id, content_type=request.mimetype) }
+
     try:
-        result, status_code = send_file(content_id, env, files)
+        result, status_code = send_file(content_id, env, files, user, run_async)
         return jsonify(result), status_code
     except Exception as e:
         return print_and_return_exception(e, additional_params={"content_id": content_id})
@@ -67,10 +182,44 @@ def send_file_route():
 @controller.route('/api/getAgentResponse', methods=['POST'])
 def get_agent_response_route():
     env = request.args.get('env')
+    user = request.args.get('user')
+    deadline = deadline_seconds(request.headers.get('X-Request-Timeout'))
     data = request.get_json()
 
     try:
-        result, status_code = get_agent_response(env, data)
+        return idempotent_response('getAgentResponse', env, user, data, lambda: get_agent_response(env, data, user, deadline))
+    except Exception as e:
+        return print_and_return_exception(e)
+
+@controller.route('/api/streamAgentResponse', methods=['POST'])
+def stream_agent_response_route():
+    env = request.args.get('env')
+    user = request.args.get('user')
+    deadline = deadline_seconds(request.headers.get('X-Request-Timeout'))
+    data = request.get_json()
+
+    try:
+        result, status_code = stream_agent_response(env, data, user, deadline=deadline)
+        if status_code != 200:
+            return jsonify(result), status_code
+        return event_stream_response(result)
+    except Exception as e:
+        return print_and_return_exception(e)
+
+@controller.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_route(job_id):
+    try:
+        result, status_code = get_job(job_id)
         return jsonify(result), status_code
+    except Exception as e:
+        return print_and_return_exception(e)
+
+@controller.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_route(job_id):
+    try:
+        result, status_code = stream_job(job_id)
+        if status_code != 200:
+            return jsonify(result), status_code
+        return event_stream_response(result)
     except Exception as e:
         return print_and_return_exception(e)
\ No newline at end of file
@@ -0,0 +1,51 @@
+import pytest
+from agent.session_manager import AgentSessionManager
+from bench.fakes import ScriptedAgent, FakeFireo, fake_message_model, SUMMARY_FIELDS
+from controllers.conversation_cache import ConversationCache, InProcessBackend
+from controllers.idempotency import IdempotentRequests
+
+REPLY = "Take a slow breath with me"
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    """message_controller with in-memory Firestore models and scripted agents."""
+    from controllers import message_controller
+    from models import message_store
+
+    for name in ["ProdMessages", "DevMessages", "ProdUserMessages", "DevUserMessages"]:
+        monkeypatch.setattr(message_controller, name, fake_message_model(name))
+    for name in ["ProdSessionSummaries", "DevSessionSummaries"]:
+        monkeypatch.setattr(message_controller, name, fake_message_model(name, fields=SUMMARY_FIELDS))
+    monkeypatch.setattr(message_store, "fireo", FakeFireo())
+
+    agents = []
+
+    def create_agent(env, user, chat_history):
+        agent = ScriptedAgent(REPLY, chat_history=chat_history)
+        agents.append(agent)
+        return agent
+
+    monkeypatch.setattr(
+        message_controller, "agent_sessions",
+        AgentSessionManager(create_agent, load_history=message_controller.load_chat_history),
+    )
+    monkeypatch.setattr(message_controller, "conversation_cache", ConversationCache(InProcessBackend()))
+    monkeypatch.setattr(message_controller, "idempotent_requests", IdempotentRequests())
+    message_controller.agents = agents
+    yield message_controller
+    del message_controller.agents
+
+
+@pytest.fixture
+def client(controller, monkeypatch):
+    from flask import Flask
+    from routes import message_route
+    from routes.message_route import controller as blueprint
+
+    # the route keys requests through the same fresh IdempotentRequests as the controller
+    monkeypatch.setattr(message_route, "idempotent_requests", controller.idempotent_requests)
+
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    return app.test_client()
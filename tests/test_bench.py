@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+from datetime import datetime
+from llama_index.llms import ChatMessage
+from bench.fakes import ScriptedAgent, fake_message_model
+from bench.load_test import summarize
+
+
+def test_scripted_agent_keeps_chat_messages():
+    agent = ScriptedAgent("hello there")
+
+    agent.chat("hi")
+    list(agent.stream_chat("again").response_gen)
+
+    assert all(isinstance(message, ChatMessage) for message in agent.chat_history)
+    assert [message.content for message in agent.chat_history] == ["hi", "hello there", "again", "hello there"]
+
+
+def test_fake_keys_page_like_fireo():
+    Messages = fake_message_model("DevMessages")
+    for second in range(3):
+        message = Messages()
+        message.created_at = datetime(2024, 1, 1, 0, 0, second)
+        message.save()
+
+    first = next(Messages.collection.order("created_at").fetch(1))
+    assert first.key == f"dev_messages/{first.id}"
+    assert len(list(Messages.collection.order("created_at").start_after(first.key).fetch())) == 2
+    with pytest.raises(AssertionError):
+        Messages.collection.start_after(first.id)
+
+
+def test_fake_subcollections_and_group_queries():
+    Messages = fake_message_model("DevUserMessages")
+    for user in ["ana", "ana", "ben"]:
+        Messages(parent=f"dev_conversations/{user}").save()
+
+    assert len(list(Messages.collection.parent("dev_conversations/ana").fetch())) == 2
+    assert len(list(Messages.collection.fetch())) == 0
+    assert len(list(Messages.collection.filter().copy(group_collection=True).fetch())) == 3
+
+    key = next(Messages.collection.parent("dev_conversations/ben").fetch()).key
+    assert key.startswith("dev_conversations/ben/dev_user_messages/")
+    Messages.collection.delete(key)
+    assert len(list(Messages.collection.filter().copy(group_collection=True).fetch())) == 2
+
+
+def test_summarize_counts_errors():
+    assert summarize([1.0, 2.0, 3.0], 1, 2.0)["requests"] == 4
+    assert summarize([], 5, 1.0)["p50_ms"] is None
+
+
+@pytest.mark.parametrize("storage", ["flat", "partitioned"])
+def test_load_test_runs_every_scenario_without_errors(tmp_path, storage):
+    output = tmp_path / "results.json"
+    result = subprocess.run(
+        [
+            sys.executable, "-m", "bench.load_test",
+            "--requests", "8", "--warmup", "1", "--concurrency", "2", "--users", "3",
+            "--llm-latency-ms", "0", "--tokens-per-second", "0", "--firestore-latency-ms", "0",
+            "--gcs-latency-ms", "0", "--file-bytes", "1024", "--output", str(output),
+        ],
+        capture_output=True,
+        text=True,
+        timeout=300,
+        env={**os.environ, "MESSAGE_STORAGE": storage},
+    )
+
+    assert result.returncode == 0, result.stderr
+    scenarios = json.loads(output.read_text())["scenarios"]
+    assert {name: summary["errors"] for name, summary in scenarios.items()} == {
+        "sendMessage": 0, "conversation": 0, "sendFile": 0, "getAgentResponse": 0,
+    }
@@ -0,0 +1,127 @@
+import time
+import threading
+from datetime import datetime
+from llama_index.llms import ChatMessage, MessageRole
+from agent.agent_setup import session_tools
+from agent.chat_memory import RollingSummaryHistory, SummaryMemory, split_summary, split_turns, summary_message
+
+
+def user(content):
+    return ChatMessage(role=MessageRole.USER, content=content)
+
+
+def assistant(content):
+    return ChatMessage(role=MessageRole.ASSISTANT, content=content)
+
+
+def conversation(turns):
+    messages = []
+    for i in range(turns):
+        messages += [user(f"question {i}"), assistant(f"answer {i}")]
+    return messages
+
+
+class Summarizer:
+    def __init__(self, release=None):
+        self.calls = []
+        self.release = release
+
+    def __call__(self, summary, messages):
+        if self.release:
+            self.release.wait(5)
+        self.calls.append((summary, [message.content for message in messages]))
+        return f"{summary or ''}+{len(messages)}"
+
+
+def history(chat_history=None, **kwargs):
+    kwargs.setdefault("token_limit", 1000)
+    kwargs.setdefault("keep_turns", 2)
+    return RollingSummaryHistory(chat_history, tokenizer_fn=str.split, **kwargs)
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_turns_keep_tool_calls_with_their_question():
+    tool_call = ChatMessage(role=MessageRole.ASSISTANT, content=None, additional_kwargs={"tool_calls": []})
+    tool_reply = ChatMessage(role=MessageRole.TOOL, content="result")
+
+    turns = split_turns([user("q1"), tool_call, tool_reply, assistant("a1"), user("q2")])
+
+    assert [len(turn) for turn in turns] == [4, 1]
+
+
+def test_old_turns_are_folded_into_the_summary():
+    summarizer = Summarizer()
+    chat = history(conversation(4), summarize_fn=summarizer)
+
+    wait_for(lambda: chat.summary == "+4")
+    assert summarizer.calls == [(None, ["question 0", "answer 0", "question 1", "answer 1"])]
+    assert [message.content for message in chat.messages()[1:]] == ["question 2", "answer 2", "question 3", "answer 3"]
+    assert chat.messages()[0].content.endswith("+4")
+
+
+def test_token_limit_shrinks_the_window():
+    release = threading.Event()
+    chat = history(conversation(3), keep_turns=10, token_limit=4, summarize_fn=Summarizer(release))
+
+    # each turn is 4 tokens, only the last one fits
+    assert [message.content for message in chat.messages()] == ["question 2", "answer 2"]
+    release.set()
+
+
+def test_turns_are_not_lost_while_a_summary_is_written():
+    release = threading.Event()
+    chat = history(conversation(3), summarize_fn=Summarizer(release))
+    chat.append(user("question 3"))
+
+    assert [message.content for message in chat.all_messages()][-1] == "question 3"
+    release.set()
+    wait_for(lambda: chat.summary is not None and "question 1" not in [m.content for m in chat.all_messages()])
+    assert [message.content for message in chat.all_messages()[1:]][-1] == "question 3"
+
+
+def test_saved_summary_starts_the_history():
+    chat = history([summary_message("likes walks"), *conversation(1)], summarize_fn=Summarizer())
+
+    assert chat.summary == "likes walks"
+    assert split_summary(chat.messages())[0] == "likes walks"
+
+
+def test_clear_drops_the_summary_and_turns():
+    chat = history([summary_message("likes walks"), *conversation(1)], summarize_fn=Summarizer())
+
+    chat.clear()
+
+    assert chat.messages() == []
+
+
+def test_save_session_persists_the_given_summary_or_the_running_one():
+    memory = SummaryMemory(history=history([summary_message("likes walks")], summarize_fn=Summarizer()))
+    saved = []
+    save_session = session_tools(memory, saved.append)[0]
+
+    save_session.call(chat_summary="Ana feels calmer")
+    save_session.call(chat_summary="")
+
+    assert saved == ["Ana feels calmer", "likes walks"]
+
+
+def test_returning_user_starts_from_the_saved_summary(controller):
+    storage = controller.get_storage("dev")
+    before = storage.new_message("ana")
+    before.user, before.type, before.content, before.created_at = "ana", "text", "old question", datetime(2024, 1, 1)
+    storage.save(before)
+    controller.save_session_summary("dev", "ana", "Ana feels calmer")
+    after = storage.new_message("ana")
+    after.user, after.type, after.content, after.created_at = "ana", "text", "new question", datetime(2100, 1, 1)
+    storage.save(after)
+
+    chat_history = controller.load_chat_history("dev", "ana")
+
+    assert split_summary(chat_history)[0] == "Ana feels calmer"
+    assert [message.content for message in chat_history[1:]] == ["new question"]
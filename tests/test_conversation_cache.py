@@ -0,0 +1,117 @@
+import time
+from datetime import datetime, timedelta
+from controllers.conversation_cache import ConversationCache, InProcessBackend, messages_etag
+
+START = datetime(2024, 1, 1, 10, 0, 0)
+
+
+def message(i):
+    return {"id": f"m{i}", "content": f"message {i}", "created_at": START + timedelta(minutes=i)}
+
+
+def newest_first(count):
+    return [message(i) for i in reversed(range(count))]
+
+
+def test_window_is_served_after_a_fill():
+    cache = ConversationCache(InProcessBackend(), window_size=5)
+    assert cache.get("dev", "ana", 3) is None
+
+    cache.fill("dev", "ana", newest_first(5), 5)
+
+    assert [m["id"] for m in cache.get("dev", "ana", 3)] == ["m4", "m3", "m2"]
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_short_conversation_is_complete():
+    cache = ConversationCache(InProcessBackend(), window_size=5)
+    cache.fill("dev", "ana", newest_first(2), 5)
+
+    assert len(cache.get("dev", "ana", 5)) == 2
+
+
+def test_partial_window_cant_answer_a_bigger_page():
+    cache = ConversationCache(InProcessBackend(), window_size=10)
+    cache.fill("dev", "ana", newest_first(3), 3)
+
+    assert cache.get("dev", "ana", 5) is None
+    assert cache.get("dev", "ana", 11) is None
+
+
+def test_appends_keep_the_window_newest_first_and_bounded():
+    cache = ConversationCache(InProcessBackend(), window_size=3)
+    cache.fill("dev", "ana", newest_first(2), 3)
+
+    cache.append("dev", "ana", message(5))
+    cache.append("dev", "ana", message(3))
+
+    assert [m["id"] for m in cache.get("dev", "ana", 3)] == ["m5", "m3", "m1"]
+    # the oldest message fell out, so the window no longer holds the whole conversation
+    assert cache.get("dev", "ana", 4) is None
+
+
+def test_append_reaches_the_env_window_too():
+    cache = ConversationCache(InProcessBackend(), window_size=5)
+    cache.fill("dev", None, newest_first(1), 5)
+
+    cache.append("dev", "ana", message(1))
+
+    assert [m["id"] for m in cache.get("dev", None, 5)] == ["m1", "m0"]
+
+
+def test_fill_that_raced_a_write_is_dropped():
+    cache = ConversationCache(InProcessBackend(), window_size=5)
+    writes = cache.writes("dev", "ana")
+    cache.append("dev", "ana", message(9))
+
+    cache.fill("dev", "ana", newest_first(2), 5, writes)
+
+    assert cache.get("dev", "ana", 1) is None
+
+
+def test_invalidate_drops_the_user_and_env_windows():
+    cache = ConversationCache(InProcessBackend(), window_size=5)
+    for user in ["ana", "ben", None]:
+        cache.fill("dev", user, newest_first(2), 5)
+
+    cache.invalidate("dev", "ana")
+    assert cache.peek("dev", "ana", 1) is None
+    assert cache.peek("dev", None, 1) is None
+    assert cache.peek("dev", "ben", 1) is not None
+
+    cache.invalidate("dev")
+    assert cache.peek("dev", "ben", 1) is None
+
+
+def test_windows_expire():
+    cache = ConversationCache(InProcessBackend(ttl_seconds=0.01), window_size=5)
+    cache.fill("dev", "ana", newest_first(2), 5)
+    time.sleep(0.02)
+
+    assert cache.get("dev", "ana", 1) is None
+
+
+def test_etag_changes_with_the_messages():
+    assert messages_etag(newest_first(2)) == messages_etag(newest_first(2))
+    assert messages_etag(newest_first(2)) != messages_etag(newest_first(3))
+
+
+def send(client, user, content, minute):
+    body = {"type": "image", "content": content, "createdAt": f"2024-01-01T10:{minute:02d}:00Z"}
+    return client.post(f"/api/sendMessage?env=dev&user={user}", json=body)
+
+
+def test_unchanged_conversation_poll_is_not_modified(client):
+    send(client, "ana", "drawing", 0)
+
+    first = client.get("/api/conversation?env=dev&user=ana&limit=10")
+    again = client.get("/api/conversation?env=dev&user=ana&limit=10", headers={"If-None-Match": first.headers["ETag"]})
+
+    assert first.status_code == 200
+    assert len(first.get_json()["messages"]) == 1
+    assert again.status_code == 304
+
+    send(client, "ana", "another drawing", 1)
+    changed = client.get("/api/conversation?env=dev&user=ana&limit=10", headers={"If-None-Match": first.headers["ETag"]})
+    assert changed.status_code == 200
+    assert len(changed.get_json()["messages"]) == 2
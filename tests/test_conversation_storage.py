@@ -0,0 +1,131 @@
+import itertools
+from datetime import datetime, timedelta
+import pytest
+from bench.fakes import FakeFireo, fake_message_model
+from models import message_store
+from models.conversation_storage import ConversationStorage
+
+START = datetime(2024, 1, 1, 10)
+
+
+@pytest.fixture(autouse=True)
+def fireo(monkeypatch):
+    monkeypatch.setattr(message_store, "fireo", FakeFireo())
+
+
+@pytest.fixture
+def storage_in():
+    flat, partitioned = fake_message_model("DevMessages"), fake_message_model("DevUserMessages")
+    return lambda mode: ConversationStorage("dev", flat, partitioned, mode)
+
+
+@pytest.fixture
+def add():
+    minutes = itertools.count()
+
+    def add(storage, user, count, sender=None):
+        messages = []
+        for index in range(count):
+            message = storage.new_message(user)
+            message.user = sender or user
+            message.type = "text"
+            message.content = f"{sender or user} {index}"
+            message.created_at = START + timedelta(minutes=next(minutes))
+            messages.append(storage.save(message))
+        return messages
+
+    return add
+
+
+def contents(query):
+    return sorted(message.content for message in query.fetch())
+
+
+def test_partitioned_messages_live_under_their_user(storage_in, add):
+    storage = storage_in("partitioned")
+    add(storage, "ana", 2)
+    add(storage, "a/b", 1)
+
+    assert contents(storage.query("ana")) == ["ana 0", "ana 1"]
+    assert contents(storage.query()) == ["a/b 0", "ana 0", "ana 1"]
+    assert next(storage.query("a/b").fetch()).key.startswith("dev_conversations/a%2Fb/")
+    assert storage.flat_model.collection.all() == []
+
+
+def test_dual_writes_both_layouts_with_the_same_ids(storage_in, add):
+    storage = storage_in("dual")
+    saved = add(storage, "ana", 2)
+
+    assert contents(storage.query("ana")) == ["ana 0", "ana 1"]
+    assert sorted(message.id for message in storage_in("partitioned").query("ana").fetch()) == sorted(message.id for message in saved)
+
+
+def test_backfill_copies_every_user_and_can_resume(storage_in, add):
+    flat = storage_in("flat")
+    add(flat, "ana", 3)
+    add(flat, "bo", 2)
+    dual, partitioned = storage_in("dual"), storage_in("partitioned")
+
+    assert dual.backfill(chunk_size=2) == 5
+    assert contents(partitioned.query("ana")) == ["ana 0", "ana 1", "ana 2"]
+    assert contents(partitioned.query("bo")) == ["bo 0", "bo 1"]
+
+    # resumed after the third message, the rest is copied again without duplicating
+    third = sorted(flat.query().fetch(), key=lambda message: message.created_at)[2]
+    assert dual.backfill(chunk_size=2, after=third.key) == 2
+    assert len(list(partitioned.query().fetch())) == 5
+
+
+def test_backfill_can_delete_the_flat_messages(storage_in, add):
+    add(storage_in("flat"), "ana", 3)
+
+    storage_in("dual").backfill(delete_flat=True)
+
+    assert storage_in("flat").flat_model.collection.all() == []
+    assert contents(storage_in("partitioned").query("ana")) == ["ana 0", "ana 1", "ana 2"]
+
+
+def test_backfill_gives_legacy_messages_their_sender(storage_in, add, capsys):
+    # messages saved before conversation_user existed
+    flat = storage_in("flat")
+    add(flat, None, 2, sender="ana")
+    coach = add(flat, None, 1, sender="ai_coach")
+    add(flat, "bo", 1)
+
+    assert storage_in("dual").backfill(chunk_size=2, delete_flat=True) == 3
+
+    assert contents(storage_in("partitioned").query("ana")) == ["ana 0", "ana 1"]
+    assert contents(storage_in("partitioned").query("bo")) == ["bo 0"]
+    # the coach's legacy reply has no owner, it is reported and kept instead of deleted
+    assert [message.key for message in flat.flat_model.collection.all()] == [coach[0].key]
+    assert coach[0].key in capsys.readouterr().out
+
+
+def test_backfilled_legacy_messages_are_found_in_the_flat_layout(storage_in, add):
+    flat = storage_in("flat")
+    add(flat, None, 2, sender="ana")
+    assert contents(flat.query("ana")) == []
+
+    storage_in("dual").backfill()
+
+    assert contents(flat.query("ana")) == ["ana 0", "ana 1"]
+
+
+@pytest.mark.parametrize("mode", ["dual", "partitioned"])
+def test_delete_clears_the_user_from_every_layout(storage_in, add, mode):
+    dual = storage_in("dual")
+    add(dual, "ana", 2)
+    add(dual, "bo", 1)
+
+    assert storage_in(mode).delete("ana") == 2
+
+    for layout in ["flat", "partitioned"]:
+        assert contents(storage_in(layout).query()) == ["bo 0"]
+
+
+def test_cursor_key_resolves_bare_ids(storage_in):
+    assert storage_in("flat").cursor_key("m1") == "dev_messages/m1"
+    assert storage_in("partitioned").cursor_key("m1", "a/b") == "dev_conversations/a%2Fb/dev_user_messages/m1"
+    assert storage_in("partitioned").cursor_key("dev_conversations/ana/dev_user_messages/m1") == "dev_conversations/ana/dev_user_messages/m1"
+    with pytest.raises(ValueError):
+        storage_in("partitioned").cursor_key("m1")
@@ -0,0 +1,228 @@
+import io
+import time
+import inspect
+import pytest
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+from types import SimpleNamespace
+from PIL import Image
+from llama_index.callbacks import CallbackManager
+from prometheus_client import REGISTRY
+from agent import deadlines
+from agent.deadlines import DeadlineExceeded, HedgedOpenAI, HedgedOpenAIEmbedding, LatencyTracker, deadline_seconds, gemini_complete, hedged_call, remaining, request_deadline
+from agent.fanout_retrieval import FanOutQueryEngine
+from agent.image_analysis import ImageAnalyzer
+from monitoring.tracing import TimingCallbackHandler
+from agent.index_loader import query_service_context
+
+
+@pytest.fixture(autouse=True)
+def fresh_latencies(monkeypatch):
+    monkeypatch.setattr(deadlines, "latencies", LatencyTracker())
+
+
+def answer_after(seconds, answer, calls=None):
+    def call(timeout):
+        if calls is not None:
+            calls.append(timeout)
+        time.sleep(seconds)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    return call
+
+
+def test_fast_call_is_not_hedged(monkeypatch):
+    monkeypatch.setattr(deadlines, "LLM_HEDGE_DEFAULT_SECONDS", 0.2)
+    calls = []
+
+    with request_deadline(2):
+        assert hedged_call("test", answer_after(0, "primary", calls)) == "primary"
+
+    assert len(calls) == 1 and 1.9 < calls[0] <= 2
+
+
+def attempts(*calls):
+    """A call whose every attempt is the next of `calls`."""
+    calls = iter(calls)
+    return lambda timeout: next(calls)(timeout)
+
+
+def test_slow_call_is_hedged(monkeypatch):
+    monkeypatch.setattr(deadlines, "LLM_HEDGE_DEFAULT_SECONDS", 0.1)
+
+    start = time.monotonic()
+    with request_deadline(2):
+        answer = hedged_call("test", attempts(answer_after(1, "primary"), answer_after(0, "hedge")))
+
+    assert answer == "hedge"
+    assert time.monotonic() - start < 0.5
+
+
+def test_hedge_waits_for_the_usual_latency(monkeypatch):
+    monkeypatch.setattr(deadlines, "LLM_HEDGE_DEFAULT_SECONDS", 0.01)
+    for _ in range(deadlines.LLM_HEDGE_MIN_SAMPLES):
+        deadlines.latencies.observe("test", 0.5)
+
+    with request_deadline(2):
+        answer = hedged_call("test", attempts(answer_after(0.2, "primary"), answer_after(0, "hedge")))
+
+    assert answer == "primary"
+
+
+def test_fallback_is_kept_time_while_the_call_is_slow(monkeypatch):
+    monkeypatch.setattr(deadlines, "LLM_HEDGE_DEFAULT_SECONDS", 0.2)
+    monkeypatch.setattr(deadlines, "LLM_FALLBACK_MIN_SECONDS", 0.5)
+    fallback_timeouts = []
+
+    with request_deadline(0.9):
+        answer = hedged_call("test", answer_after(2, "primary"), fallback=answer_after(0, "fallback", fallback_timeouts))
+
+    assert answer == "fallback"
+    assert fallback_timeouts[0] >= 0.45
+
+
+def test_little_budget_goes_straight_to_the_fallback(monkeypatch):
+    monkeypatch.setattr(deadlines, "LLM_FALLBACK_MIN_SECONDS", 0.5)
+    calls = []
+
+    with request_deadline(0.3):
+        assert hedged_call("test", answer_after(0, "primary", calls), fallback=answer_after(0, "fallback")) == "fallback"
+
+    assert calls == []
+
+
+def test_failed_call_is_retried_then_reported(monkeypatch):
+    monkeypatch.setattr(deadlines, "LLM_HEDGE_DEFAULT_SECONDS", 1)
+
+    with request_deadline(2):
+        assert hedged_call("test", attempts(answer_after(0, ValueError("down")), answer_after(0, "hedge"))) == "hedge"
+        with pytest.raises(ValueError, match="first"):
+            hedged_call("test", attempts(answer_after(0, ValueError("first")), answer_after(0, ValueError("second"))))
+
+
+def test_failed_call_is_answered_by_the_fallback(monkeypatch):
+    monkeypatch.setattr(deadlines, "LLM_HEDGE_DEFAULT_SECONDS", 0.1)
+    monkeypatch.setattr(deadlines, "LLM_FALLBACK_MIN_SECONDS", 0.5)
+
+    with request_deadline(1):
+        assert hedged_call("test", answer_after(0, ValueError("down")), fallback=answer_after(0, "fallback")) == "fallback"
+
+
+def test_nothing_answering_in_time_raises(monkeypatch):
+    monkeypatch.setattr(deadlines, "LLM_HEDGE_DEFAULT_SECONDS", 0.1)
+
+    with request_deadline(0.3), pytest.raises(DeadlineExceeded):
+        hedged_call("test", answer_after(1, "primary"))
+
+
+def test_nested_deadline_keeps_the_sooner_one():
+    assert remaining() is None
+    with request_deadline(1):
+        with request_deadline(5):
+            assert remaining() <= 1
+        with request_deadline(0.5):
+            assert remaining() <= 0.5
+    assert remaining() is None
+
+
+def test_deadline_header_is_bounded():
+    assert deadline_seconds(None) == deadlines.REQUEST_DEADLINE_SECONDS
+    assert deadline_seconds("abc") == deadlines.REQUEST_DEADLINE_SECONDS
+    assert deadline_seconds("5") == 5
+    assert deadline_seconds("-1") == 0
+    assert deadline_seconds("100000") == deadlines.REQUEST_DEADLINE_MAX_SECONDS
+
+
+def test_latency_percentile_needs_enough_samples():
+    tracker = LatencyTracker(window=10)
+    for seconds in range(20):
+        tracker.observe("chat", seconds)
+
+    assert tracker.percentile("chat", percentile=50, min_samples=5) == 15
+    assert tracker.percentile("chat", min_samples=11) is None
+    assert tracker.percentile("other") is None
+
+
+class FakeGeminiClient:
+    def __init__(self):
+        self.requests = []
+
+    def generate_content(self, request, timeout=None):
+        self.requests.append((request, timeout))
+        return glm.GenerateContentResponse(
+            candidates=[glm.Candidate(content=glm.Content(parts=[glm.Part(text="a calm lake")]))]
+        )
+
+
+def fake_gemini(model_name="gemini-pro"):
+    """Stands in for llama_index's Gemini, which looks the model up over the network when it is created."""
+    model = genai.GenerativeModel(model_name)
+    model._client = FakeGeminiClient()
+    return SimpleNamespace(_model=model, model_name=f"models/{model_name}", callback_manager=CallbackManager([TimingCallbackHandler()]))
+
+
+def test_gemini_request_gets_the_timeout():
+    gemini = fake_gemini()
+
+    assert gemini_complete(gemini, "hi", timeout=3) == "a calm lake"
+
+    request, timeout = gemini._model._client.requests[0]
+    assert timeout == 3
+    assert request.contents[0].parts[0].text == "hi"
+
+
+def test_gemini_call_is_reported_as_an_llm_call():
+    gemini = fake_gemini("gemini-test")
+
+    gemini_complete(gemini, "hi", timeout=3)
+
+    assert REGISTRY.get_sample_value("willow_llm_call_duration_seconds_count", {"model": "models/gemini-test"}) == 1
+
+
+def test_gemini_timeout_still_needs_the_private_path():
+    # once generate_content takes request_options, gemini_complete should use it instead of the client
+    assert "request_options" not in inspect.signature(genai.GenerativeModel.generate_content).parameters
+
+
+def test_image_analysis_gets_the_remaining_budget():
+    gemini = fake_gemini("gemini-pro-vision")
+    image = io.BytesIO()
+    Image.new("RGB", (10, 10)).save(image, format="JPEG")
+
+    with request_deadline(5):
+        assert ImageAnalyzer(gemini=gemini)._describe([image.getvalue()], "describe") == "a calm lake"
+
+    request, timeout = gemini._model._client.requests[0]
+    assert 4 < timeout <= 5
+    assert request.contents[0].parts[1].inline_data.mime_type == "image/jpeg"
+
+
+class FakeEmbeddingsClient:
+    def __init__(self):
+        self.timeouts = []
+        self.embeddings = self
+
+    def create(self, input, model, timeout=None):
+        self.timeouts.append(timeout)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[0.5, 0.5])])
+
+
+def test_query_embedding_gets_the_remaining_budget():
+    embed_model = HedgedOpenAIEmbedding(api_key="sk-test")
+    embed_model._client = FakeEmbeddingsClient()
+
+    with request_deadline(3):
+        assert embed_model.get_query_embedding("I feel anxious") == [0.5, 0.5]
+
+    assert 2.5 < embed_model._client.timeouts[0] <= 3
+
+
+def test_toolbox_engines_use_deadline_aware_models(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    service_context = query_service_context()
+
+    assert isinstance(service_context.llm, HedgedOpenAI)
+    assert isinstance(service_context.embed_model, HedgedOpenAIEmbedding)
+    assert isinstance(FanOutQueryEngine({}).synthesizer._service_context.llm, HedgedOpenAI)
@@ -0,0 +1,65 @@
+import json
+import pytest
+from models.conversation_storage import ConversationStorage
+
+MESSAGES = 5
+
+
+def add_messages(controller, user="ana"):
+    for minute in range(MESSAGES):
+        body = {"type": "image", "content": "", "createdAt": f"2024-01-01T10:0{minute}:00Z"}
+        controller.send_message("dev", user, body)
+
+
+def export(controller, **kwargs):
+    lines, status_code = controller.export_conversation("dev", **kwargs)
+    assert status_code == 200
+    lines = [json.loads(line) for line in lines]
+    return lines[:-1], lines[-1]
+
+
+@pytest.fixture(params=["flat", "partitioned"])
+def mode(request, controller, monkeypatch):
+    def get_storage(env):
+        return ConversationStorage(env, controller.get_message_model(env), controller.get_user_message_model(env), request.param)
+
+    monkeypatch.setattr(controller, "get_storage", get_storage)
+    return request.param
+
+
+def test_export_reads_every_chunk_in_order(controller, mode):
+    add_messages(controller)
+
+    messages, last = export(controller, user="ana", chunk_size=2)
+
+    assert [message["created_at"][:16] for message in messages] == [f"2024-01-01T10:0{minute}" for minute in range(MESSAGES)]
+    assert last["done"] and last["exported"] == MESSAGES
+    assert last["cursor"].startswith("dev_conversations/ana/") == (mode == "partitioned")
+
+
+@pytest.mark.parametrize("cursor_field", ["key", "id"])
+def test_export_resumes_from_a_cursor(controller, mode, cursor_field):
+    add_messages(controller)
+    messages, last = export(controller, user="ana", chunk_size=2)
+    if cursor_field == "key":
+        first, interrupted = export(controller, user="ana", chunk_size=2, end="2024-01-01T10:02:00Z")
+        cursor = interrupted["cursor"]
+    else:
+        cursor = messages[1]["id"]
+
+    rest, last = export(controller, user="ana", chunk_size=2, cursor=cursor)
+
+    assert [message["id"] for message in rest] == [message["id"] for message in messages[2:]]
+    assert last["exported"] == MESSAGES - 2
+
+
+def test_export_of_every_user_needs_a_key_in_the_partitioned_layout(controller, mode):
+    add_messages(controller)
+    messages, last = export(controller)
+
+    result, status_code = controller.export_conversation("dev", cursor=messages[0]["id"])
+
+    if mode == "partitioned":
+        assert status_code == 400
+    else:
+        assert [message["id"] for message in export(controller, cursor=messages[0]["id"])[0]] == [message["id"] for message in messages[1:]]
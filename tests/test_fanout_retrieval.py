@@ -0,0 +1,144 @@
+import time
+import threading
+from llama_index.response.schema import Response
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+from agent.deadlines import request_deadline
+from agent.fanout_retrieval import NO_RESULTS, FanOutQueryEngine
+from agent.query_cache import CachedQueryEngine, SemanticQueryCache
+
+
+class FakeRetriever:
+    def __init__(self, passages, delay=None, error=None, seconds=0):
+        self.passages = passages
+        self.delay = delay
+        self.error = error
+        self.seconds = seconds
+        self.embeddings = []
+
+    def retrieve(self, query_bundle):
+        self.embeddings.append(query_bundle.embedding)
+        if self.delay:
+            self.delay.wait(5)
+        time.sleep(self.seconds)
+        if self.error:
+            raise self.error
+        return [
+            NodeWithScore(node=TextNode(text=text, metadata={"page_label": str(page)}), score=score)
+            for text, page, score in self.passages
+        ]
+
+
+class FakeEmbedModel:
+    def __init__(self):
+        self.calls = 0
+
+    def get_query_embedding(self, text):
+        self.calls += 1
+        return [1.0, 0.0]
+
+
+class FakeSynthesizer:
+    def synthesize(self, query_bundle, nodes):
+        return Response(" | ".join(node.node.get_content() for node in nodes), source_nodes=nodes)
+
+
+def engine(retrievers, **kwargs):
+    fanout = FanOutQueryEngine({name: None for name in retrievers}, embed_model=FakeEmbedModel(), **kwargs)
+    fanout._retrievers = retrievers
+    fanout._synthesizer = FakeSynthesizer()
+    return fanout
+
+
+def test_passages_from_every_book_are_merged_by_score():
+    fanout = engine({
+        "challenging_child": FakeRetriever([("set a routine", 3, 0.7), ("name the feeling", 8, 0.9)]),
+        "mindfulness_TB_50": FakeRetriever([("breathe slowly", 12, 0.8)]),
+    }, top_k=2)
+
+    response = fanout.query("my son has tantrums")
+
+    assert response.response.startswith("name the feeling | breathe slowly")
+    assert "Sources: The Challenging Child Toolbox, p. 8; The Mindfulness Toolbox: 50" in response.response
+
+
+def test_same_passage_in_two_books_is_kept_once():
+    fanout = engine({
+        "mindfulness_TB_50": FakeRetriever([("breathe slowly", 12, 0.8)]),
+        "mindfulness_TB_relationships": FakeRetriever([("breathe slowly", 40, 0.6)]),
+    })
+
+    nodes = fanout.retrieve(QueryBundle("I feel anxious"))
+
+    assert len(nodes) == 1
+    assert nodes[0].node.metadata["source"].endswith("p. 12")
+
+
+def test_slow_or_failing_index_is_left_out():
+    release = threading.Event()
+    fanout = engine({
+        "challenging_child": FakeRetriever([("set a routine", 3, 0.7)], delay=release),
+        "mindfulness_TB_50": FakeRetriever([], error=RuntimeError("index unavailable")),
+        "mindfulness_TB_relationships": FakeRetriever([("listen first", 5, 0.5)]),
+    }, timeout=0.1)
+
+    nodes = fanout.retrieve(QueryBundle("we keep arguing"))
+    release.set()
+
+    assert [node.node.get_content() for node in nodes] == ["listen first"]
+
+
+def test_every_index_has_its_own_budget():
+    release = threading.Event()
+    fanout = engine({
+        "challenging_child": FakeRetriever([("set a routine", 3, 0.7)], delay=release),
+        "mindfulness_TB_relationships": FakeRetriever([("listen first", 5, 0.5)], seconds=0.3),
+    }, timeout=1, timeouts={"challenging_child": 0.1})
+
+    start = time.monotonic()
+    nodes = fanout.retrieve(QueryBundle("we keep arguing"))
+    release.set()
+
+    # the slow book only lost its own passages, the other one had the time it was given
+    assert [node.node.get_content() for node in nodes] == ["listen first"]
+    assert time.monotonic() - start < 0.9
+
+
+def test_index_budget_is_cut_to_the_request_deadline():
+    fanout = engine({
+        "challenging_child": FakeRetriever([("set a routine", 3, 0.7)], seconds=0.5),
+        "mindfulness_TB_relationships": FakeRetriever([("listen first", 5, 0.5)]),
+    }, timeout=5)
+
+    start = time.monotonic()
+    with request_deadline(0.2):
+        nodes = fanout.retrieve(QueryBundle("we keep arguing"))
+
+    assert [node.node.get_content() for node in nodes] == ["listen first"]
+    assert time.monotonic() - start < 0.45
+
+
+def test_nothing_found_answers_without_synthesis():
+    fanout = engine({"challenging_child": FakeRetriever([])})
+
+    assert fanout.query("anything").response == NO_RESULTS
+
+
+def test_query_is_embedded_once_for_every_index():
+    retrievers = {name: FakeRetriever([]) for name in ["challenging_child", "mindfulness_TB_50"]}
+    fanout = engine(retrievers)
+
+    fanout.retrieve(QueryBundle("I feel anxious"))
+
+    assert fanout.embed_model.calls == 1
+    assert all(retriever.embeddings == [[1.0, 0.0]] for retriever in retrievers.values())
+
+
+def test_cached_fanout_uses_the_cache_embedding():
+    retrievers = {"challenging_child": FakeRetriever([("set a routine", 3, 0.7)])}
+    fanout = engine(retrievers)
+    cached = CachedQueryEngine(fanout, SemanticQueryCache(embed_fn=lambda text: [0.0, 1.0]))
+
+    cached.query("my son has tantrums")
+
+    assert fanout.embed_model.calls == 0
+    assert retrievers["challenging_child"].embeddings == [[0.0, 1.0]]
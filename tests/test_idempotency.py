@@ -0,0 +1,123 @@
+import threading
+import time
+import pytest
+from controllers.idempotency import COALESCED, EXECUTED, REPLAYED, IdempotentRequests, request_idempotency_key
+
+BODY = {"type": "text", "content": "hi", "createdAt": "2024-01-01T10:00:00Z"}
+
+
+def test_key_comes_from_the_header_or_the_message():
+    assert request_idempotency_key("sendMessage", "dev", "ana", {"content": "hi"}) is None
+    assert request_idempotency_key("sendMessage", "dev", "ana", BODY) == request_idempotency_key("sendMessage", "dev", "ana", dict(BODY))
+    assert request_idempotency_key("sendMessage", "dev", "ana", BODY) != request_idempotency_key("sendMessage", "dev", "bo", BODY)
+    assert request_idempotency_key("sendMessage", "dev", "ana", BODY, "k1") != request_idempotency_key("sendMessage", "dev", "ana", BODY)
+
+
+def test_duplicate_of_a_running_request_shares_its_result():
+    requests = IdempotentRequests()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def send():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return {"ok": True}, 200
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(requests.run("k", send)))
+    first.start()
+    started.wait()
+    second = threading.Thread(target=lambda: results.append(requests.run("k", send)))
+    second.start()
+    time.sleep(0.05)
+    release.set()
+    first.join()
+    second.join()
+
+    assert len(calls) == 1
+    assert sorted(outcome for result, outcome in results) == [COALESCED, EXECUTED]
+    assert requests.run("k", send) == (({"ok": True}, 200), REPLAYED)
+
+
+def test_server_errors_run_again():
+    requests = IdempotentRequests()
+    results = iter([({"error": "boom"}, 502), ({"ok": True}, 200)])
+
+    assert requests.run("k", lambda: next(results)) == (({"error": "boom"}, 502), EXECUTED)
+    assert requests.run("k", lambda: next(results)) == (({"ok": True}, 200), EXECUTED)
+
+
+def test_exception_is_not_kept():
+    requests = IdempotentRequests()
+
+    with pytest.raises(ZeroDivisionError):
+        requests.run("k", lambda: 1 / 0)
+
+    assert requests.run("k", lambda: ({}, 200)) == (({}, 200), EXECUTED)
+
+
+def test_result_without_a_status_doesnt_leave_the_key_running():
+    requests = IdempotentRequests()
+
+    with pytest.raises(TypeError):
+        requests.run("k", lambda: {"status": "no status code"})
+
+    assert requests.stats()["running"] == 0
+    assert requests.run("k", lambda: ({}, 200)) == (({}, 200), EXECUTED)
+
+
+def test_results_expire_and_are_bounded():
+    requests = IdempotentRequests(ttl_seconds=0.05, max_entries=2)
+    for key in ["a", "b", "c"]:
+        requests.run(key, lambda: ({}, 200))
+    assert requests.stats()["replayable"] == 2
+
+    time.sleep(0.06)
+    assert requests.run("c", lambda: ({}, 201)) == (({}, 201), EXECUTED)
+
+
+def test_clear_forgets_only_one_conversation():
+    requests = IdempotentRequests()
+    scopes = {"ana": ("dev", "ana"), "bo": ("dev", "bo"), "prod": ("prod", "ana")}
+
+    def send_all():
+        return [requests.run(key, lambda: ({}, 200), scope=scope)[1] for key, scope in scopes.items()]
+
+    send_all()
+    requests.clear("dev", "ana")
+    assert send_all() == [EXECUTED, REPLAYED, REPLAYED]
+
+    requests.clear("dev")
+    assert send_all() == [EXECUTED, EXECUTED, REPLAYED]
+
+
+def test_retried_send_is_replayed(client, controller):
+    first = client.post("/api/sendMessage?env=dev&user=ana", json=BODY)
+    retry = client.post("/api/sendMessage?env=dev&user=ana", json=BODY)
+
+    assert first.status_code == retry.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.get_json() == first.get_json()
+    assert len(list(controller.get_storage("dev").query("ana").fetch())) == 2
+
+
+def test_failed_agent_reply_is_a_bad_gateway(client, controller):
+    controller.agent_sessions.get_agent("dev", "ana").chat = lambda message: 1 / 0
+
+    response = client.post("/api/sendMessage?env=dev&user=ana", json=BODY)
+
+    assert response.status_code == 502
+    assert response.get_json()["userMessage"]["content"] == "hi"
+    assert "Idempotent-Replayed" not in client.post("/api/sendMessage?env=dev&user=ana", json=BODY).headers
+
+
+def test_deleting_a_conversation_forgets_its_sends(client, controller):
+    client.post("/api/sendMessage?env=dev&user=ana", json=BODY)
+    client.post("/api/sendMessage?env=dev&user=bo", json=BODY)
+
+    client.delete("/api/conversation?env=dev&user=ana")
+
+    assert "Idempotent-Replayed" not in client.post("/api/sendMessage?env=dev&user=ana", json=BODY).headers
+    assert client.post("/api/sendMessage?env=dev&user=bo", json=BODY).headers["Idempotent-Replayed"] == "true"
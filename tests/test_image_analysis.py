@@ -0,0 +1,103 @@
+import io
+import threading
+import pytest
+from PIL import Image
+from agent.image_analysis import ImageAnalyzer, downscale
+
+
+def jpeg(width, height, color="red"):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(output, format="JPEG")
+    return output.getvalue()
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, images):
+        self.images = images
+        self.timeouts = []
+
+    def get(self, url, timeout=None):
+        self.timeouts.append(timeout)
+        return FakeResponse(self.images[url])
+
+
+class RecordingAnalyzer(ImageAnalyzer):
+    def __init__(self, images, release=None, **kwargs):
+        super().__init__(gemini=object(), session=FakeSession(images), **kwargs)
+        self.described = []
+        self.release = release
+        self.started = threading.Event()
+
+    def _describe(self, images, prompt):
+        self.described.append(images)
+        self.started.set()
+        if self.release:
+            self.release.wait(5)
+        if prompt == "fail":
+            raise ValueError("vision unavailable")
+        return f"description {len(self.described)}"
+
+
+def test_large_image_is_downscaled_to_a_jpeg():
+    downscaled = Image.open(io.BytesIO(downscale(jpeg(4000, 2000), max_dimension=1024)))
+
+    assert downscaled.format == "JPEG"
+    assert downscaled.size == (1024, 512)
+
+
+def test_image_with_alpha_is_converted():
+    output = io.BytesIO()
+    Image.new("RGBA", (10, 10)).save(output, format="PNG")
+
+    assert Image.open(io.BytesIO(downscale(output.getvalue()))).mode == "RGB"
+
+
+def test_same_image_from_another_url_is_analyzed_once():
+    image = jpeg(20, 20)
+    analyzer = RecordingAnalyzer({"a": image, "b": image, "c": jpeg(20, 20, "blue")})
+
+    assert analyzer.analyze(["a"]) == analyzer.analyze(["b"]) == "description 1"
+    assert analyzer.analyze(["c"]) == "description 2"
+    assert len(analyzer.described) == 2
+
+
+def test_cache_keeps_the_most_recent_images():
+    analyzer = RecordingAnalyzer({color: jpeg(20, 20, color) for color in ["red", "blue", "green"]}, cache_size=2)
+    for color in ["red", "blue", "green", "red"]:
+        analyzer.analyze([color])
+
+    assert len(analyzer.described) == 4
+
+
+def test_concurrent_requests_for_one_image_share_the_analysis():
+    release = threading.Event()
+    analyzer = RecordingAnalyzer({"a": jpeg(20, 20)}, release=release)
+    results = []
+    first = threading.Thread(target=lambda: results.append(analyzer.analyze(["a"])))
+    first.start()
+    analyzer.started.wait(5)
+    second = threading.Thread(target=lambda: results.append(analyzer.analyze(["a"])))
+    second.start()
+
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert results == ["description 1", "description 1"]
+    assert len(analyzer.described) == 1
+
+
+def test_failed_analysis_is_not_cached():
+    analyzer = RecordingAnalyzer({"a": jpeg(20, 20)})
+
+    with pytest.raises(ValueError):
+        analyzer.analyze(["a"], prompt="fail")
+    assert analyzer.analyze(["a"]) == "description 2"
@@ -0,0 +1,166 @@
+import os
+import json
+import threading
+import pytest
+from agent import index_loader
+from agent.index_loader import IndexManifestError, LazyIndex, verify_index, write_manifest_entry
+
+
+@pytest.fixture
+def store(tmp_path):
+    persist_dir = tmp_path / "store"
+    persist_dir.mkdir()
+    (persist_dir / "docstore.json").write_text('{"docs": 1}')
+    (persist_dir / "vectors.npy").write_bytes(b"\0" * 64)
+    manifest = tmp_path / "manifest.json"
+    write_manifest_entry("book", str(persist_dir), str(manifest))
+    return persist_dir, manifest
+
+
+def count_hashes(monkeypatch):
+    hashed = []
+    hash_file = index_loader.hash_file
+
+    def counting(file_path, *digests):
+        hashed.append(os.path.basename(file_path))
+        return hash_file(file_path, *digests)
+
+    monkeypatch.setattr(index_loader, "hash_file", counting)
+    return hashed
+
+
+def test_unchanged_store_is_verified_without_reading_it(store, monkeypatch):
+    persist_dir, manifest = store
+    hashed = count_hashes(monkeypatch)
+
+    entry = verify_index("book", str(persist_dir), str(manifest))
+
+    assert hashed == []
+    assert set(entry["files"]) == {"docstore.json", "vectors.npy"}
+
+
+def test_touched_file_is_hashed_and_accepted(store, monkeypatch):
+    persist_dir, manifest = store
+    hashed = count_hashes(monkeypatch)
+    stat = os.stat(persist_dir / "vectors.npy")
+    os.utime(persist_dir / "vectors.npy", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    verify_index("book", str(persist_dir), str(manifest))
+
+    assert hashed == ["vectors.npy"]
+
+
+def test_changed_content_is_rejected(store):
+    persist_dir, manifest = store
+    stat = os.stat(persist_dir / "vectors.npy")
+    (persist_dir / "vectors.npy").write_bytes(b"\1" * 64)
+    os.utime(persist_dir / "vectors.npy", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    with pytest.raises(IndexManifestError, match="vectors.npy does not match its manifest content hash"):
+        verify_index("book", str(persist_dir), str(manifest))
+
+
+def test_changed_size_is_rejected(store):
+    persist_dir, manifest = store
+    (persist_dir / "docstore.json").write_text('{"docs": 2, "more": true}')
+
+    with pytest.raises(IndexManifestError, match="size"):
+        verify_index("book", str(persist_dir), str(manifest))
+
+
+def test_missing_file_is_rejected(store):
+    persist_dir, manifest = store
+    os.remove(persist_dir / "docstore.json")
+
+    with pytest.raises(IndexManifestError, match="missing docstore.json"):
+        verify_index("book", str(persist_dir), str(manifest))
+
+
+def test_verify_content_hashes_every_file(store, monkeypatch):
+    persist_dir, manifest = store
+    hashed = count_hashes(monkeypatch)
+
+    verify_index("book", str(persist_dir), str(manifest), verify_content=True)
+
+    assert sorted(hashed) == ["docstore.json", "vectors.npy"]
+
+
+def test_entry_without_file_list_falls_back_to_the_content_hash(store):
+    persist_dir, manifest = store
+    data = json.loads(manifest.read_text())
+    del data["indexes"]["book"]["files"]
+    manifest.write_text(json.dumps(data))
+
+    verify_index("book", str(persist_dir), str(manifest))
+
+    (persist_dir / "docstore.json").write_text('{"docs": 2}')
+    with pytest.raises(IndexManifestError, match="content hash"):
+        verify_index("book", str(persist_dir), str(manifest))
+
+
+def test_store_embedded_with_another_model_is_rejected(store, monkeypatch):
+    persist_dir, manifest = store
+    monkeypatch.setattr(index_loader, "EMBED_MODEL", "text-embedding-3-small")
+
+    with pytest.raises(IndexManifestError, match="embedded with"):
+        verify_index("book", str(persist_dir), str(manifest))
+
+
+def test_missing_store_is_rejected(tmp_path):
+    with pytest.raises(IndexManifestError, match="no store"):
+        verify_index("book", str(tmp_path / "nowhere"), str(tmp_path / "manifest.json"))
+
+
+def test_store_without_manifest_entry_loads(store, tmp_path):
+    persist_dir, _ = store
+    assert verify_index("book", str(persist_dir), str(tmp_path / "other.json")) is None
+
+
+def test_unsupported_manifest_version_is_rejected(store):
+    persist_dir, manifest = store
+    manifest.write_text(json.dumps({"version": 99, "indexes": {}}))
+
+    with pytest.raises(IndexManifestError, match="version"):
+        verify_index("book", str(persist_dir), str(manifest))
+
+
+def test_background_index_starts_loading_right_away(monkeypatch):
+    release = threading.Event()
+    loaded = []
+
+    def load_index(name):
+        loaded.append(name)
+        release.wait(5)
+        return f"index {name}"
+
+    monkeypatch.setattr(index_loader, "load_index", load_index)
+    lazy_index = LazyIndex("challenging_child", background=True)
+
+    assert not lazy_index.ready()
+    release.set()
+    assert lazy_index.get() == "index challenging_child"
+    assert lazy_index.ready()
+    assert loaded == ["challenging_child"]
+
+
+def test_on_demand_index_loads_on_first_use(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(index_loader, "load_index", lambda name: loaded.append(name) or name)
+    lazy_index = LazyIndex("challenging_child", background=False)
+
+    assert loaded == []
+    assert lazy_index.get() == "challenging_child"
+    assert lazy_index.get() == "challenging_child"
+    assert loaded == ["challenging_child"]
+
+
+def test_failed_load_is_raised_to_the_caller(monkeypatch):
+    def load_index(name):
+        raise IndexManifestError("broken")
+
+    monkeypatch.setattr(index_loader, "load_index", load_index)
+    lazy_index = LazyIndex("challenging_child", background=True)
+
+    with pytest.raises(IndexManifestError):
+        lazy_index.get()
+    assert not lazy_index.ready()
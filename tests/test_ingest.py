@@ -0,0 +1,142 @@
+import json
+import time
+import pytest
+from llama_index.schema import Document
+from agent import ingest
+from agent.ingest import Checkpoint, RateLimiter, download, embed_pages
+
+SETTINGS = {"source_sha256": "abc", "chunk_size": 1024}
+PAGES = 7
+
+
+def fake_pages(path, start_page=0):
+    for page_number in range(start_page, PAGES):
+        yield page_number, Document(text=f"page {page_number} text", metadata={"page_label": str(page_number + 1)})
+
+
+class FakeEmbedModel:
+    def __init__(self, fail_on_call=None):
+        self.calls = []
+        self.fail_on_call = fail_on_call
+
+    def get_text_embedding_batch(self, texts):
+        self.calls.append(texts)
+        if len(self.calls) == self.fail_on_call:
+            raise ConnectionError("rate limited")
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def run(tmp_path, embed_model):
+    checkpoint = Checkpoint(str(tmp_path))
+    checkpoint.load(SETTINGS)
+    embed_pages("book", "source.pdf", checkpoint, embed_model, batch_size=2, concurrency=1, requests_per_minute=0)
+    return checkpoint
+
+
+def node_ids(tmp_path):
+    with open(tmp_path / "nodes.jsonl") as nodes_file:
+        return [json.loads(line)["id_"] for line in nodes_file]
+
+
+@pytest.fixture(autouse=True)
+def pages(monkeypatch):
+    monkeypatch.setattr(ingest, "iter_pages", fake_pages)
+
+
+def test_rate_limiter_spaces_calls():
+    limiter = RateLimiter(per_minute=1200)
+    start = time.monotonic()
+    for _ in range(4):
+        limiter.acquire()
+
+    assert time.monotonic() - start >= 0.14
+
+
+def test_every_page_is_embedded_and_checkpointed(tmp_path):
+    checkpoint = run(tmp_path, FakeEmbedModel())
+
+    assert checkpoint.state["pages_done"] == PAGES
+    assert node_ids(tmp_path) == [f"book-page-{page}-chunk-0" for page in range(PAGES)]
+
+
+def test_interrupted_run_resumes_after_the_last_written_batch(tmp_path):
+    with pytest.raises(ConnectionError):
+        run(tmp_path, FakeEmbedModel(fail_on_call=3))
+    assert Checkpoint(str(tmp_path)).load(SETTINGS)["pages_done"] == 4
+
+    resumed = FakeEmbedModel()
+    run(tmp_path, resumed)
+
+    # only the pages after the checkpoint are embedded again
+    assert [text.split("\n")[-1] for texts in resumed.calls for text in texts] == [f"page {page} text" for page in range(4, PAGES)]
+    assert node_ids(tmp_path) == [f"book-page-{page}-chunk-0" for page in range(PAGES)]
+
+
+def test_partial_line_after_the_checkpoint_is_dropped(tmp_path):
+    run(tmp_path, FakeEmbedModel())
+    size = (tmp_path / "nodes.jsonl").stat().st_size
+    with open(tmp_path / "nodes.jsonl", "a") as nodes_file:
+        nodes_file.write('{"id_": "half a no')
+
+    Checkpoint(str(tmp_path)).load(SETTINGS)
+
+    assert (tmp_path / "nodes.jsonl").stat().st_size == size
+
+
+def test_checkpoint_with_other_settings_starts_over(tmp_path):
+    run(tmp_path, FakeEmbedModel())
+
+    state = Checkpoint(str(tmp_path)).load({**SETTINGS, "source_sha256": "def"})
+
+    assert state["pages_done"] == 0
+    assert (tmp_path / "nodes.jsonl").stat().st_size == 0
+
+
+class FakeDownload:
+    def __init__(self, body, honors_range=True):
+        self.body = body
+        self.honors_range = honors_range
+        self.headers = []
+
+    def __call__(self, url, stream=False, headers=None, timeout=None):
+        self.headers.append(headers)
+        offset = int(headers["Range"][len("bytes="):-1]) if headers and self.honors_range else 0
+        download = self
+
+        class Response:
+            status_code = 206 if offset else 200
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def raise_for_status(self):
+                pass
+
+            def iter_content(self, chunk_size):
+                yield download.body[offset:]
+
+        return Response()
+
+
+def test_download_continues_a_partial_file(tmp_path, monkeypatch):
+    fake = FakeDownload(b"0123456789")
+    monkeypatch.setattr(ingest.requests, "get", fake)
+    (tmp_path / "source.pdf.part").write_bytes(b"0123")
+
+    download("https://example.com/book.pdf", str(tmp_path / "source.pdf"))
+
+    assert fake.headers == [{"Range": "bytes=4-"}]
+    assert (tmp_path / "source.pdf").read_bytes() == b"0123456789"
+    assert not (tmp_path / "source.pdf.part").exists()
+
+
+def test_download_starts_over_when_the_range_is_ignored(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest.requests, "get", FakeDownload(b"0123456789", honors_range=False))
+    (tmp_path / "source.pdf.part").write_bytes(b"0123")
+
+    download("https://example.com/book.pdf", str(tmp_path / "source.pdf"))
+
+    assert (tmp_path / "source.pdf").read_bytes() == b"0123456789"
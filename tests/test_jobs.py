@@ -0,0 +1,116 @@
+import io
+import time
+import threading
+import pytest
+from bench.fakes import FakeBucket
+from controllers import bucket
+from controllers.jobs import DONE, FAILED, JobQueue
+from conftest import REPLY
+
+
+def test_job_result_is_kept_for_polling():
+    jobs = JobQueue(max_workers=1)
+
+    job = jobs.wait(jobs.submit(lambda a, b: a + b, 1, 2), timeout=5)
+
+    assert job.status == DONE
+    assert job.result == 3
+    assert job.to_dict()["status"] == DONE
+
+
+def test_failed_job_keeps_its_error():
+    jobs = JobQueue(max_workers=1)
+
+    job = jobs.wait(jobs.submit(lambda: 1 / 0), timeout=5)
+
+    assert job.status == FAILED
+    assert job.error == "division by zero"
+
+
+def test_job_reports_progress():
+    jobs = JobQueue(max_workers=1)
+    reported = threading.Event()
+    release = threading.Event()
+
+    def work(report):
+        report({"deleted": 10})
+        reported.set()
+        release.wait(5)
+        return "ok"
+
+    job_id = jobs.submit_with_progress(work)
+    reported.wait(5)
+    assert jobs.get(job_id).progress == {"deleted": 10}
+    release.set()
+    assert jobs.wait(job_id, timeout=5).result == "ok"
+
+
+def test_finished_jobs_are_pruned():
+    jobs = JobQueue(max_workers=1, max_jobs=2, ttl_seconds=60)
+    job_ids = [jobs.submit(lambda: None) for _ in range(2)]
+    for job_id in job_ids:
+        jobs.wait(job_id, timeout=5)
+
+    jobs.submit(lambda: None)
+
+    assert jobs.get(job_ids[0]) is None
+
+    expiring = JobQueue(max_workers=1, ttl_seconds=0)
+    job_id = expiring.submit(lambda: None)
+    expiring.wait(job_id, timeout=5)
+    time.sleep(0.01)
+    expiring.submit(lambda: None)
+    assert expiring.get(job_id) is None
+
+
+@pytest.fixture
+def fake_bucket(monkeypatch):
+    fake = FakeBucket()
+    monkeypatch.setattr(bucket, "_bucket", fake)
+    return fake
+
+
+@pytest.fixture
+def jobs(controller, monkeypatch):
+    jobs = JobQueue(max_workers=1)
+    monkeypatch.setattr(controller, "background_jobs", jobs)
+    return jobs
+
+
+def test_async_file_is_uploaded_then_analyzed_in_a_job(client, fake_bucket, jobs):
+    response = client.post(
+        "/api/sendFile?contentId=drawing-1&env=dev&user=ana&async=true",
+        data=b"\0" * 4096,
+        content_type="image/jpeg",
+    )
+
+    assert response.status_code == 202
+    assert fake_bucket.uploads["drawing-1"] == {"size": 4096, "content_type": "image/jpeg"}
+    job = jobs.wait(response.get_json()["jobId"], timeout=5)
+    assert job.status == DONE
+    assert job.result["agentResponse"]["content"] == REPLY
+
+    response = client.get(f"/api/jobs/{job.id}")
+    assert response.get_json()["job"]["status"] == DONE
+
+
+def test_multipart_file_is_analyzed_before_answering(client, fake_bucket, jobs):
+    response = client.post(
+        "/api/sendFile?contentId=drawing-2&env=dev&user=ana",
+        data={"file": (io.BytesIO(b"\0" * 100), "drawing.jpg", "image/jpeg")},
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 200
+    assert response.get_json()["agentResponse"]["content"] == REPLY
+    assert fake_bucket.uploads["drawing-2"]["size"] == 100
+
+
+def test_job_events_end_with_the_outcome(client, jobs):
+    job_id = jobs.submit(lambda: {"agentResponse": "ok"})
+    jobs.wait(job_id, timeout=5)
+
+    body = client.get(f"/api/jobs/{job_id}/events").get_data(as_text=True)
+
+    assert body.startswith("event: done\n")
+    assert client.get("/api/jobs/missing/events").status_code == 404
@@ -0,0 +1,157 @@
+import time
+import threading
+import pytest
+from bench.fakes import FakeFireo, fake_message_model
+from models import message_store
+from models.message_store import MessageWriter, delete_messages
+
+
+class CountingFireo(FakeFireo):
+    def __init__(self, fail=0):
+        super().__init__()
+        self.commits = []
+        self.fail = fail
+        self.committed = threading.Event()
+
+    def batch(self):
+        fireo = self
+        batch = super().batch()
+        commit = batch.commit
+
+        def counted():
+            if fireo.fail:
+                fireo.fail -= 1
+                raise ConnectionError("firestore unavailable")
+            fireo.commits.append(len(batch._writes))
+            commit()
+            fireo.committed.set()
+
+        batch.commit = counted
+        return batch
+
+
+@pytest.fixture
+def fireo(monkeypatch):
+    fake = CountingFireo()
+    monkeypatch.setattr(message_store, "fireo", fake)
+    return fake
+
+
+@pytest.fixture
+def Messages():
+    return fake_message_model("DevMessages")
+
+
+def messages(Messages, count):
+    return [Messages() for _ in range(count)]
+
+
+def test_without_write_behind_every_save_is_written(fireo, Messages):
+    writer = MessageWriter(write_behind=False)
+
+    message = writer.save(Messages())
+
+    assert len(list(Messages.collection.fetch())) == 1
+    assert message.id
+    assert fireo.commits == []
+
+
+def test_saves_are_committed_once_a_batch_is_full(fireo, Messages):
+    writer = MessageWriter(write_behind=True, batch_size=3, flush_seconds=60)
+
+    saved = [writer.save(message) for message in messages(Messages, 3)]
+
+    assert fireo.committed.wait(5)
+    assert fireo.commits == [3]
+    # ids are given before the commit, so they can be returned right away
+    assert {message.id for message in saved} == {message.id for message in Messages.collection.fetch()}
+    writer.close()
+
+
+def test_pending_saves_are_committed_every_interval(fireo, Messages):
+    writer = MessageWriter(write_behind=True, batch_size=100, flush_seconds=0.05)
+
+    writer.save(Messages())
+
+    assert fireo.committed.wait(5)
+    assert fireo.commits == [1]
+    writer.close()
+
+
+def test_close_commits_what_is_left(fireo, Messages):
+    writer = MessageWriter(write_behind=True, batch_size=100, flush_seconds=60)
+    for message in messages(Messages, 2):
+        writer.save(message)
+
+    writer.close()
+
+    assert len(list(Messages.collection.fetch())) == 2
+
+
+def test_failed_commit_is_retried_on_the_next_flush(monkeypatch, Messages):
+    fireo = CountingFireo(fail=1)
+    monkeypatch.setattr(message_store, "fireo", fireo)
+    writer = MessageWriter(write_behind=True, batch_size=100, flush_seconds=60, retry_seconds=0)
+    for message in messages(Messages, 2):
+        writer.save(message)
+
+    assert writer.flush() == 0
+    assert writer.flush() == 2
+    assert len(list(Messages.collection.fetch())) == 2
+    writer.close()
+
+
+def test_failed_commit_backs_off_before_it_is_retried(monkeypatch, Messages):
+    monkeypatch.setattr(message_store, "fireo", CountingFireo(fail=1))
+    writer = MessageWriter(write_behind=True, batch_size=100, flush_seconds=60, retry_seconds=0.1)
+    writer.save(Messages())
+
+    assert writer.flush() == 0
+    assert writer.flush() == 0
+    time.sleep(0.1)
+    assert writer.flush() == 1
+    writer.close()
+
+
+def test_batch_that_keeps_failing_is_saved_one_by_one(monkeypatch, Messages):
+    monkeypatch.setattr(message_store, "fireo", CountingFireo(fail=100))
+    writer = MessageWriter(write_behind=True, batch_size=100, flush_seconds=60, max_retries=2, retry_seconds=0)
+    rejected = Messages()
+    rejected.save = lambda batch=None: 1 / 0
+    for message in [*messages(Messages, 2), rejected]:
+        writer.save(message)
+
+    assert [writer.flush() for _ in range(3)] == [0, 0, 2]
+
+    # the rejected message was dropped instead of being queued again
+    assert writer.flush() == 0
+    assert len(list(Messages.collection.fetch())) == 2
+
+
+def test_large_saves_are_split_into_firestore_sized_batches(fireo, Messages):
+    MessageWriter(write_behind=False).save_many(messages(Messages, message_store.FIRESTORE_BATCH_LIMIT + 1))
+
+    assert fireo.commits == [message_store.FIRESTORE_BATCH_LIMIT, 1]
+
+
+def test_delete_messages_deletes_matches_in_chunks(fireo, Messages):
+    for i, message in enumerate(messages(Messages, 7)):
+        message.conversation_user = "ana" if i < 5 else "ben"
+        message.save()
+    reports = []
+
+    deleted = delete_messages(
+        Messages, Messages.collection.filter("conversation_user", "==", "ana"), chunk_size=2, workers=2, report=reports.append
+    )
+
+    assert deleted == 5
+    assert reports[-1] == {"deleted": 5}
+    assert [message.conversation_user for message in Messages.collection.fetch()] == ["ben", "ben"]
+
+
+def test_delete_messages_without_query_empties_the_collection(fireo, Messages):
+    for message in messages(Messages, 3):
+        message.save()
+
+    assert delete_messages(Messages) == 3
+    assert list(Messages.collection.fetch()) == []
@@ -0,0 +1,52 @@
+import os
+import sys
+import subprocess
+from monitoring import metrics
+from monitoring.metrics import IDEMPOTENT_REQUESTS, REQUEST_DURATION, mark_process_dead, render_metrics
+
+WORKER = """
+import os
+from monitoring.metrics import IDEMPOTENT_REQUESTS, REQUEST_DURATION
+IDEMPOTENT_REQUESTS.labels(route="sendMessage", outcome="replayed").inc(2)
+REQUEST_DURATION.labels(route="/api/sendMessage", method="POST", status=200).observe(0.05)
+print(os.getpid())
+"""
+
+
+def run_worker(directory):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(directory)}
+    done = subprocess.run([sys.executable, "-c", WORKER], env=env, check=True, timeout=120, capture_output=True, text=True)
+    return int(done.stdout.split()[-1])
+
+
+def test_metrics_of_this_process_are_rendered():
+    IDEMPOTENT_REQUESTS.labels(route="getAgentResponse", outcome='a"b').inc()
+
+    lines = render_metrics(None).decode().splitlines()
+
+    assert 'willow_idempotent_requests_total{outcome="a\\"b",route="getAgentResponse"} 1.0' in lines
+    assert "# TYPE willow_request_duration_seconds histogram" in lines
+
+
+def test_scrape_sums_every_worker(tmp_path):
+    run_worker(tmp_path)
+    run_worker(tmp_path)
+
+    lines = render_metrics(str(tmp_path)).decode().splitlines()
+
+    assert 'willow_idempotent_requests_total{outcome="replayed",route="sendMessage"} 4.0' in lines
+    assert 'willow_request_duration_seconds_bucket{le="0.05",method="POST",route="/api/sendMessage",status="200"} 2.0' in lines
+    assert 'willow_request_duration_seconds_count{method="POST",route="/api/sendMessage",status="200"} 2.0' in lines
+
+
+def test_exited_worker_is_still_counted(tmp_path):
+    mark_process_dead(run_worker(tmp_path), str(tmp_path))
+
+    assert 'willow_idempotent_requests_total{outcome="replayed",route="sendMessage"} 2.0' in render_metrics(str(tmp_path)).decode().splitlines()
+
+
+def test_metrics_route_uses_the_exposition_content_type(client):
+    response = client.get("/metrics")
+
+    assert response.headers["Content-Type"] == metrics.CONTENT_TYPE_LATEST
+    assert b"# TYPE willow_request_duration_seconds histogram" in response.data
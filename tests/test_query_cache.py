@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+from llama_index.core.base_query_engine import BaseQueryEngine
+from llama_index.response.schema import Response
+from llama_index.schema import NodeWithScore, TextNode
+from agent import query_cache
+from agent.query_cache import CachedQueryEngine, SemanticQueryCache, cached_query_engine, response_size
+
+BEDTIME = "How do I calm my child down at bedtime?"
+MORNING = "How do I calm my child down in the morning?"
+BEDTIME_REWORDED = "how can I calm my child down at bedtime"
+
+
+def unit(angle):
+    return [float(np.cos(angle)), float(np.sin(angle)), 0.0]
+
+
+# cosine similarities to BEDTIME: about 0.96 for MORNING, 0.995 for the rewording
+EMBEDDINGS = {BEDTIME: unit(0.0), MORNING: unit(0.28), BEDTIME_REWORDED: unit(0.1)}
+
+
+class Embedder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text):
+        self.calls.append(text)
+        return EMBEDDINGS[text]
+
+
+class RecordingEngine(BaseQueryEngine):
+    def __init__(self):
+        super().__init__(callback_manager=None)
+        self.bundles = []
+
+    def _get_prompt_modules(self):
+        return {}
+
+    def _query(self, query_bundle):
+        self.bundles.append(query_bundle)
+        return Response(f"answer to {query_bundle.query_str}", source_nodes=[])
+
+    async def _aquery(self, query_bundle):
+        return self._query(query_bundle)
+
+
+def test_near_paraphrase_about_another_situation_is_a_miss():
+    cache = SemanticQueryCache(embed_fn=Embedder())
+    response, key, embedding = cache.lookup(BEDTIME)
+    cache.store(key, embedding, "bedtime answer")
+
+    assert cache.lookup(MORNING)[0] is None
+    assert cache.lookup(BEDTIME_REWORDED)[0] == "bedtime answer"
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_same_text_is_answered_without_embedding():
+    embedder = Embedder()
+    cache = SemanticQueryCache(embed_fn=embedder)
+    response, key, embedding = cache.lookup(BEDTIME)
+    cache.store(key, embedding, "bedtime answer")
+
+    assert cache.lookup("how do i calm my child down at BEDTIME")[0] == "bedtime answer"
+    assert embedder.calls == [BEDTIME]
+
+
+def test_miss_hands_its_embedding_to_the_engine():
+    embedder = Embedder()
+    engine = RecordingEngine()
+    cached = CachedQueryEngine(engine, SemanticQueryCache(embed_fn=embedder))
+
+    cached.query(BEDTIME)
+
+    assert embedder.calls == [BEDTIME]
+    assert engine.bundles[0].embedding == EMBEDDINGS[BEDTIME]
+
+
+def test_query_that_already_has_an_embedding_is_not_embedded_again():
+    from llama_index.schema import QueryBundle
+
+    embedder = Embedder()
+    cached = CachedQueryEngine(RecordingEngine(), SemanticQueryCache(embed_fn=embedder))
+
+    cached.query(QueryBundle(BEDTIME, embedding=EMBEDDINGS[BEDTIME]))
+
+    assert embedder.calls == []
+
+
+def test_size_counts_the_source_text():
+    node = TextNode(text="x" * 1000, metadata={"page_label": "12"})
+    response = Response("short answer", source_nodes=[NodeWithScore(node=node, score=0.9)])
+
+    assert response_size(response) >= 1000 + len("short answer")
+
+
+def test_entries_are_evicted_by_size():
+    cache = SemanticQueryCache(embed_fn=Embedder(), max_bytes=1500)
+    node = NodeWithScore(node=TextNode(text="x" * 1000), score=0.9)
+    for query in [BEDTIME, MORNING]:
+        response, key, embedding = cache.lookup(query)
+        cache.store(key, embedding, Response("answer", source_nodes=[node]))
+
+    assert cache.stats()["entries"] == 1
+    assert cache.lookup(MORNING)[0] is not None
+
+
+def test_similarity_can_be_set_per_tool(monkeypatch):
+    monkeypatch.setattr(query_cache, "QUERY_CACHES", {})
+    monkeypatch.setattr(query_cache, "QUERY_CACHE_SIMILARITIES", {"toolboxes": 0.9})
+
+    cached_query_engine("toolboxes", RecordingEngine(), embed_fn=Embedder())
+    cached_query_engine("challenging_child", RecordingEngine(), embed_fn=Embedder())
+
+    assert query_cache.QUERY_CACHES["toolboxes"]._similarity == 0.9
+    assert query_cache.QUERY_CACHES["challenging_child"]._similarity == query_cache.QUERY_CACHE_SIMILARITY
@@ -0,0 +1,261 @@
+import time
+import threading
+import pytest
+from llama_index.llms import ChatMessage, MessageRole
+from agent.session_manager import AgentSessionManager, to_chat_history
+from controllers import message_controller
+
+
+class FakeAgent:
+    def __init__(self, chat_history=None):
+        self.chat_history = list(chat_history or [])
+
+    def chat(self, message):
+        self.chat_history.append(ChatMessage(role=MessageRole.USER, content=message))
+        self.chat_history.append(ChatMessage(role=MessageRole.ASSISTANT, content=message))
+
+
+def manager(**kwargs):
+    created = []
+
+    def create_agent(env, user, chat_history):
+        created.append((env, user))
+        return FakeAgent(chat_history)
+
+    return AgentSessionManager(create_agent, **kwargs), created
+
+
+def turn(sessions, env, user, message):
+    agent = sessions.get_agent(env, user)
+    with sessions.session_lock(env, user):
+        agent.chat(message)
+    return agent
+
+
+def test_one_agent_per_user():
+    sessions, created = manager()
+
+    agent = sessions.get_agent("dev", "ana")
+    assert sessions.get_agent("dev", "ana") is agent
+    assert sessions.get_agent("dev", "ben") is not agent
+    assert sessions.get_agent("prod", "ana") is not agent
+    assert created == [("dev", "ana"), ("dev", "ben"), ("prod", "ana")]
+
+
+def test_least_recently_used_session_is_evicted():
+    sessions, created = manager(max_sessions=2)
+
+    sessions.get_agent("dev", "ana")
+    sessions.get_agent("dev", "ben")
+    sessions.get_agent("dev", "ana")
+    sessions.get_agent("dev", "cleo")
+
+    assert sessions.stats()["sessions"] == 2
+    sessions.get_agent("dev", "ana")
+    sessions.get_agent("dev", "ben")
+    assert created == [("dev", "ana"), ("dev", "ben"), ("dev", "cleo"), ("dev", "ben")]
+
+
+def test_memory_limit_counts_what_turns_add():
+    sessions, created = manager(max_memory_bytes=100)
+
+    turn(sessions, "dev", "ana", "a" * 30)
+    assert sessions.stats()["memory_bytes"] == 60
+    turn(sessions, "dev", "ben", "b" * 30)
+
+    # the turn that pushed the total over the limit evicts the other, older session
+    assert sessions.stats() == {"sessions": 1, "busy_sessions": 0, "memory_bytes": 60}
+    sessions.get_agent("dev", "ana")
+    assert created[-1] == ("dev", "ana")
+
+
+def test_memory_is_not_measured_on_lookups():
+    sessions, _ = manager()
+    agent = turn(sessions, "dev", "ana", "hello")
+
+    class CountingHistory(list):
+        reads = 0
+
+        def __iter__(self):
+            CountingHistory.reads += 1
+            return super().__iter__()
+
+    agent.chat_history = CountingHistory(agent.chat_history)
+    for user in ["ben", "cleo", "ana", "ana"]:
+        sessions.get_agent("dev", user)
+    assert CountingHistory.reads == 0
+
+    turn(sessions, "dev", "ana", "again")
+    assert CountingHistory.reads == 1
+    assert sessions.stats()["memory_bytes"] == 2 * len("hello") + 2 * len("again")
+
+
+def test_idle_sessions_are_dropped():
+    sessions, created = manager(idle_seconds=0.05)
+
+    sessions.get_agent("dev", "ana")
+    time.sleep(0.1)
+    sessions.evict_idle()
+
+    assert sessions.stats() == {"sessions": 0, "busy_sessions": 0, "memory_bytes": 0}
+    sessions.get_agent("dev", "ana")
+    assert created == [("dev", "ana"), ("dev", "ana")]
+
+
+def test_evicted_session_is_rebuilt_from_history():
+    histories = {("dev", "ana"): [ChatMessage(role=MessageRole.USER, content="I'm Ana")]}
+    sessions = AgentSessionManager(
+        lambda env, user, chat_history: FakeAgent(chat_history),
+        load_history=lambda env, user: histories.get((env, user), []),
+        max_sessions=1,
+    )
+
+    sessions.get_agent("dev", "ana")
+    sessions.get_agent("dev", "ben")
+    agent = sessions.get_agent("dev", "ana")
+
+    assert [message.content for message in agent.chat_history] == ["I'm Ana"]
+    assert sessions.stats()["memory_bytes"] == len("I'm Ana")
+
+
+def test_reset_only_drops_the_given_user():
+    sessions, _ = manager()
+    turn(sessions, "dev", "ana", "hi")
+    turn(sessions, "dev", "ben", "hi")
+    turn(sessions, "prod", "ana", "hi")
+
+    sessions.reset("dev", "ana")
+    assert sessions.stats()["sessions"] == 2
+    assert sessions.stats()["memory_bytes"] == 8
+
+    sessions.reset("dev")
+    assert sessions.stats()["sessions"] == 1
+
+
+def test_concurrent_first_requests_share_one_session():
+    start = threading.Barrier(8)
+
+    def create_agent(env, user, chat_history):
+        time.sleep(0.05)
+        return FakeAgent(chat_history)
+
+    sessions = AgentSessionManager(create_agent)
+    agents = []
+
+    def get():
+        start.wait()
+        agents.append(sessions.get_agent("dev", "ana"))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(agent) for agent in agents}) == 1
+    assert sessions.stats()["sessions"] == 1
+
+
+def test_request_that_lost_the_race_still_counts_as_a_use():
+    release = threading.Event()
+    slow = []
+
+    def create_agent(env, user, chat_history):
+        if user == "ana" and not slow:
+            slow.append(1)
+            release.wait(5)
+        return FakeAgent(chat_history)
+
+    sessions = AgentSessionManager(create_agent, max_sessions=2)
+    loser = threading.Thread(target=sessions.get_agent, args=("dev", "ana"))
+    loser.start()
+    while not slow:
+        time.sleep(0.01)
+    agent = sessions.get_agent("dev", "ana")
+    sessions.get_agent("dev", "ben")
+    release.set()
+    loser.join()
+
+    # ana was used after ben, so ben is the one evicted
+    sessions.get_agent("dev", "cleo")
+    assert sessions.get_agent("dev", "ana") is agent
+    assert sessions.stats()["sessions"] == 2
+
+
+def test_to_chat_history_marks_the_coach_as_assistant():
+    history = to_chat_history([("ana", "hi"), ("ai_coach", "hey")], "ai_coach")
+    assert [(message.role, message.content) for message in history] == [
+        (MessageRole.USER, "hi"),
+        (MessageRole.ASSISTANT, "hey"),
+    ]
+
+
+@pytest.mark.parametrize("user", [None, ""])
+def test_agent_routes_need_a_user(user):
+    body = {"content": "hi"}
+
+    assert message_controller.get_agent_response("dev", body, user)[1] == 400
+    assert message_controller.stream_agent_response("dev", body, user)[1] == 400
+    assert message_controller.send_file("content-id", "dev", {"file": object()}, user)[1] == 400
+
+
+def run_turns(sessions, users, hold=0.1):
+    active = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def turn(env, user):
+        with sessions.session_lock(env, user):
+            with lock:
+                active.append(user)
+                overlaps.append(len(active))
+            time.sleep(hold)
+            with lock:
+                active.remove(user)
+
+    threads = [threading.Thread(target=turn, args=("dev", user)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return max(overlaps)
+
+
+def test_turns_of_one_user_are_serialized():
+    sessions, _ = manager()
+
+    assert run_turns(sessions, ["ana", "ana", "ana"]) == 1
+
+
+def test_turns_of_different_users_run_in_parallel():
+    sessions, _ = manager()
+
+    assert run_turns(sessions, ["ana", "ben", "cleo"]) == 3
+
+
+def test_session_locks_are_dropped_once_released():
+    sessions, _ = manager()
+    run_turns(sessions, ["ana", "ana", "ben"], hold=0.01)
+
+    assert sessions.stats()["busy_sessions"] == 0
+
+
+def test_lock_outlives_an_eviction_during_the_turn():
+    sessions, _ = manager(max_sessions=1)
+    acquired = threading.Event()
+
+    def next_turn():
+        with sessions.session_lock("dev", "ana"):
+            acquired.set()
+
+    sessions.get_agent("dev", "ana")
+    with sessions.session_lock("dev", "ana"):
+        # another user's session evicts ana's while her turn still runs
+        sessions.get_agent("dev", "ben")
+        waiter = threading.Thread(target=next_turn)
+        waiter.start()
+        assert not acquired.wait(0.1)
+
+    waiter.join(5)
+    assert acquired.is_set()
+    assert sessions.stats()["busy_sessions"] == 0
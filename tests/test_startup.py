@@ -0,0 +1,129 @@
+import threading
+import pytest
+from agent import index_loader
+from agent.index_loader import LazyIndex
+from agent.warmup import AgentWarmup
+from monitoring.startup import StartupReport
+
+
+def test_phases_and_checks_are_reported():
+    startup = StartupReport()
+    with startup.phase("routes"):
+        pass
+    with pytest.raises(ValueError):
+        with startup.phase("tools_setup"):
+            raise ValueError("no api key")
+    startup.add_check("agent_tools", lambda: False)
+
+    report = startup.report()
+
+    assert report["phases"]["routes"]["status"] == "done"
+    assert report["phases"]["tools_setup"] == {**report["phases"]["tools_setup"], "status": "failed", "error": "no api key"}
+    assert report["checks"] == {"agent_tools": False}
+    assert not startup.ready()
+
+
+def test_warmup_builds_the_tools_once_in_the_background():
+    startup = StartupReport()
+    release = threading.Event()
+    builds = []
+
+    def build():
+        builds.append(1)
+        release.wait(5)
+        return ["tool"]
+
+    warmup = AgentWarmup(build, startup)
+    warmup.start()
+    assert not startup.ready()
+
+    release.set()
+    assert warmup.tools(timeout=5) == ["tool"]
+    assert startup.ready()
+    assert builds == [1]
+
+
+def test_failed_warmup_is_retried():
+    attempts = []
+
+    def build():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("index missing")
+        return ["tool"]
+
+    warmup = AgentWarmup(build, StartupReport())
+    with pytest.raises(RuntimeError):
+        warmup.tools(timeout=5)
+
+    assert warmup.tools(timeout=5) == ["tool"]
+
+
+def test_on_demand_index_does_not_hold_readiness_back(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(index_loader, "load_index", lambda name: release.wait(5) and name)
+    lazy_index = LazyIndex("challenging_child", background=False)
+
+    assert lazy_index.ready()
+    loading = threading.Thread(target=lazy_index.get)
+    loading.start()
+    assert lazy_index.ready()
+    release.set()
+    loading.join(5)
+    assert lazy_index.ready()
+
+
+def test_failed_on_demand_index_is_not_ready(monkeypatch):
+    def load_index(name):
+        raise index_loader.IndexManifestError("broken")
+
+    monkeypatch.setattr(index_loader, "load_index", load_index)
+    lazy_index = LazyIndex("challenging_child", background=False)
+
+    with pytest.raises(index_loader.IndexManifestError):
+        lazy_index.get()
+    assert not lazy_index.ready()
+
+
+def test_readyz_follows_the_startup_checks(client, monkeypatch):
+    from controllers import message_controller
+
+    startup = StartupReport()
+    ready = threading.Event()
+    startup.add_check("agent_tools", ready.is_set)
+    monkeypatch.setattr(message_controller, "startup_report", startup)
+
+    assert client.get("/readyz").status_code == 503
+    ready.set()
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.get_json()["checks"] == {"agent_tools": True}
+    assert client.get("/healthz").status_code == 200
+
+
+def test_module_app_is_created_on_first_lookup(monkeypatch):
+    import main
+
+    created = []
+    monkeypatch.setattr(main, "_app", None)
+    monkeypatch.setattr(main, "create_app", lambda: created.append(1) or "app")
+
+    assert main.app == "app"
+    assert main.app == "app"
+    assert created == [1]
+    with pytest.raises(AttributeError):
+        main.application
+
+
+def test_create_app_registers_the_routes(monkeypatch):
+    import fireo
+    import main
+
+    monkeypatch.setattr(fireo, "connection", lambda **kwargs: None)
+    # create_app sets it, restored once the test is done
+    monkeypatch.setenv("GOOGLE_APPLICATION_CREDENTIALS", "serviceAccountKey.json")
+    monkeypatch.setattr(main, "AGENT_WARMUP", "post_fork")
+
+    app = main.create_app()
+
+    assert app.test_client().get("/healthz").status_code == 200
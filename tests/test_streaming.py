@@ -0,0 +1,73 @@
+import json
+from conftest import REPLY
+
+
+def parse_events(events):
+    parsed = []
+    for event in events:
+        name, data = event.strip().split("\n")
+        parsed.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    return parsed
+
+
+def stored_replies(controller, user):
+    return [message.content for message in controller.get_storage("dev").query(user).fetch() if message.user == "ai_coach"]
+
+
+def test_reply_is_streamed_token_by_token_then_saved(controller):
+    events, status_code = controller.stream_agent_response("dev", {"content": "hi"}, "ana")
+
+    events = parse_events(events)
+    assert status_code == 200
+    assert "".join(data["delta"] for name, data in events if name == "token") == REPLY
+    assert [name for name, data in events][-1] == "done"
+    assert events[-1][1]["message"]["content"] == REPLY
+    assert stored_replies(controller, "ana") == [REPLY]
+
+
+def test_streamed_send_starts_with_the_saved_user_message(controller):
+    body = {"type": "text", "content": "hi", "createdAt": "2024-01-01T10:00:00Z"}
+
+    events, status_code = controller.send_message("dev", "ana", body, stream=True)
+
+    events = parse_events(events)
+    assert status_code == 200
+    assert events[0][0] == "userMessage"
+    assert events[0][1]["content"] == "hi"
+    assert events[-1][0] == "done"
+
+
+def test_reply_is_saved_when_the_client_goes_away(controller):
+    events, _ = controller.stream_agent_response("dev", {"content": "hi"}, "ana")
+
+    next(events)
+    events.close()
+
+    assert stored_replies(controller, "ana") == [REPLY]
+    # the session lock was released with the generator
+    assert controller.agent_sessions.stats()["busy_sessions"] == 0
+
+
+def test_agent_failure_ends_the_stream_with_an_error(controller):
+    controller.agent_sessions.get_agent("dev", "ana").stream_chat = lambda message: 1 / 0
+
+    events = parse_events(controller.stream_agent_response("dev", {"content": "hi"}, "ana")[0])
+
+    assert events == [("error", {"error": "division by zero"})]
+    assert stored_replies(controller, "ana") == []
+
+
+def test_stream_route_sends_server_sent_events(client):
+    response = client.post("/api/streamAgentResponse?env=dev&user=ana", json={"content": "hi"})
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    events = parse_events(chunk for chunk in response.get_data(as_text=True).split("\n\n") if chunk)
+    assert events[-1][0] == "done"
+
+
+def test_stream_route_without_user_is_rejected(client):
+    response = client.post("/api/streamAgentResponse?env=dev", json={"content": "hi"})
+
+    assert response.status_code == 400
@@ -0,0 +1,102 @@
+import time
+from llama_index.llms import OpenAI
+from llama_index.memory import ChatMemoryBuffer
+from llama_index.tools import FunctionTool
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall, Function
+from agent import tool_executor
+from agent.deadlines import request_deadline
+from agent.tool_executor import ParallelToolAgentWorker
+
+
+def slow_tool(name, seconds, answer):
+    def fn(query: str) -> str:
+        time.sleep(seconds)
+        return f"{answer} {query}"
+
+    return FunctionTool.from_defaults(fn=fn, name=name, description=f"{name} tool")
+
+
+def tool_call(name, call_id, arguments='{"query": "calm"}'):
+    return ChatCompletionMessageToolCall(id=call_id, type="function", function=Function(name=name, arguments=arguments))
+
+
+def make_worker(tools):
+    return ParallelToolAgentWorker(tools, OpenAI(model="gpt-3.5-turbo", api_key="sk-test"), prefix_messages=[])
+
+
+def run_calls(tools, tool_calls):
+    """Submits the calls the way one step would, then waits for them. Returns the messages, sources and seconds taken."""
+    worker = make_worker(tools)
+    memory = ChatMemoryBuffer.from_defaults()
+    sources = []
+    start = time.monotonic()
+    worker._pending.calls = []
+    for call in tool_calls:
+        worker._call_function(tools, call, memory, sources)
+    worker._collect(worker._pending.calls)
+    return memory.get_all(), sources, time.monotonic() - start
+
+
+def test_calls_run_concurrently_and_are_answered_in_order():
+    tools = [slow_tool("toolboxes", 0.3, "breathe"), slow_tool("videos", 0.1, "watch")]
+    messages, sources, seconds = run_calls(tools, [tool_call("toolboxes", "a"), tool_call("videos", "b")])
+
+    assert seconds < 0.35
+    assert [message.additional_kwargs["tool_call_id"] for message in messages] == ["a", "b"]
+    assert [message.content for message in messages] == ["breathe calm", "watch calm"]
+    assert [source.tool_name for source in sources] == ["toolboxes", "videos"]
+
+
+def test_slow_call_times_out_alone(monkeypatch):
+    monkeypatch.setitem(tool_executor.AGENT_TOOL_TIMEOUTS, "toolboxes", 0.1)
+    tools = [slow_tool("toolboxes", 0.5, "breathe"), slow_tool("videos", 0, "watch")]
+
+    messages, sources, seconds = run_calls(tools, [tool_call("toolboxes", "a"), tool_call("videos", "b")])
+
+    assert seconds < 0.4
+    assert messages[0].content == "Error: toolboxes did not answer within 0.1s"
+    assert messages[1].content == "watch calm"
+
+
+def test_tool_cannot_outlive_the_request_deadline():
+    tools = [slow_tool("toolboxes", 0.5, "breathe")]
+
+    with request_deadline(0.1):
+        messages, sources, seconds = run_calls(tools, [tool_call("toolboxes", "a")])
+
+    assert seconds < 0.4
+    assert messages[0].content.startswith("Error: toolboxes did not answer within 0.")
+
+
+def test_unknown_tool_and_bad_arguments_are_answered_with_errors():
+    tools = [slow_tool("videos", 0, "watch")]
+
+    messages, sources, seconds = run_calls(
+        tools, [tool_call("missing", "a"), tool_call("videos", "b", arguments="{not json"), tool_call("videos", "c")]
+    )
+
+    assert messages[0].content.startswith("Error: ")
+    assert messages[1].content.startswith("Error: ")
+    assert [message.additional_kwargs["tool_call_id"] for message in messages] == ["a", "b", "c"]
+    assert messages[2].content == "watch calm"
+
+
+def test_failing_tool_is_answered_with_its_error():
+    def broken(query: str) -> str:
+        raise RuntimeError("index unavailable")
+
+    messages, sources, seconds = run_calls([FunctionTool.from_defaults(fn=broken, name="broken")], [tool_call("broken", "a")])
+
+    assert "index unavailable" in messages[0].content
+    assert isinstance(sources[0].raw_output, RuntimeError)
+
+
+def test_outside_a_step_calls_run_inline():
+    tools = [slow_tool("videos", 0, "watch")]
+    worker = make_worker(tools)
+    memory = ChatMemoryBuffer.from_defaults()
+    sources = []
+
+    worker._call_function(tools, tool_call("videos", "a"), memory, sources)
+
+    assert memory.get_all()[0].content == "watch calm"
@@ -0,0 +1,138 @@
+import json
+import numpy as np
+import pytest
+from llama_index.vector_stores.types import ExactMatchFilter, MetadataFilters, VectorStoreQuery
+from agent.vector_store import MmapVectorStore, convert_persist_dir, normalize_rows, write_vectors
+
+rng = np.random.default_rng(7)
+MATRIX = rng.normal(size=(60, 8)).astype(np.float32)
+IDS = [f"node-{i}" for i in range(60)]
+REF_DOC_IDS = [f"doc-{i % 4}" for i in range(60)]
+METADATA = {node_id: {"page_label": str(i % 5), "topic": "calm" if i % 2 else "sleep", "tags": ["calm"]} for i, node_id in enumerate(IDS)}
+
+
+def store():
+    return MmapVectorStore(normalize_rows(MATRIX), list(IDS), list(REF_DOC_IDS), dict(METADATA))
+
+
+def brute_force(query_embedding, top_k, keep=lambda row: True):
+    scores = normalize_rows(MATRIX) @ normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+    rows = sorted((row for row in range(len(IDS)) if keep(row)), key=lambda row: -scores[row])
+    return [IDS[row] for row in rows[:top_k]]
+
+
+def query(**kwargs):
+    return VectorStoreQuery(query_embedding=list(rng.normal(size=8)), **kwargs)
+
+
+def test_top_k_matches_brute_force():
+    vector_store = store()
+    for _ in range(5):
+        vector_query = query(similarity_top_k=7)
+        assert vector_store.query(vector_query).ids == brute_force(vector_query.query_embedding, 7)
+
+
+def test_doc_ids_restrict_the_search():
+    vector_query = query(similarity_top_k=5, doc_ids=["doc-1", "doc-3"])
+
+    ids = store().query(vector_query).ids
+
+    assert ids == brute_force(vector_query.query_embedding, 5, lambda row: REF_DOC_IDS[row] in {"doc-1", "doc-3"})
+
+
+def test_node_ids_restrict_the_search():
+    node_ids = IDS[10:20]
+    vector_query = query(similarity_top_k=3, node_ids=node_ids)
+
+    assert store().query(vector_query).ids == brute_force(vector_query.query_embedding, 3, lambda row: 10 <= row < 20)
+
+
+def test_node_ids_naming_every_node_filter_nothing():
+    vector_store = store()
+    every_node = list(reversed(IDS))
+    vector_query = query(similarity_top_k=4, node_ids=every_node)
+
+    assert vector_store.query(vector_query).ids == brute_force(vector_query.query_embedding, 4)
+    # the same list comes with every query of a retriever, it is recognized without being compared again
+    assert vector_store._all_node_ids is every_node
+
+
+def test_metadata_filters_combine():
+    filters = MetadataFilters(filters=[
+        ExactMatchFilter(key="page_label", value="2"),
+        ExactMatchFilter(key="topic", value="calm"),
+    ])
+    vector_query = query(similarity_top_k=10, filters=filters, doc_ids=["doc-1", "doc-3"])
+
+    ids = store().query(vector_query).ids
+
+    expected = brute_force(
+        vector_query.query_embedding, 10,
+        lambda row: row % 5 == 2 and row % 2 == 1 and REF_DOC_IDS[row] in {"doc-1", "doc-3"},
+    )
+    assert ids == expected
+    assert ids
+
+
+def test_filter_that_matches_nothing_returns_nothing():
+    filters = MetadataFilters(filters=[ExactMatchFilter(key="page_label", value="99")])
+
+    assert store().query(query(similarity_top_k=3, filters=filters)).ids == []
+
+
+def test_only_exact_match_filters_are_supported():
+    from llama_index.vector_stores.types import FilterOperator, MetadataFilter
+
+    filters = MetadataFilters(filters=[MetadataFilter(key="page_label", value="2", operator=FilterOperator.GT)])
+    with pytest.raises(ValueError):
+        store().query(query(similarity_top_k=3, filters=filters))
+
+
+def test_vectors_round_trip_through_the_persist_dir(tmp_path):
+    write_vectors(str(tmp_path), MATRIX, IDS, REF_DOC_IDS, METADATA)
+    loaded = MmapVectorStore.from_persist_dir(str(tmp_path))
+    vector_query = query(similarity_top_k=5, doc_ids=["doc-2"])
+
+    assert isinstance(loaded._matrix, np.memmap)
+    assert loaded.query(vector_query).ids == store().query(vector_query).ids
+
+
+def test_json_vector_store_is_converted(tmp_path):
+    (tmp_path / "default__vector_store.json").write_text(json.dumps({
+        "embedding_dict": {node_id: MATRIX[i].tolist() for i, node_id in enumerate(IDS)},
+        "text_id_to_ref_doc_id": dict(zip(IDS, REF_DOC_IDS)),
+        "metadata_dict": METADATA,
+    }))
+
+    assert convert_persist_dir(str(tmp_path)) == len(IDS)
+    vector_query = query(similarity_top_k=5)
+    assert MmapVectorStore.from_persist_dir(str(tmp_path)).query(vector_query).ids == brute_force(vector_query.query_embedding, 5)
+
+
+class StubLazyIndex:
+    def __init__(self, index):
+        self.index = index
+
+    def get(self):
+        return self.index
+
+
+def test_toolbox_engine_searches_the_mmap_store_without_a_node_id_filter(tmp_path):
+    from llama_index import ServiceContext, StorageContext, VectorStoreIndex, load_index_from_storage
+    from llama_index import MockEmbedding
+    from llama_index.schema import TextNode
+    from agent.index_loader import LazyQueryEngine
+
+    service_context = ServiceContext.from_defaults(embed_model=MockEmbedding(embed_dim=8), llm=None)
+    nodes = [TextNode(text=f"passage {i}", id_=f"node-{i}") for i in range(5)]
+    VectorStoreIndex(nodes, service_context=service_context).storage_context.persist(str(tmp_path))
+    convert_persist_dir(str(tmp_path))
+    storage_context = StorageContext.from_defaults(
+        persist_dir=str(tmp_path), vector_store=MmapVectorStore.from_persist_dir(str(tmp_path))
+    )
+    index = load_index_from_storage(storage_context, service_context=service_context)
+
+    retriever = LazyQueryEngine(StubLazyIndex(index), service_context=service_context, similarity_top_k=3).get_query_engine().retriever
+
+    assert retriever._node_ids is None
+    assert len(retriever.retrieve("how do I stay calm")) == 3
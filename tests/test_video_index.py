@@ -0,0 +1,75 @@
+import numpy as np
+from agent.video_index import VideoIndex, format_local_recommendation, video_link
+
+VIDEOS = {
+    "breath": "a breathing exercise for anxiety",
+    "sleep": "a body scan to fall asleep",
+    "anger": "cooling down when you feel angry",
+}
+VECTORS = {
+    VIDEOS["breath"]: [1.0, 0.0, 0.0],
+    VIDEOS["sleep"]: [0.0, 1.0, 0.0],
+    VIDEOS["anger"]: [0.0, 0.0, 1.0],
+    "I can't sleep": [0.1, 0.9, 0.0],
+}
+
+
+class FakeEmbedModel:
+    def __init__(self):
+        self.batches = []
+        self.queries = []
+
+    def get_text_embedding_batch(self, texts):
+        self.batches.append(texts)
+        return [VECTORS[text] for text in texts]
+
+    def get_query_embedding(self, text):
+        self.queries.append(text)
+        return VECTORS[text]
+
+
+def test_best_matches_come_first(tmp_path):
+    index = VideoIndex(VIDEOS, FakeEmbedModel(), path=str(tmp_path / "videos.npz"))
+
+    candidates = index.top_k("I can't sleep", k=2)
+
+    assert [video_id for video_id, summary, score in candidates] == ["sleep", "breath"]
+    assert candidates[0][1] == VIDEOS["sleep"]
+    assert candidates[0][2] > candidates[1][2]
+
+
+def test_summaries_are_embedded_once_and_cached_on_disk(tmp_path):
+    path = str(tmp_path / "videos.npz")
+    embed_model = FakeEmbedModel()
+    index = VideoIndex(VIDEOS, embed_model, path=path)
+    index.top_k("I can't sleep")
+    index.top_k("I can't sleep")
+    assert len(embed_model.batches) == 1
+
+    reloaded = FakeEmbedModel()
+    np.testing.assert_array_equal(VideoIndex(VIDEOS, reloaded, path=path).matrix(), index.matrix())
+    assert reloaded.batches == []
+
+
+def test_changed_summaries_are_embedded_again(tmp_path):
+    path = str(tmp_path / "videos.npz")
+    VideoIndex(VIDEOS, FakeEmbedModel(), path=path).matrix()
+
+    embed_model = FakeEmbedModel()
+    VideoIndex({video_id: VIDEOS[video_id] for video_id in ["breath", "sleep"]}, embed_model, path=path).matrix()
+
+    assert len(embed_model.batches) == 1
+
+
+def test_no_videos_means_no_candidates(tmp_path):
+    embed_model = FakeEmbedModel()
+    assert VideoIndex({}, embed_model, path=str(tmp_path / "videos.npz")).top_k("I can't sleep") == []
+    assert embed_model.queries == []
+
+
+def test_local_recommendation_links_the_best_match():
+    answer = format_local_recommendation([("sleep", VIDEOS["sleep"], 0.9), ("breath", VIDEOS["breath"], 0.1)])
+
+    assert video_link("sleep") in answer
+    assert VIDEOS["sleep"] in answer
+    assert "Sorry" in format_local_recommendation([])
@@ -0,0 +1,103 @@
+import json
+import threading
+from agent import video_summaries
+from agent.video_summaries import extract_video_id, load_video_summaries
+
+LINKS = [
+    "https://youtu.be/aaa?si=1",
+    "https://youtu.be/bbb?si=2",
+    "https://youtu.be/aaa?si=3",
+]
+
+
+class Recorder:
+    def __init__(self, transcripts):
+        self.transcripts = transcripts
+        self.fetched = []
+        self.summarized = []
+        self._lock = threading.Lock()
+
+    def fetch(self, link):
+        with self._lock:
+            self.fetched.append(extract_video_id(link))
+        return self.transcripts[extract_video_id(link)]
+
+    def summarize(self, transcript):
+        with self._lock:
+            self.summarized.append(transcript)
+        return f"summary of {transcript}"
+
+
+def load(path, recorder, revalidate=False, links=LINKS):
+    return load_video_summaries(links, str(path), revalidate, 2, recorder.fetch, recorder.summarize)
+
+
+def test_extract_video_id():
+    assert extract_video_id("https://youtu.be/nPvN1OI7h80?si=iB3") == "nPvN1OI7h80"
+    assert extract_video_id("https://www.youtube.com/watch?v=abc&t=10") == "abc"
+
+
+def test_summaries_are_built_once_and_reused(tmp_path):
+    path = tmp_path / "summaries.json"
+    first = Recorder({"aaa": "one", "bbb": "two"})
+
+    assert load(path, first) == {"aaa": "summary of one", "bbb": "summary of two"}
+    # the same video linked twice is only summarized once
+    assert sorted(first.summarized) == ["one", "two"]
+
+    second = Recorder({})
+    assert load(path, second) == {"aaa": "summary of one", "bbb": "summary of two"}
+    assert second.fetched == [] and second.summarized == []
+
+
+def test_only_new_videos_are_summarized(tmp_path):
+    path = tmp_path / "summaries.json"
+    load(path, Recorder({"aaa": "one", "bbb": "two"}))
+
+    recorder = Recorder({"ccc": "three"})
+    summaries = load(path, recorder, links=LINKS + ["https://youtu.be/ccc"])
+
+    assert summaries["ccc"] == "summary of three"
+    assert recorder.fetched == ["ccc"]
+
+
+def test_revalidate_only_resummarizes_changed_transcripts(tmp_path):
+    path = tmp_path / "summaries.json"
+    load(path, Recorder({"aaa": "one", "bbb": "two"}))
+
+    recorder = Recorder({"aaa": "one", "bbb": "two, edited"})
+    summaries = load(path, recorder, revalidate=True)
+
+    assert sorted(recorder.fetched) == ["aaa", "bbb"]
+    assert recorder.summarized == ["two, edited"]
+    assert summaries["bbb"] == "summary of two, edited"
+
+
+def test_a_failed_video_keeps_its_old_summary(tmp_path):
+    path = tmp_path / "summaries.json"
+    load(path, Recorder({"aaa": "one", "bbb": "two"}))
+
+    recorder = Recorder({"aaa": "one, edited"})
+    summaries = load(path, recorder, revalidate=True)
+
+    assert summaries == {"aaa": "summary of one, edited", "bbb": "summary of two"}
+
+
+def test_snapshot_from_another_prompt_is_ignored(tmp_path, monkeypatch):
+    path = tmp_path / "summaries.json"
+    load(path, Recorder({"aaa": "one", "bbb": "two"}))
+
+    monkeypatch.setattr(video_summaries, "SUMMARY_PROMPT", "Summarize differently: {transcript}")
+    recorder = Recorder({"aaa": "one", "bbb": "two"})
+    load(path, recorder)
+
+    assert sorted(recorder.summarized) == ["one", "two"]
+    assert json.loads(path.read_text())["key"] == video_summaries.snapshot_key()
+
+
+def test_unreadable_snapshot_is_rebuilt(tmp_path):
+    path = tmp_path / "summaries.json"
+    path.write_text("{not json")
+
+    recorder = Recorder({"aaa": "one", "bbb": "two"})
+    assert load(path, recorder) == {"aaa": "summary of one", "bbb": "summary of two"}